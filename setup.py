@@ -31,6 +31,7 @@ setup(
             'pytest',
         ],
         'pyramid': ['pyramid'],
+        'numpy': ['numpy'],
     },
     entry_points={},
     author='gocept <mail@gocept.com>',
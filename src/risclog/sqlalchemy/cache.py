@@ -1,13 +1,61 @@
+import collections
+import concurrent.futures
+import contextlib
+import copy
 import csv
 import gc
 import io
+import itertools
+import operator
+import os
 import sys
-
+import time
+import tracemalloc
+import weakref
+
+import risclog.sqlalchemy.interfaces
+import risclog.sqlalchemy.pgcopy
+import risclog.sqlalchemy.snapshot
+import risclog.sqlalchemy.sortedindex
 import sqlalchemy
+import zope.component
 from risclog.sqlalchemy.model import ObjectBase
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import attributes
 
+# Number of bytes handed to PostgreSQL per read during COPY.
+COPY_BUFFER_SIZE = 65536
+
+# Table recording the progress of checkpointed flushes, see `ModelCache`.
+CHECKPOINT_TABLE = 'modelcache_checkpoint'
+
+
+def _batches(iterable, size):
+    """Yield lists of at most `size` consecutive items of `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _record_type(name, fields):
+    """
+    Return a named tuple class whose instances are compared by identity,
+    like model instances, so equal rows stay distinct in index buckets.
+    """
+    return type(
+        name,
+        (collections.namedtuple(name, fields, rename=True),),
+        {
+            '__slots__': (),
+            '__hash__': object.__hash__,
+            '__eq__': object.__eq__,
+            '__ne__': object.__ne__,
+        },
+    )
+
 
 class MultipleObjectsFoundException(Exception):
     """Raised when a single result was expected but multiple were found."""
@@ -15,6 +63,12 @@ class MultipleObjectsFoundException(Exception):
     pass
 
 
+class DuplicateKeyException(Exception):
+    """Raised when an instance would violate a unique index."""
+
+    pass
+
+
 class ModelCache:
     """
     A cache for SQLAlchemy ORM model instances, used to enhance performance
@@ -31,9 +85,9 @@ class ModelCache:
     changes to the database and clearing the cache.
 
     For setup, `ModelCache` currently needs some metadata about the models
-    it should handle. Namely, the order in which models will be saved should
-    be specified by an iterable (`save_order`). Use this to handle foreign key
-    dependencies between your tables.
+    it should handle. Namely, the order in which models will be saved can
+    be specified by an iterable (`save_order`). If it is None, the order is
+    derived from the foreign key dependencies between the models' tables.
     Additionally, a dictionary `sequences` specifies model attributes and
     corresponding sequences that will be set during flushing. Use this for
     example for primary keys that normally are set automatically when creating
@@ -62,12 +116,36 @@ class ModelCache:
         logger=None,
         use_copy=False,
         check_memory_usage=False,
+        preload_batch_size=None,
+        copy_format='csv',
+        copy_updates=False,
+        unique_indices={},
+        indices={},
+        load_on_miss=False,
+        load_batch_size=1000,
+        flush_workers=1,
+        sequence_block_size=None,
+        snapshot_dir=None,
+        snapshot_versions={},
+        profile_memory=False,
+        auto_flush_count=None,
+        auto_flush_memory=None,
+        read_only_models=(),
+        columnar_models={},
+        upsert_models={},
+        upsert_update=True,
+        upsert_returning=False,
+        prefetch_strategy='joined',
+        checkpoint_size=None,
+        checkpoint_name='default',
+        strict_transaction=False,
     ):
         """
         Args:
             save_order: Iterable of model names, specifying the order in
                         which models will be saved. Used to solve dependency
-                        constraints.
+                        constraints. If None, models are saved in
+                        topological levels of their foreign keys instead.
             sequences: Dictionary that matches models' attributes to
                        database sequences that are set automatically on
                        flushing.
@@ -79,19 +157,248 @@ class ModelCache:
             preload_models: Preloads existing model instances on setup if True.
             use_copy: Use PostgreSQL's COPY command to insert new instances if
                       True.
+            preload_batch_size: Stream preloaded model instances from a
+                                server-side cursor in batches of this size
+                                instead of fetching all rows at once.
+                                Cannot be combined with prefetching
+                                collections via `prefetch`.
+            copy_format: Format used by COPY if `use_copy` is True, either
+                         'csv' or 'binary'. Tables with column types not
+                         supported by the binary encoder fall back to
+                         'csv'.
+            copy_updates: Update changed instances by copying their changed
+                          columns into a staging table and applying them with
+                          one `UPDATE ... FROM` per model and set of changed
+                          columns if True.
+            unique_indices: Dictionary that matches model names to tuples
+                            of attribute names whose values are unique.
+                            Their index maps each key directly to a single
+                            instance.
+                            Example: {'Model': (('attribute', ), )}
+            indices: Dictionary that matches model names to tuples of
+                     attribute names to index. Declared indices (including
+                     `unique_indices`) are built together in a single pass
+                     while preloading instead of on first use.
+                     Example: {'Model': (('attribute', 'other'), )}
+            load_on_miss: Do not preload models, but load instances matching
+                          keys of declared indices (`indices` and
+                          `unique_indices`) from the database when they are
+                          looked up for the first time.
+            load_batch_size: Maximum number of keys loaded per query if
+                             `load_on_miss` is True.
+            flush_workers: Number of connections used to COPY new instances
+                           of independent models concurrently if `use_copy`
+                           is True and `save_order` is None. Every level of
+                           models is committed before the next one.
+            sequence_block_size: Reserve values of `sequences` in blocks of
+                                 at least this size and assign them in
+                                 `create()` instead of on flushing, so
+                                 primary and foreign keys of new instances
+                                 are known right away.
+            snapshot_dir: Directory in which the preloaded data and declared
+                          indices of each model are stored in a snapshot
+                          file, used instead of the database on the next
+                          preload as long as the table is unchanged.
+                          Models preloaded with `preload_models_data` or
+                          `prefetch` are not snapshotted, neither are
+                          models with values of types other than numbers,
+                          strings, bytes, dates, times and UUIDs.
+            snapshot_versions: Dictionary that matches model names to a
+                               version column attribute (e.g. a timestamp
+                               of the last change) which is used to detect
+                               changes instead of PostgreSQL's `xmin` by
+                               snapshots and `refresh()`.
+                               Example: {'Model': 'updated'}
+            profile_memory: Trace memory allocations using `tracemalloc`
+                            and attribute them to the preload, instances
+                            and indices of each model and to COPY buffers,
+                            see `memory_profile()`. Slows down allocations,
+                            so use it to size batches, not in production.
+                            Tracing started by the cache is stopped by
+                            `close()` or when the cache is garbage
+                            collected.
+            auto_flush_count: Write new and modified instances to the
+                              database as soon as this many instances were
+                              created since the last flush. Preloaded data
+                              and indices are kept, while written instances
+                              are replaced by read-only records (named
+                              tuples of their column values), which are
+                              returned by later lookups. Instances returned
+                              before must not be changed afterwards and
+                              relationships to them must be set using their
+                              foreign key attributes.
+            auto_flush_memory: Flush like `auto_flush_count` as soon as the
+                               memory traced by `tracemalloc` grew by this
+                               number of bytes since the last flush, not
+                               counting preloaded data. Implies
+                               `profile_memory`, so allocations are slowed
+                               down while the cache exists. For long
+                               running jobs, prefer an `auto_flush_count`
+                               sized using a profiled trial run.
+            read_only_models: Iterable of model names which are preloaded
+                              as read-only records (named tuples of their
+                              column values) instead of model instances,
+                              saving the memory of ORM bookkeeping. Use
+                              `materialize()` to get an instance for a
+                              record to change it.
+            columnar_models: Dictionary that matches model names to tuples
+                             of attribute names which are preloaded into
+                             NumPy arrays (requires the `numpy` extra).
+                             Lookups use binary searches on sorted key
+                             arrays and return read-only records of these
+                             attributes. Key columns must not contain NULL
+                             values.
+                             Example: {'Model': ('id', 'attribute')}
+            upsert_models: Dictionary that matches model names to a tuple
+                           of attribute names with a unique constraint
+                           (the primary key if empty). New instances of
+                           these models are copied into a temporary staging
+                           table and merged with a single
+                           `INSERT ... SELECT ... ON CONFLICT` instead of
+                           failing on existing keys. Of several new
+                           instances with the same key the last one wins.
+                           Example: {'Model': ('attribute', )}
+            upsert_update: Overwrite the other columns of existing rows
+                           with the values of new instances of
+                           `upsert_models` if True, keep them otherwise.
+                           Primary keys are never overwritten.
+            upsert_returning: Set the primary key attributes of new
+                              instances of `upsert_models` to the ones of
+                              the rows they were merged into if True.
+            prefetch_strategy: How relationships listed in `prefetch` are
+                               loaded while preloading. 'joined' uses a
+                               `joinedload` on the preload query. 'stitch'
+                               preloads the related model into the cache
+                               as well and sets the relationships by
+                               matching foreign key values against its
+                               instances, falling back to a `selectinload`
+                               for relationships with a secondary table,
+                               an `order_by` or a join condition other
+                               than equal foreign keys, or whose related
+                               model is not fully preloaded as instances.
+            checkpoint_size: Insert new instances in chunks of this size,
+                             committing each chunk together with the number
+                             of instances of its model written so far in the
+                             `modelcache_checkpoint` table. If a flush
+                             fails, the next flush with the same
+                             `checkpoint_name` skips the committed chunks,
+                             so it expects the same new instances in the
+                             same order, created again instead of found in
+                             the committed rows. Their primary keys must
+                             not be drawn from `sequences`. The progress is
+                             removed once a flush succeeded. Flushes do not
+                             use parallel COPY if set.
+            checkpoint_name: Name under which the progress of checkpointed
+                             flushes is recorded, needed to resume several
+                             imports independently.
+            strict_transaction: Never commit while flushing, neither after
+                                each table nor at the end, so all changes
+                                are committed or rolled back together with
+                                the session's transaction. Flushes do not
+                                use parallel COPY if True. Cannot be
+                                combined with `checkpoint_size`.
         """
+        if checkpoint_size is not None and strict_transaction:
+            raise ValueError(
+                'checkpoint_size cannot be combined with strict_transaction.'
+            )
         self._save_order = save_order
         self._sequences = sequences
         self.session = session
         self._engine_name = engine_name
         self._prefetch = prefetch
+        self._prefetch_strategy = prefetch_strategy
         self._preload_models = preload_models
         self._preload_models_data = preload_models_data
         self._preload_models_filter = preload_models_filter
         self._logger = logger
         self._use_copy = use_copy
+        self._preload_batch_size = preload_batch_size
+        self._copy_format = copy_format
+        self._copy_updates = copy_updates
+        self._upsert_models = {
+            model_key: tuple(attributes)
+            for model_key, attributes in upsert_models.items()
+        }
+        self._upsert_update = upsert_update
+        self._upsert_returning = upsert_returning
+        self._checkpoint_size = checkpoint_size
+        self._checkpoint_name = checkpoint_name
+        self._strict_transaction = strict_transaction
+        self._unique_indices = {
+            model_key: {tuple(sorted(attributes)) for attributes in declared}
+            for model_key, declared in unique_indices.items()
+        }
+        self._declared_indices = {
+            model_key: {tuple(sorted(attributes)) for attributes in declared}
+            for model_key, declared in indices.items()
+        }
         self._cached_instances = {}
         self._indices = {}
+        # Insertion-ordered sets (dicts with None values) of instances
+        # created or modified since the last flush, keyed by model name.
+        self._new_instances = {}
+        self._dirty_instances = {}
+        # Instances owned by the cache by model name. Only their changes
+        # are tracked.
+        self._owned_instances = {}
+        # Attributes with a registered change handler by model name.
+        self._change_listeners = {}
+        self._load_on_miss = load_on_miss
+        self._load_batch_size = load_batch_size
+        self._flush_workers = flush_workers
+        # Model classes by model name.
+        self._models = {}
+        self._sequence_block_size = sequence_block_size
+        # Reserved but unassigned values by sequence name.
+        self._sequence_pools = collections.defaultdict(collections.deque)
+        self._snapshot_dir = snapshot_dir
+        self._snapshot_versions = snapshot_versions
+        # Change marks of preloaded models by model name, see `refresh()`.
+        self._change_marks = {}
+        self.reset_stats()
+        self._profile_memory = profile_memory or auto_flush_memory is not None
+        self._auto_flush_count = auto_flush_count
+        self._auto_flush_memory = auto_flush_memory
+        # Number of instances created since the last flush.
+        self._created_count = 0
+        self._read_only_models = set(read_only_models)
+        # Read-only record classes by model name and vice versa.
+        self._record_classes = {}
+        self._record_models = {}
+        # Pending replacements of entries of the instance list by model
+        # name, see `_replace_in_cache()`. Deleted entries are replaced by
+        # None.
+        self._replacements = {}
+        # Insertion-ordered sets of primary keys of deleted rows by model
+        # name.
+        self._deleted_keys = {}
+        self._columnar_models = {
+            model_key: tuple(attributes)
+            for model_key, attributes in columnar_models.items()
+        }
+        self._columnar_tables = {}
+        # Sorted and interval indices by model name and a tuple of the kind
+        # of index, its attributes and the attributes of equality filters.
+        # New instances are inserted, while they are dropped on other changes
+        # and rebuilt on the next lookup.
+        self._sorted_indices = {}
+        self._memory = {'models': {}, 'copy': 0, 'cycles': []}
+        # Peak of the current `save_changes` cycle before the last reset of
+        # tracemalloc's peak.
+        self._cycle_peak = 0
+        # Stops tracing started by this cache, see `close()`.
+        self._stop_tracing = None
+        if self._profile_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._stop_tracing = weakref.finalize(self, tracemalloc.stop)
+        # Traced memory after the last flush, see `auto_flush_memory`.
+        self._flush_memory_base = self._traced_memory()
+        # Keys already looked up in the database per model name and index
+        # and the identities of the instances loaded that way, if
+        # `load_on_miss` is True.
+        self._loaded_keys = {}
+        self._loaded_instances = {}
 
         if check_memory_usage:
             from guppy import hpy
@@ -121,6 +428,195 @@ class ModelCache:
         size = self._sizeof_fmt(bsize)
         self._log('info', f'Memory usage: {size} ({bsize})')
 
+    def stats(self):
+        """
+        Return the statistics collected since setup or the last call of
+        `reset_stats()`.
+
+        Returns:
+            A dictionary like::
+
+                {
+                    'models': {
+                        'Model': {
+                            'preload': {'rows': 10, 'seconds': 0.1},
+                            'indices': {
+                                'attribute,other': {'keys': 8, 'seconds': 0.01},
+                            },
+                            'hits': 5,
+                            'misses': 1,
+                            'created': 2,
+                            'updated': 1,
+                            'deleted': 1,
+                        },
+                    },
+                    'phases': {
+                        'sequences': 0.01,
+                        'relationships': 0.0,
+                        'copy': 0.2,
+                        'bulk_save': 0.0,
+                    },
+                }
+
+            Preload and index build times add up if a model is loaded again
+            after clearing the cache, the number of index keys is the one of
+            the last build.
+        """  # noqa: E501
+        return copy.deepcopy(self._stats)
+
+    def reset_stats(self):
+        """Reset the statistics returned by `stats()`."""
+        self._stats = {
+            'models': {},
+            'phases': dict.fromkeys(
+                ('sequences', 'relationships', 'copy', 'bulk_save'), 0.0
+            ),
+        }
+
+    def log_stats(self, level='info'):
+        """Send the statistics returned by `stats()` to the logger."""
+        for model_key, model_stats in self._stats['models'].items():
+            preload = model_stats['preload']
+            self._log(
+                level,
+                f'{model_key}: preloaded {preload["rows"]} rows in '
+                f'{preload["seconds"]:.3f}s, {model_stats["hits"]} hits, '
+                f'{model_stats["misses"]} misses, '
+                f'{model_stats["created"]} created, '
+                f'{model_stats["updated"]} updated, '
+                f'{model_stats["deleted"]} deleted.',
+            )
+            for attribute_key, index_stats in model_stats['indices'].items():
+                self._log(
+                    level,
+                    f'{model_key}: index {attribute_key} with '
+                    f'{index_stats["keys"]} keys built in '
+                    f'{index_stats["seconds"]:.3f}s.',
+                )
+        phases = ', '.join(
+            f'{phase} {seconds:.3f}s'
+            for phase, seconds in self._stats['phases'].items()
+        )
+        self._log(level, f'Time spent flushing: {phases}.')
+
+    def _model_stats(self, model):
+        """Return the statistics of `model`, see `stats()`."""
+        model_key = self._model_key(model)
+        model_stats = self._stats['models'].get(model_key)
+        if model_stats is None:
+            model_stats = self._stats['models'][model_key] = {
+                'preload': {'rows': 0, 'seconds': 0.0},
+                'indices': {},
+                'hits': 0,
+                'misses': 0,
+                'created': 0,
+                'updated': 0,
+                'deleted': 0,
+            }
+        return model_stats
+
+    def _record_index_build(self, model, attribute_key, seconds):
+        """Add the build time of an index to the statistics."""
+        index_stats = self._model_stats(model)['indices'].setdefault(
+            ','.join(attribute_key), {'keys': 0, 'seconds': 0.0}
+        )
+        index_stats['keys'] = len(
+            self._get_model_indices(model)[attribute_key]
+        )
+        index_stats['seconds'] += seconds
+
+    @contextlib.contextmanager
+    def _timed(self, phase):
+        """Add the time spent in the `with` block to a flush phase."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._stats['phases'][phase] += time.perf_counter() - start
+
+    def memory_profile(self):
+        """
+        Return the memory attributed to parts of the cache if
+        `profile_memory` is True. Sizes are given in bytes as differences of
+        the memory traced before and after an operation, so memory freed
+        meanwhile (e.g. by the garbage collector) is subtracted.
+
+        Returns:
+            A dictionary like::
+
+                {
+                    'models': {
+                        'Model': {
+                            'preload': 2048,
+                            'instances': 1536,
+                            'indices': {'attribute,other': 512},
+                        },
+                    },
+                    'copy': 65536,
+                    'cycles': [{'peak': 4096, 'current': 1024}],
+                }
+
+            `preload` is the memory allocated while preloading a model,
+            including the instances and the declared indices built on the
+            way. `copy` is the highest peak of a single COPY. `cycles` holds
+            the peak of traced memory from the previous `save_changes()` to
+            the end of each `save_changes()` and the memory still traced
+            after it.
+        """
+        return copy.deepcopy(self._memory)
+
+    def _traced_memory(self):
+        """Return the memory traced by tracemalloc if profiling."""
+        if not self._profile_memory:
+            return 0
+        return tracemalloc.get_traced_memory()[0]
+
+    def _model_memory(self, model):
+        """Return the memory profile of `model`, see `memory_profile()`."""
+        return self._memory['models'].setdefault(
+            self._model_key(model),
+            {'preload': 0, 'instances': 0, 'indices': {}},
+        )
+
+    def _record_index_memory(self, model, attribute_key, size):
+        """Add memory allocated for an index to the memory profile."""
+        indices = self._model_memory(model)['indices']
+        key = ','.join(attribute_key)
+        indices[key] = indices.get(key, 0) + size
+
+    @contextlib.contextmanager
+    def _copy_memory(self):
+        """Record the peak of memory traced in the `with` block."""
+        if not self._profile_memory:
+            yield
+            return
+        start, peak = tracemalloc.get_traced_memory()
+        self._cycle_peak = max(self._cycle_peak, peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        try:
+            yield
+        finally:
+            peak = tracemalloc.get_traced_memory()[1]
+            self._memory['copy'] = max(self._memory['copy'], peak - start)
+
+    def _record_memory_cycle(self):
+        """Record the peak of traced memory since the last cycle."""
+        if not self._profile_memory:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        cycle = {'peak': max(self._cycle_peak, peak), 'current': current}
+        self._memory['cycles'].append(cycle)
+        self._flush_memory_base = current
+        self._cycle_peak = 0
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        self._log(
+            'debug',
+            f'Memory peak: {self._sizeof_fmt(cycle["peak"])}, '
+            f'after flushing: {self._sizeof_fmt(current)}.',
+        )
+
     def find(self, model, **kwargs):
         """
         Find `model` instances with matching `kwargs`.
@@ -128,9 +624,12 @@ class ModelCache:
         Returns:
             A list of matching `model` instances or an empty list.
         """
-        attribute_index = self._get_attribute_index(model, kwargs.keys())
-        instance_key = tuple(kwargs[attr] for attr in sorted(kwargs.keys()))
-        return attribute_index.get(instance_key, [])
+        result, unique = self._lookup(model, kwargs)
+        if result is None:
+            return []
+        if unique:
+            return [result]
+        return list(result)
 
     def get(self, model, **kwargs):
         """
@@ -142,12 +641,57 @@ class ModelCache:
         Raises:
             MultipleObjectsFoundException: Multiple objects were found.
         """
-        result = self.find(model, **kwargs)
-        if len(result) == 0:
-            return None
+        result, unique = self._lookup(model, kwargs)
+        if result is None or unique:
+            return result
         elif len(result) > 1:
             raise MultipleObjectsFoundException()
-        return result[0]
+        return next(iter(result))
+
+    def _lookup(self, model, kwargs):
+        """
+        Look up the index entry matching `kwargs`.
+
+        Returns:
+            A tuple of the entry (or None) and a flag whether the index is
+            unique. Entries of unique indices are single instances, others
+            are insertion-ordered sets of instances.
+        """
+        attribute_key = tuple(sorted(kwargs))
+        if self._model_key(model) in self._columnar_models:
+            [result], unique = self._lookup_many(
+                model,
+                attribute_key,
+                [tuple(kwargs[attr] for attr in attribute_key)],
+            )
+            return result, unique
+        attribute_index = self._get_attribute_index(model, attribute_key)
+        instance_key = tuple(kwargs[attr] for attr in attribute_key)
+        unique = self._is_unique(model, attribute_key)
+        result = attribute_index.get(instance_key)
+        if (
+            self._load_on_miss
+            and not (unique and result is not None)
+            and self._is_declared(model, attribute_key)
+        ):
+            self._load_keys(model, attribute_key, [instance_key])
+            result = attribute_index.get(instance_key)
+        found = result is not None and (unique or len(result) > 0)
+        self._model_stats(model)['hits' if found else 'misses'] += 1
+        return result, unique
+
+    def prefetch_keys(self, model, attributes, keys):
+        """
+        Load `model` instances matching `keys` from the database, if
+        `load_on_miss` is True, so later lookups of these keys are answered
+        from the cache. Already looked up keys are skipped.
+
+        Args:
+            attributes: Tuple of attribute names of a declared index.
+            keys: Iterable of value tuples in the order of `attributes`.
+        """
+        if self._load_on_miss:
+            self._lookup_many(model, attributes, keys)
 
     def create(self, model, **kwargs):
         """
@@ -156,19 +700,122 @@ class ModelCache:
         Returns:
             The newly created `model` instance.
         """
+        return self._create_many(model, [kwargs])[0]
+
+    def _create_many(self, model, kwargs_list):
+        """Create a `model` instance per dictionary of attributes."""
+        if self._model_key(model) in self._columnar_models:
+            raise ValueError(
+                f'{self._model_key(model)} is loaded as read-only columns.'
+            )
         model_cache = self._get_model_cache(model)
-        model_indices = self._get_model_indices(model)
 
-        instance = model(**kwargs)
-        model_cache.append(instance)
+        if self._record_models:
+            kwargs_list = [
+                {key: self.materialize(value) for key, value in kwargs.items()}
+                for kwargs in kwargs_list
+            ]
+        memory = self._traced_memory()
+        instances = [model(**kwargs) for kwargs in kwargs_list]
+        if self._profile_memory:
+            self._model_memory(model)['instances'] += (
+                self._traced_memory() - memory
+            )
+        if self._sequence_block_size is not None:
+            self._assign_reserved_sequences(model, instances)
+            self._sync_instance_relationships(model, instances)
+        try:
+            self._check_unique(model, instances)
+        except DuplicateKeyException:
+            for instance in instances:
+                # Related instances may have cascaded it into a session.
+                session = sqlalchemy.orm.object_session(instance)
+                if session is not None:
+                    session.expunge(instance)
+            raise
+        model_cache.extend(instances)
+        self._own(model, instances)
+        self._model_stats(model)['created'] += len(instances)
+        self._new_instances.setdefault(self._model_key(model), {}).update(
+            dict.fromkeys(instances)
+        )
+        self._index_instances(model, instances)
+        self._created_count += len(instances)
+
+        if (
+            self._auto_flush_count is not None
+            and self._created_count >= self._auto_flush_count
+        ) or (
+            self._auto_flush_memory is not None
+            and self._traced_memory() - self._flush_memory_base
+            >= self._auto_flush_memory
+        ):
+            self._auto_flush()
+
+        return instances
+
+    def delete(self, instance):
+        """
+        Remove an instance or read-only record from the cache and delete
+        its row on the next `save_changes()`.
+
+        Rows of all deleted instances of a model are deleted with a single
+        `DELETE ... USING` a temporary table of their primary keys, in
+        reverse save order after new and modified instances were saved, so
+        rows can be moved to another parent before deleting it. If new
+        instances reuse the primary key of a deleted row, the rows of their
+        model and of all models saved after it are deleted before saving
+        instead. Instances created since the last flush are just discarded.
+        """
+        model_key = self._record_models.get(type(instance))
+        if model_key is None:
+            model = type(instance)
+            model_key = self._model_key(model)
+            state = attributes.instance_state(instance)
+            persistent = state.key is not None
+        else:
+            model = self._models[model_key]
+            state, persistent = None, True
+        if model_key in self._columnar_models:
+            raise ValueError(f'{model_key} is loaded as read-only columns.')
+        self._models.setdefault(model_key, model)
+
+        for attribute_key, attribute_index in self._get_model_indices(
+            model
+        ).items():
+            self._remove_from_index(
+                attribute_index,
+                self._object_instance_key(instance, attribute_key),
+                instance,
+                self._is_unique(model, attribute_key),
+            )
+        self._drop_sorted_indices(model)
+        self._replacements.setdefault(model_key, {})[instance] = None
+        self._owned_instances.get(model_key, set()).discard(instance)
+        self._new_instances.get(model_key, {}).pop(instance, None)
+        self._dirty_instances.get(model_key, {}).pop(instance, None)
+
+        if persistent:
+            mapper = inspect(model)
+            key = tuple(
+                getattr(instance, mapper.get_property_by_column(column).key)
+                for column in mapper.primary_key
+            )
+            self._deleted_keys.setdefault(model_key, {})[key] = None
+        if state is not None and state.session_id is not None:
+            sqlalchemy.orm.object_session(instance).expunge(instance)
 
-        for attribute_key in model_indices.keys():
-            instance_key = self._object_instance_key(instance, attribute_key)
-            cache = model_indices[attribute_key].setdefault(instance_key, [])
-            if instance not in cache:
-                cache.append(instance)
+    def delete_where(self, model, **kwargs):
+        """
+        Delete every instance of `model` matching `kwargs`, see `delete()`.
 
-        return instance
+        Returns:
+            The number of deleted instances.
+        """
+        instances = self.find(model, **kwargs)
+        for instance in instances:
+            self.delete(instance)
+        return len(instances)
 
     def get_or_create(self, model, **kwargs):
         """
@@ -186,19 +833,429 @@ class ModelCache:
         else:
             return self.create(model, **kwargs)
 
-    def save_changes(self, session=None, cursor=None):
+    def find_many(self, model, attributes, keys):
+        """
+        Find `model` instances for many keys of the same attributes at once.
+
+        Args:
+            attributes: Tuple of attribute names.
+            keys: Iterable of value tuples in the order of `attributes`.
+
+        Returns:
+            A list containing a list of matching `model` instances per key.
+        """
+        entries, unique = self._lookup_many(model, attributes, keys)
+        if unique:
+            return [[] if entry is None else [entry] for entry in entries]
+        return [[] if entry is None else list(entry) for entry in entries]
+
+    def find_range(
+        self,
+        model,
+        attribute,
+        lower=None,
+        upper=None,
+        include_lower=True,
+        include_upper=True,
+        **kwargs,
+    ):
+        """
+        Find `model` instances whose `attribute` is between `lower` and
+        `upper` and which have matching `kwargs`.
+
+        A bound of None is open. Instances whose `attribute` is None never
+        match. Only cached instances are searched, even if `load_on_miss`
+        is True.
+
+        Returns:
+            A list of matching `model` instances ordered by `attribute`.
+        """
+        index = self._get_sorted_index(model, 'range', (attribute,), kwargs)
+        if index is None:
+            return []
+        return index.range(lower, upper, include_lower, include_upper)
+
+    def find_prefix(self, model, attribute, prefix, **kwargs):
+        """
+        Find `model` instances whose string `attribute` starts with `prefix`
+        and which have matching `kwargs`, see `find_range()`.
+        """
+        index = self._get_sorted_index(model, 'range', (attribute,), kwargs)
+        if index is None:
+            return []
+        return index.prefix(prefix)
+
+    def find_containing(self, model, left, right, point, **kwargs):
+        """
+        Find `model` instances whose interval from the attribute `left` to
+        the attribute `right` contains `point` and which have matching
+        `kwargs`.
+
+        Like `risclog.sqlalchemy.functions.in_interval`, both bounds are
+        inclusive and a `right` of None means the interval is open-ended,
+        while a `left` of None never matches. Only cached instances are
+        searched, even if `load_on_miss` is True.
+
+        Returns:
+            A list of matching `model` instances ordered by `left`.
+        """
+        index = self._get_sorted_index(
+            model, 'interval', (left, right), kwargs
+        )
+        if index is None:
+            return []
+        return index.containing(point)
+
+    def _get_sorted_index(self, model, kind, attributes, kwargs):
+        """
+        Return the sorted index of `kind` ('range' or 'interval') over
+        `attributes` for the instances matching `kwargs` or None if no
+        instance matches, building it on first use.
+        """
+        model_key = self._model_key(model)
+        if model_key in self._columnar_models:
+            raise ValueError(
+                f'{model_key} is loaded as columns, '
+                'use `find_positions()` instead.'
+            )
+        filter_key = tuple(sorted(kwargs))
+        model_indices = self._sorted_indices.setdefault(model_key, {})
+        index_key = (kind, attributes, filter_key)
+        if index_key not in model_indices:
+            model_cache = self._get_model_cache(model)
+            self._apply_replacements(model)
+            start = time.perf_counter()
+            groups = {}
+            for instance in model_cache:
+                values = tuple(getattr(instance, attr) for attr in attributes)
+                if values[0] is None:
+                    continue
+                groups.setdefault(
+                    self._object_instance_key(instance, filter_key), []
+                ).append(values + (instance,))
+            index_class = self._sorted_index_class(kind)
+            model_indices[index_key] = {
+                key: index_class(items) for key, items in groups.items()
+            }
+            self._register_change_handler(model, self._instance_change_handler)
+            self._log(
+                'debug',
+                f'Built {kind} index {attributes} of {model_key} for '
+                f'{filter_key} in {time.perf_counter() - start:.3f}s.',
+            )
+        return model_indices[index_key].get(
+            tuple(kwargs[attr] for attr in filter_key)
+        )
+
+    def _drop_sorted_indices(self, model, attribute=None):
+        """
+        Drop the sorted indices of `model` which use `attribute` or all if
+        `attribute` is None.
+        """
+        model_indices = self._sorted_indices.get(self._model_key(model))
+        if not model_indices:
+            return
+        if attribute is None:
+            model_indices.clear()
+            return
+        for index_key in list(model_indices):
+            _, attributes, filter_key = index_key
+            if attribute in attributes or attribute in filter_key:
+                del model_indices[index_key]
+
+    def _insert_into_sorted_indices(self, model, instances):
+        """
+        Add `instances` to the partition of every sorted index of `model`
+        matching their filter attributes.
+        """
+        model_indices = self._sorted_indices.get(self._model_key(model), {})
+        for index_key, partitions in model_indices.items():
+            kind, index_attributes, filter_key = index_key
+            for instance in instances:
+                values = tuple(
+                    getattr(instance, attr) for attr in index_attributes
+                )
+                if values[0] is None:
+                    continue
+                key = self._object_instance_key(instance, filter_key)
+                if key in partitions:
+                    partitions[key].insert(*values, instance)
+                else:
+                    partitions[key] = self._sorted_index_class(kind)(
+                        [values + (instance,)]
+                    )
+
+    def _sorted_index_class(self, kind):
+        """Return the class of sorted indices of `kind`."""
+        if kind == 'range':
+            return risclog.sqlalchemy.sortedindex.SortedIndex
+        return risclog.sqlalchemy.sortedindex.IntervalIndex
+
+    def get_or_create_many(self, model, attributes, keys):
+        """
+        Find or create a `model` instance for many keys of the same
+        attributes at once. Missing instances are created in bulk, once per
+        distinct key.
+
+        Args:
+            attributes: Tuple of attribute names.
+            keys: Iterable of value tuples in the order of `attributes`.
+
+        Returns:
+            A list containing a matching or newly created `model` instance
+            per key.
+
+        Raises:
+            MultipleObjectsFoundException: Multiple objects were found.
+        """
+        keys = [tuple(key) for key in keys]
+        entries, unique = self._lookup_many(model, attributes, keys)
+        missing = list(
+            dict.fromkeys(
+                key for key, entry in zip(keys, entries) if entry is None
+            )
+        )
+        created = dict(
+            zip(
+                missing,
+                self._create_many(
+                    model, [dict(zip(attributes, key)) for key in missing]
+                ),
+            )
+        )
+
+        result = []
+        for key, entry in zip(keys, entries):
+            if entry is None:
+                result.append(created[key])
+            elif unique:
+                result.append(entry)
+            elif len(entry) > 1:
+                raise MultipleObjectsFoundException()
+            else:
+                result.append(next(iter(entry)))
+        return result
+
+    def _lookup_many(self, model, attributes, keys):
+        """
+        Look up the index entries matching `keys` of `attributes`, loading
+        all missing keys at once if `load_on_miss` is True.
+
+        Returns:
+            A tuple of a list of entries (see `_lookup()`) and a flag whether
+            the index is unique.
+        """
+        attribute_key = tuple(sorted(attributes))
+        if attribute_key != tuple(attributes):
+            order = [attributes.index(attr) for attr in attribute_key]
+            keys = [tuple(key[i] for i in order) for key in keys]
+        else:
+            keys = [tuple(key) for key in keys]
+        if self._model_key(model) in self._columnar_models:
+            return self._lookup_columnar(model, attribute_key, keys), False
+        attribute_index = self._get_attribute_index(model, attribute_key)
+        unique = self._is_unique(model, attribute_key)
+
+        if self._load_on_miss and self._is_declared(model, attribute_key):
+            self._load_keys(
+                model,
+                attribute_key,
+                [
+                    key
+                    for key in keys
+                    if not (unique and key in attribute_index)
+                ],
+            )
+
+        get = attribute_index.get
+        entries = [get(key) for key in keys]
+        hits = sum(
+            1
+            for entry in entries
+            if entry is not None and (unique or len(entry) > 0)
+        )
+        model_stats = self._model_stats(model)
+        model_stats['hits'] += hits
+        model_stats['misses'] += len(entries) - hits
+        return entries, unique
+
+    def find_positions(self, model, attributes, keys):
+        """
+        Find the row positions of a model of `columnar_models` for many keys
+        of the same attributes at once.
+
+        Args:
+            attributes: Tuple of attribute names.
+            keys: Iterable of value tuples in the order of `attributes`.
+
+        Returns:
+            A list containing a NumPy array of row positions per key, see
+            `columnar_records()` and `columnar_instances()`.
+        """
+        attribute_key = tuple(sorted(attributes))
+        order = [attributes.index(attr) for attr in attribute_key]
+        keys = [tuple(key[i] for i in order) for key in keys]
+        table = self._get_columnar_table(model)
+        missing = set(attribute_key) - set(table.columns)
+        if missing:
+            raise ValueError(
+                f'Attributes {sorted(missing)} of {self._model_key(model)} '
+                'are not loaded as columns.'
+            )
+        return table.find_positions(attribute_key, keys)
+
+    def columnar_records(self, model, positions):
+        """
+        Return read-only records of the columns of a model of
+        `columnar_models` at the row `positions`.
+        """
+        return self._get_columnar_table(model).records(
+            self._columnar_record_class(model), positions
+        )
+
+    def columnar_instances(self, model, positions):
+        """
+        Load the `model` instances of the rows at `positions` of a model of
+        `columnar_models` from the database by their primary keys, which
+        must be among the loaded columns.
+
+        Returns:
+            A list of `model` instances in the order of `positions`.
+        """
+        mapper = inspect(model)
+        pk_attributes = tuple(
+            mapper.get_property_by_column(column).key
+            for column in mapper.primary_key
+        )
+        table = self._get_columnar_table(model)
+        identities = list(
+            zip(
+                *[
+                    table.columns[attr][positions].tolist()
+                    for attr in pk_attributes
+                ]
+            )
+        )
+        columns = [getattr(model, attr) for attr in pk_attributes]
+        instances = {}
+        for batch in _batches(identities, self._load_batch_size):
+            for instance in model.query().filter(
+                self._keys_condition(columns, batch)
+            ):
+                instances[
+                    attributes.instance_state(instance).identity
+                ] = instance
+        return [instances[identity] for identity in identities]
+
+    def _lookup_columnar(self, model, attribute_key, keys):
+        """
+        Look up the records matching `keys` of `attribute_key` of a model of
+        `columnar_models`.
+
+        Returns:
+            A list of entries (see `_lookup()`).
+        """
+        table = self._get_columnar_table(model)
+        record_class = self._columnar_record_class(model)
+        entries = [
+            table.records(record_class, positions) or None
+            for positions in self.find_positions(model, attribute_key, keys)
+        ]
+        hits = sum(1 for entry in entries if entry is not None)
+        model_stats = self._model_stats(model)
+        model_stats['hits'] += hits
+        model_stats['misses'] += len(entries) - hits
+        return entries
+
+    def _get_columnar_table(self, model):
+        """
+        Return the `ColumnarTable` of a model of `columnar_models`, loading
+        it on first use.
+        """
+        model_key = self._model_key(model)
+        if model_key not in self._columnar_tables:
+            import risclog.sqlalchemy.columnar
+
+            start = time.perf_counter()
+            attributes = self._columnar_models[model_key]
+            query = self._column_query(model, attributes)
+            if self._preload_batch_size is None:
+                batches = [query.all()]
+            else:
+                batches = _batches(
+                    query.yield_per(
+                        self._preload_batch_size
+                    ).execution_options(stream_results=True),
+                    self._preload_batch_size,
+                )
+            table = risclog.sqlalchemy.columnar.ColumnarTable.from_batches(
+                attributes, batches
+            )
+            self._columnar_tables[model_key] = table
+
+            preload_stats = self._model_stats(model)['preload']
+            preload_stats['rows'] += len(table)
+            preload_stats['seconds'] += time.perf_counter() - start
+            self._log(
+                'debug',
+                f'Loaded {len(table)} rows of {model_key} into '
+                f'{self._sizeof_fmt(table.nbytes)} of columns.',
+            )
+        return self._columnar_tables[model_key]
+
+    def _columnar_record_class(self, model):
+        """
+        Return a named tuple class for records of the columns of a model of
+        `columnar_models`, which are compared by identity.
+        """
+        model_key = self._model_key(model)
+        if model_key not in self._record_classes:
+            self._record_classes[model_key] = _record_type(
+                f'{model.__name__}Columns', self._columnar_models[model_key]
+            )
+        return self._record_classes[model_key]
+
+    def save_changes(
+        self, session=None, cursor=None, plan=None, after_level=None
+    ):
         """
         Flush modified and created object to the database before clearing the
         cache.
 
         Args:
             session: A SQLAlchemy session to use instead of the default one.
+            plan: List of levels (lists of model names) to save in this
+                  order instead of the one derived from `save_order` or
+                  foreign keys.
+            after_level: Callable called with each level of `plan` after it
+                         was written and committed.
+
+        Raises:
+            ValueError: If `after_level` is given with `strict_transaction`.
         """
+        if after_level is not None and self._strict_transaction:
+            raise ValueError(
+                'after_level requires commits, which strict_transaction '
+                'forbids.'
+            )
         self.log_memory_usage()
+        self._flush_changes(session, cursor, plan, after_level)
+        self.clear(session)
+        self._log('info', 'Flushed model cache.')
+        self.log_stats('debug')
+        self._record_memory_cycle()
 
+    def _flush_changes(
+        self, session=None, cursor=None, plan=None, after_level=None
+    ):
+        """Write new and modified instances to the database."""
         if session is None:
             session = self.session
-        if cursor is None and self._use_copy:
+        if cursor is None and (
+            self._uses_cursor()
+            or after_level is not None
+            or self._deleted_keys
+        ):
             cursor = (
                 self.session.using_bind(self._engine_name)
                 .connection()
@@ -206,42 +1263,314 @@ class ModelCache:
             )
 
         self._log('debug', 'Flushing model cache.')
-        self._assign_sequences()
-        self._sync_relationship_attrs()
+        self._collect_dirty_instances()
+        with self._timed('sequences'):
+            self._assign_sequences()
+        with self._timed('relationships'):
+            self._sync_relationship_attrs()
+
+        if plan is None:
+            plan = self.save_plan()
+        deletes = self._delete_order(plan)
+        # Rows whose keys are reused by new instances must be deleted
+        # before writing, together with the rows of models saved after them.
+        reused = [
+            position
+            for position, model_name in enumerate(deletes)
+            if self._reuses_deleted_keys(model_name)
+        ]
+        early = reused[-1] + 1 if reused else 0
+        self._delete_rows(cursor, deletes[:early])
+        if self._checkpoint_size is not None:
+            cursor.execute(
+                f'CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} '
+                '(name text, model text, rows bigint NOT NULL, '
+                'PRIMARY KEY (name, model))'
+            )
+        for level in plan:
+            copied = set()
+            if (
+                self._use_copy
+                and self._flush_workers > 1
+                and self._save_order is None
+                and len(level) > 1
+                and self._checkpoint_size is None
+                and not self._strict_transaction
+            ):
+                # Make previous levels visible to the other connections.
+                cursor.connection.commit()
+                with self._timed('copy'), self._copy_memory():
+                    copied = self._save_by_parallel_copy(level)
+
+            for model_name in level:
+                new_objects = self._filter_sa_result_objects(
+                    self._new_instances.get(model_name, ())
+                )
+                updated_objects = self._filter_sa_result_objects(
+                    self._dirty_instances.get(model_name, ())
+                )
+                if len(new_objects) == 0 and len(updated_objects) == 0:
+                    continue
 
-        for model_name in self._save_order:
-            if model_name not in self._cached_instances:
-                continue
-            objects = self._cached_instances[model_name]
-            objects = self._filter_sa_result_objects(objects)
-            if len(objects) == 0:
-                continue
+                model = type((new_objects or updated_objects)[0])
+                self._deregister_change_handler(
+                    model, self._instance_change_handler
+                )
+                self._model_stats(model)['updated'] += len(updated_objects)
 
-            self._deregister_change_handler(
-                type(objects[0]), self._instance_change_handler
+                if model_name in copied:
+                    pass
+                elif self._checkpoint_size is not None:
+                    self._save_checkpointed(
+                        session, cursor, model_name, new_objects
+                    )
+                else:
+                    self._save_new(
+                        session,
+                        cursor,
+                        model_name,
+                        new_objects,
+                        commit=not self._strict_transaction,
+                    )
+                if self._copy_updates:
+                    with self._timed('copy'), self._copy_memory():
+                        updated_objects = self._update_by_copy(
+                            cursor, updated_objects
+                        )
+                with self._timed('bulk_save'):
+                    session.bulk_save_objects(updated_objects)
+                    session.flush()
+
+            if after_level is not None:
+                cursor.connection.commit()
+                after_level(level)
+
+        self._delete_rows(cursor, deletes[early:])
+        if self._checkpoint_size is not None:
+            cursor.execute(
+                f'DELETE FROM {CHECKPOINT_TABLE} WHERE name = %s',
+                (self._checkpoint_name,),
+            )
+        if self._uses_cursor() and not self._strict_transaction:
+            cursor.connection.commit()
+
+    def _delete_order(self, plan):
+        """
+        Return the names of the models with deleted rows in the order their
+        rows are deleted: models missing in `plan` first, then the others
+        in reverse `plan` order.
+        """
+        planned = [model_name for level in plan for model_name in level]
+        unplanned = sorted(set(self._deleted_keys).difference(planned))
+        return [
+            model_name
+            for model_name in unplanned + planned[::-1]
+            if self._deleted_keys.get(model_name)
+        ]
+
+    def _reuses_deleted_keys(self, model_name):
+        """
+        Return whether new instances of a model have the primary key of a
+        deleted row.
+        """
+        deleted = self._deleted_keys[model_name]
+        mapper = inspect(self._models[model_name])
+        attrs = [
+            mapper.get_property_by_column(column).key
+            for column in mapper.primary_key
+        ]
+        return any(
+            tuple(getattr(instance, attr) for attr in attrs) in deleted
+            for instance in self._filter_sa_result_objects(
+                self._new_instances.get(model_name, ())
             )
-            new_objects, updated_objects = [], []
+        )
+
+    def _delete_rows(self, cursor, model_names):
+        """Delete the rows of deleted instances of `model_names`."""
+        with self._timed('copy'), self._copy_memory():
+            for model_name in model_names:
+                keys = self._deleted_keys.pop(model_name)
+                self._delete_by_copy(
+                    cursor, self._models[model_name], list(keys)
+                )
 
-            for object in objects:
-                if attributes.instance_state(object).key is None:
-                    new_objects.append(object)
-                else:
-                    updated_objects.append(object)
+    def _uses_cursor(self):
+        """Return whether flushing writes using a raw Psycopg2 cursor."""
+        return bool(
+            self._use_copy
+            or self._copy_updates
+            or self._upsert_models
+            or self._checkpoint_size is not None
+        )
 
-            if self._use_copy:
-                self._save_by_copy(cursor, new_objects)
-            else:
-                session.bulk_save_objects(new_objects)
-            session.bulk_save_objects(updated_objects)
-            session.flush()
+    def _save_new(self, session, cursor, model_name, objects, commit=True):
+        """
+        Insert new instances of a single model.
+
+        Args:
+            commit: Commit the cursor's connection after each table if
+                    `use_copy` is True.
+        """
+        if model_name in self._upsert_models:
+            with self._timed('copy'), self._copy_memory():
+                self._upsert_by_copy(cursor, objects)
+        elif self._use_copy:
+            with self._timed('copy'), self._copy_memory():
+                self._save_by_copy(cursor, objects, commit=commit)
+        else:
+            with self._timed('bulk_save'):
+                session.bulk_save_objects(objects)
 
-        if self._use_copy:
+    def _save_checkpointed(self, session, cursor, model_name, objects):
+        """
+        Insert new instances of a single model in chunks of
+        `checkpoint_size`, committing each chunk together with the number of
+        instances written so far. Skips the instances committed by a
+        previous flush with the same `checkpoint_name`.
+        """
+        cursor.execute(
+            f'SELECT rows FROM {CHECKPOINT_TABLE} '
+            'WHERE name = %s AND model = %s',
+            (self._checkpoint_name, model_name),
+        )
+        row = cursor.fetchone()
+        written = row[0] if row else 0
+        if written:
+            self._log(
+                'info',
+                f'Resuming {model_name} after {written} committed '
+                'instances.',
+            )
+        for chunk in _batches(
+            itertools.islice(objects, written, None), self._checkpoint_size
+        ):
+            self._save_new(session, cursor, model_name, chunk, commit=False)
+            session.flush()
+            written += len(chunk)
+            cursor.execute(
+                f'INSERT INTO {CHECKPOINT_TABLE} (name, model, rows) '
+                'VALUES (%s, %s, %s) ON CONFLICT (name, model) '
+                'DO UPDATE SET rows = EXCLUDED.rows',
+                (self._checkpoint_name, model_name, written),
+            )
             cursor.connection.commit()
 
-        self.clear(session)
-        self._log('info', 'Flushed model cache.')
+    def save_plan(self, models=None):
+        """
+        Return the order in which models are saved as a list of levels,
+        each a list of model names.
 
-    def _save_by_copy(self, cursor, objects):
+        If `save_order` is set, every listed model forms its own level.
+        Otherwise, models with pending changes are sorted topologically by
+        the foreign keys between their tables: models of one level only
+        depend on models of previous levels. Models in dependency cycles are
+        appended one by one.
+
+        Args:
+            models: Dictionary mapping the names of the models to sort to
+                    their classes, defaults to the models with pending
+                    changes.
+        """
+        if self._save_order is not None:
+            return [[model_name] for model_name in self._save_order]
+
+        if models is None:
+            models = self._pending_models()
+        pending = set(models)
+        table_owners = {}
+        for model_name in pending:
+            for table in inspect(models[model_name]).tables:
+                table_owners.setdefault(table, set()).add(model_name)
+        dependencies = {
+            model_name: {
+                owner
+                for table in inspect(models[model_name]).tables
+                for foreign_key in table.foreign_keys
+                for owner in table_owners.get(foreign_key.column.table, ())
+                if owner != model_name
+            }
+            for model_name in pending
+        }
+
+        levels = []
+        while dependencies:
+            level = sorted(
+                model_name
+                for model_name, depends_on in dependencies.items()
+                if not depends_on
+            )
+            if not level:
+                cycle = sorted(dependencies)
+                self._log(
+                    'warning',
+                    f'Cannot sort models {cycle} by foreign keys, '
+                    'saving them in name order.',
+                )
+                levels.extend([model_name] for model_name in cycle)
+                break
+            levels.append(level)
+            for model_name in level:
+                del dependencies[model_name]
+            for depends_on in dependencies.values():
+                depends_on.difference_update(level)
+        return levels
+
+    def _save_by_parallel_copy(self, model_names):
+        """
+        Insert the new instances of several independent models concurrently
+        by using PostgreSQL's COPY command on a separate connection per
+        model. The connections are committed together after all of them
+        succeeded and rolled back otherwise.
+
+        Returns:
+            The set of model names whose new instances were saved.
+        """
+        batches = {
+            model_name: self._filter_sa_result_objects(
+                self._new_instances.get(model_name, ())
+            )
+            for model_name in model_names
+        }
+        batches = {
+            name: objects
+            for name, objects in batches.items()
+            if objects and name not in self._upsert_models
+        }
+        db_util = zope.component.getUtility(
+            risclog.sqlalchemy.interfaces.IDatabase
+        )
+        engine = db_util.get_engine(self._engine_name)
+        connections = []
+
+        def copy(objects):
+            connection = engine.raw_connection()
+            connections.append(connection)
+            self._save_by_copy(connection.cursor(), objects, commit=False)
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self._flush_workers
+            ) as executor:
+                for future in [
+                    executor.submit(copy, objects)
+                    for objects in batches.values()
+                ]:
+                    future.result()
+        except Exception:
+            for connection in connections:
+                connection.rollback()
+            raise
+        else:
+            for connection in connections:
+                connection.commit()
+        finally:
+            for connection in connections:
+                connection.close()
+        self._log('debug', f'Copied {sorted(batches)} in parallel.')
+        return set(batches)
+
+    def _save_by_copy(self, cursor, objects, commit=True):
         """
         Insert objects by using PostgreSQL's COPY command. This is
         database-specific but one of the most efficient ways to populate a
@@ -251,11 +1580,32 @@ class ModelCache:
         Args:
             cursor: A Psycopg2 cursor
             objects: SQLAlchemy ORM instances to save
+            commit: Commit the cursor's connection after each table.
         """
         if len(objects) == 0:
             return
 
         model = inspect(objects[0]).mapper
+        if self._copy_format == 'binary' and len(model.tables) == 1:
+            table = model.tables[0]
+            columns = [
+                (model.get_property_by_column(column).key, column)
+                for column in table.columns
+            ]
+            if self._binary_encoders([c.type for _, c in columns]):
+                self._copy_into(
+                    cursor,
+                    table,
+                    [(column.name, column.type) for _, column in columns],
+                    self._copy_values(objects, columns),
+                )
+                if commit:
+                    cursor.connection.commit()
+                return
+            self._log(
+                'debug', f'Falling back to CSV COPY for unsupported {table}.'
+            )
+
         for table in model.tables:
             file = io.StringIO()
             writer = csv.DictWriter(file, table.columns.keys())
@@ -289,50 +1639,1467 @@ class ModelCache:
                 "FROM STDIN WITH CSV DELIMITER ',' NULL '\\N'",
                 file,
             )
-            cursor.connection.commit()
-
-    def clear(self, session=None):
-        """Clear the cache. Will result in data loss of unflushed objects."""
-        self._cached_instances.clear()
-        self._indices.clear()
-        gc.collect()
-        self.log_memory_usage()
+            if commit:
+                cursor.connection.commit()
 
-    def _get_model_cache(self, model):
+    def _upsert_by_copy(self, cursor, objects):
         """
-        Return a list of every existing and newly created instance of `model`.
+        Insert or merge objects by copying them into a temporary staging
+        table and applying them with a single
+        `INSERT ... SELECT ... ON CONFLICT` on the conflict target declared
+        in `upsert_models`. Expects instances of one single model per call.
+
+        Args:
+            cursor: A Psycopg2 cursor
+            objects: SQLAlchemy ORM instances to save
         """
-        model_key = self._model_key(model)
+        if len(objects) == 0:
+            return
 
-        if model_key not in self._cached_instances:
-            # Initialize model cache if it doesn't exist yet.
-            if model_key in self._preload_models_data:
-                query = model.query(*self._preload_models_data[model_key])
-            else:
-                query = model.query()
+        model = inspect(objects[0]).mapper
+        if len(model.tables) != 1:
+            self._log(
+                'debug',
+                f'Falling back to COPY for {model.class_.__name__} '
+                'spanning multiple tables.',
+            )
+            self._save_by_copy(cursor, objects, commit=False)
+            return
+        table = model.tables[0]
+        columns = [
+            (model.get_property_by_column(column).key, column)
+            for column in table.columns
+        ]
+        target = [
+            model.get_property_by_column(column).key
+            for column in model.primary_key
+        ]
+        target = self._upsert_models[model.class_.__name__] or target
+        target_columns = ', '.join(
+            f'"{model.columns[attr].name}"' for attr in target
+        )
+        column_names = ', '.join(f'"{column.name}"' for _, column in columns)
+        updated = [
+            column.name
+            for attr, column in columns
+            if attr not in target and not column.primary_key
+        ]
+        if self._upsert_update and updated:
+            action = 'DO UPDATE SET ' + ', '.join(
+                f'"{name}" = EXCLUDED."{name}"' for name in updated
+            )
+        else:
+            action = 'DO NOTHING'
+
+        staging_table = f'modelcache_upsert_{table.name}'
+        cursor.execute(
+            f'CREATE TEMPORARY TABLE "{staging_table}" AS SELECT '
+            f'{column_names}, NULL::bigint AS "__row" FROM {table} '
+            'WITH NO DATA'
+        )
+        self._copy_into(
+            cursor,
+            f'"{staging_table}"',
+            [(column.name, column.type) for _, column in columns]
+            + [('__row', sqlalchemy.BigInteger())],
+            (
+                row + [position]
+                for position, row in enumerate(
+                    self._copy_values(objects, columns)
+                )
+            ),
+        )
+        # DISTINCT ON avoids affecting a row twice in a single command.
+        cursor.execute(
+            f'INSERT INTO {table} ({column_names}) '
+            f'SELECT DISTINCT ON ({target_columns}) {column_names} '
+            f'FROM "{staging_table}" '
+            f'ORDER BY {target_columns}, "__row" DESC '
+            f'ON CONFLICT ({target_columns}) {action}'
+        )
+        if self._upsert_returning:
+            self._resolve_primary_keys(
+                cursor, model, table, staging_table, target, objects
+            )
+        cursor.execute(f'DROP TABLE "{staging_table}"')
 
-            if model_key in self._preload_models_filter:
-                query = query.filter(self._preload_models_filter[model_key])
+    def _resolve_primary_keys(
+        self, cursor, model, table, staging_table, target, objects
+    ):
+        """
+        Set the primary key attributes of upserted `objects` to the ones of
+        the rows matching their conflict `target` attributes.
+        """
+        primary_key = [
+            (model.get_property_by_column(column).key, column.name)
+            for column in model.primary_key
+        ]
+        cursor.execute(
+            'SELECT s."__row", '
+            + ', '.join(f't."{name}"' for _, name in primary_key)
+            + f' FROM "{staging_table}" AS s JOIN {table} AS t ON '
+            + ' AND '.join(
+                f't."{name}" = s."{name}"'
+                for name in (model.columns[attr].name for attr in target)
+            )
+        )
+        model_class = model.class_
+        for position, *key in cursor.fetchall():
+            instance = objects[position]
+            for (attr, _), value in zip(primary_key, key):
+                oldvalue = getattr(instance, attr)
+                if oldvalue != value:
+                    attributes.set_committed_value(instance, attr, value)
+                    self._reindex(model_class, instance, attr, oldvalue, value)
+
+    def _delete_by_copy(self, cursor, model, keys):
+        """
+        Delete rows by copying their primary `keys` into a temporary staging
+        table and deleting them with a single `DELETE ... USING` per table
+        of `model`.
 
-            if self._prefetch is not None and model_key in self._prefetch:
-                query = query.options(
-                    sqlalchemy.orm.joinedload(
-                        *[attr for attr in self._prefetch[model_key]]
-                    )
+        Args:
+            cursor: A Psycopg2 cursor
+            model: The model class of the rows
+            keys: Primary key tuples in the order of the mapper's primary key
+        """
+        mapper = inspect(model)
+        # Tables of subclasses refer to the ones of their base classes.
+        for table in reversed(mapper.tables):
+            primary_key = list(table.primary_key.columns)
+            staging_table = f'modelcache_delete_{table.name}'
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE "{staging_table}" AS SELECT '
+                + ', '.join(f'"{column.name}"' for column in primary_key)
+                + f' FROM {table} WITH NO DATA'
+            )
+            self._copy_into(
+                cursor,
+                f'"{staging_table}"',
+                [(column.name, column.type) for column in primary_key],
+                keys,
+            )
+            cursor.execute(
+                f'DELETE FROM {table} AS t USING "{staging_table}" AS s '
+                'WHERE '
+                + ' AND '.join(
+                    f't."{column.name}" = s."{column.name}"'
+                    for column in primary_key
                 )
+            )
+            cursor.execute(f'DROP TABLE "{staging_table}"')
+        self._model_stats(model)['deleted'] += len(keys)
+        self._log(
+            'debug', f'Deleted {len(keys)} rows of {self._model_key(model)}.'
+        )
+
+    def _copy_values(self, objects, columns):
+        """
+        Yield a row of values per object for the given tuples of attribute
+        name and column, replacing missing values by scalar column defaults.
+        """
+        defaults = [
+            column.default.arg
+            if column.default is not None and column.default.is_scalar
+            else None
+            for attr, column in columns
+        ]
+        for object in objects:
+            row = [getattr(object, attr) for attr, column in columns]
+            if None in row:
+                row = [
+                    default if value is None else value
+                    for value, default in zip(row, defaults)
+                ]
+            yield row
+
+    def _binary_encoders(self, types):
+        """
+        Return binary COPY encoders for column `types` or None if binary
+        COPY is disabled or not supported for one of the types.
+        """
+        if self._copy_format != 'binary':
+            return None
+        encoders = [risclog.sqlalchemy.pgcopy.get_encoder(t) for t in types]
+        if None in encoders:
+            return None
+        return encoders
+
+    def _copy_into(self, cursor, target, columns, rows):
+        """
+        Copy `rows` into the table `target` by using PostgreSQL's COPY
+        command. With binary COPY, rows are encoded while PostgreSQL reads
+        them, so the whole payload is never held in memory. Rows with naive
+        values for a `DateTime(timezone=True)` column are copied as CSV
+        instead, so PostgreSQL applies the session's time zone to them.
+
+        Args:
+            cursor: A Psycopg2 cursor
+            target: Name of the table to copy into
+            columns: Tuples of column name and SQLAlchemy type
+            rows: Iterable of value sequences matching `columns`
+        """
+        columns_string = ','.join(f'"{name}"' for name, _ in columns)
+        encoders = self._binary_encoders([type_ for _, type_ in columns])
+        zoned = [
+            position
+            for position, (_, type_) in enumerate(columns)
+            if isinstance(type_, sqlalchemy.DateTime) and type_.timezone
+        ]
+        if encoders is not None and zoned:
+            # Naive values are interpreted in the session's time zone,
+            # which only PostgreSQL's text input applies.
+            rows = list(rows)
+            if any(
+                row[position] is not None and row[position].tzinfo is None
+                for row in rows
+                for position in zoned
+            ):
+                self._log(
+                    'debug',
+                    f'Falling back to CSV COPY for naive timestamps '
+                    f'in {target}.',
+                )
+                encoders = None
+        if encoders is not None:
+            cursor.copy_expert(
+                f'COPY {target} ({columns_string}) '
+                'FROM STDIN WITH (FORMAT binary)',
+                risclog.sqlalchemy.pgcopy.CopyStream(
+                    risclog.sqlalchemy.pgcopy.encode_rows(encoders, rows)
+                ),
+                size=COPY_BUFFER_SIZE,
+            )
+            return
+
+        file = io.StringIO()
+        writer = csv.writer(file)
+        for row in rows:
+            writer.writerow(
+                [r'\N' if value is None else value for value in row]
+            )
+        file.seek(0)
+        cursor.copy_expert(
+            f'COPY {target} ({columns_string}) '
+            "FROM STDIN WITH CSV DELIMITER ',' NULL '\\N'",
+            file,
+        )
+
+    def _update_by_copy(self, cursor, objects):
+        """
+        Update objects by copying their changed columns into a temporary
+        staging table and applying them with a single `UPDATE ... FROM` per
+        set of changed columns. Expects instances of one single model per
+        call.
+
+        Args:
+            cursor: A Psycopg2 cursor
+            objects: Persistent SQLAlchemy ORM instances to update
+
+        Returns:
+            The objects which could not be updated this way (because their
+            primary key changed or their model spans multiple tables) and
+            need to be saved otherwise.
+        """
+        if len(objects) == 0:
+            return objects
+
+        model = inspect(objects[0]).mapper
+        if len(model.tables) != 1:
+            return objects
+        table = model.tables[0]
+        primary_key = model.primary_key
+        primary_key_attrs = {
+            model.get_property_by_column(column).key for column in primary_key
+        }
+        column_attrs = {
+            attr.key: attr.columns[0]
+            for attr in model.column_attrs
+            if attr.columns[0].table is table
+        }
+
+        remaining, groups = [], {}
+        for object in objects:
+            state = attributes.instance_state(object)
+            changed = tuple(
+                sorted(
+                    attr
+                    for attr in state.committed_state
+                    if attr in column_attrs
+                )
+            )
+            if not changed:
+                continue
+            if primary_key_attrs.intersection(changed):
+                remaining.append(object)
+            else:
+                groups.setdefault(changed, []).append(state)
+
+        staging_table = f'modelcache_update_{table.name}'
+        for changed, states in groups.items():
+            columns = [column_attrs[attr] for attr in changed]
+            staging_columns = [
+                (f'__pk_{i}', column.type)
+                for i, column in enumerate(primary_key)
+            ] + [(column.name, column.type) for column in columns]
+            cursor.execute(
+                f'CREATE TEMPORARY TABLE "{staging_table}" AS SELECT '
+                + ', '.join(
+                    [
+                        f'"{column.name}" AS "{name}"'
+                        for column, (name, _) in zip(
+                            primary_key, staging_columns
+                        )
+                    ]
+                    + [f'"{column.name}"' for column in columns]
+                )
+                + f' FROM {table} WITH NO DATA'
+            )
+            self._copy_into(
+                cursor,
+                f'"{staging_table}"',
+                staging_columns,
+                (
+                    list(state.key[1]) + [state.dict.get(a) for a in changed]
+                    for state in states
+                ),
+            )
+            cursor.execute(
+                f'UPDATE {table} AS t SET '
+                + ', '.join(f'"{c.name}" = s."{c.name}"' for c in columns)
+                + f' FROM "{staging_table}" AS s WHERE '
+                + ' AND '.join(
+                    f't."{column.name}" = s."__pk_{i}"'
+                    for i, column in enumerate(primary_key)
+                )
+            )
+            cursor.execute(f'DROP TABLE "{staging_table}"')
+            for state in states:
+                # Mark as saved, so the session won't update them again.
+                instance = state.obj()
+                for attr in changed:
+                    attributes.set_committed_value(
+                        instance, attr, state.dict.get(attr)
+                    )
+
+        return remaining
+
+    def _auto_flush(self):
+        """
+        Write new and modified instances to the database and replace them
+        by read-only records, keeping the rest of the cache.
+        """
+        flushed = {
+            model_key: self._filter_sa_result_objects(objects)
+            for model_key, objects in self._changed_instances()
+        }
+        self._log(
+            'debug',
+            f'Automatically flushing {sum(map(len, flushed.values()))} '
+            'instances.',
+        )
+        self._flush_changes()
+        self._new_instances.clear()
+        self._dirty_instances.clear()
+        self._created_count = 0
+
+        for model_key, objects in flushed.items():
+            if not objects:
+                continue
+            model = type(objects[0])
+            self._replace_by_records(model, objects)
+            # Flushing removed the handler of the remaining instances.
+            self._register_change_handler(model, self._instance_change_handler)
+        gc.collect()
+        self._record_memory_cycle()
+
+    def materialize(self, record):
+        """
+        Return a persistent model instance for a read-only record and use it
+        instead of the record in the cache from now on.
+
+        Records are returned by lookups of `read_only_models` and for
+        instances written by an automatic flush. Other values are returned
+        unchanged. Records passed to `create()` are materialized
+        automatically.
+        """
+        model_key = self._record_models.get(type(record))
+        if model_key is None:
+            return record
+        model = self._models[model_key]
+        [instance] = self._materialize_rows(
+            model, self._record_keys(model), [record]
+        )
+        self._replace_in_cache(model, {record: instance})
+        return instance
+
+    def _materialize_rows(self, model, keys, rows):
+        """
+        Return persistent `model` instances built from `rows` of values of
+        the attributes `keys`.
+
+        Rows whose identity is already present in the session are taken
+        from there.
+        """
+        mapper = inspect(model)
+        identity_map = self.session.identity_map
+        instances = []
+        new_instances = []
+        for values in rows:
+            instance = mapper.class_manager.new_instance()
+            for key, value in zip(keys, values):
+                attributes.set_committed_value(instance, key, value)
+            sqlalchemy.orm.make_transient_to_detached(instance)
+            existing = identity_map.get(
+                attributes.instance_state(instance).key
+            )
+            if existing is None:
+                new_instances.append(instance)
+            else:
+                instance = existing
+            instances.append(instance)
+        self.session.add_all(new_instances)
+        return instances
+
+    def _record_keys(self, model):
+        """Return the column attribute keys stored in records of `model`."""
+        return [attr.key for attr in inspect(model).column_attrs]
+
+    def _record_class(self, model):
+        """
+        Return a named tuple class for read-only records of `model`, which
+        are compared by identity like model instances.
+        """
+        model_key = self._model_key(model)
+        if model_key not in self._record_classes:
+            record_class = _record_type(
+                f'{model.__name__}Record', self._record_keys(model)
+            )
+            self._record_classes[model_key] = record_class
+            self._record_models[record_class] = model_key
+        return self._record_classes[model_key]
+
+    def _replace_by_records(self, model, instances):
+        """
+        Replace flushed `model` instances in the cache and its indices by
+        read-only records and remove them from the session.
+        """
+        keys = self._record_keys(model)
+        make_record = self._record_class(model)._make
+        self._replace_in_cache(
+            model,
+            {
+                instance: make_record(
+                    attributes.instance_state(instance).dict.get(key)
+                    for key in keys
+                )
+                for instance in instances
+            },
+        )
+        # Rebuilding the instance list on every flush would be quadratic,
+        # so release the instances once they make up half of it.
+        model_key = self._model_key(model)
+        if 2 * len(self._replacements.get(model_key, ())) >= len(
+            self._cached_instances.get(model_key, ())
+        ):
+            self._apply_replacements(model)
+
+        for instance in instances:
+            if attributes.instance_state(instance).session_id is not None:
+                sqlalchemy.orm.object_session(instance).expunge(instance)
+
+    def _replace_in_cache(self, model, replacements):
+        """
+        Replace entries of the indices of `model` according to the
+        dictionary `replacements`.
+
+        The instance list is updated lazily by `_apply_replacements()` as
+        it is only needed to build new indices.
+        """
+        model_key = self._model_key(model)
+        self._replacements.setdefault(model_key, {}).update(replacements)
+        self._owned_instances.get(model_key, set()).difference_update(
+            replacements
+        )
+        self._own(model, filter(None, replacements.values()))
+        self._drop_sorted_indices(model)
+
+        for attribute_key, attribute_index in self._get_model_indices(
+            model
+        ).items():
+            unique = self._is_unique(model, attribute_key)
+            keys = {
+                self._object_instance_key(old, attribute_key)
+                for old in replacements
+            }
+            for key in keys:
+                entry = attribute_index.get(key)
+                if entry is None:
+                    continue
+                if unique:
+                    attribute_index[key] = replacements.get(entry, entry)
+                else:
+                    attribute_index[key] = {
+                        replacements.get(i, i): None for i in entry
+                    }
+
+    def _apply_replacements(self, model):
+        """Apply pending replacements to the instance list of `model`."""
+        model_key = self._model_key(model)
+        replacements = self._replacements.pop(model_key, None)
+        if replacements:
+            model_cache = self._cached_instances[model_key]
+            model_cache[:] = [
+                replacement
+                for replacement in (
+                    replacements.get(i, i) for i in model_cache
+                )
+                if replacement is not None
+            ]
+
+    def clear(self, session=None):
+        """Clear the cache. Will result in data loss of unflushed objects."""
+        self._created_count = 0
+        for model_key in list(self._change_listeners):
+            self._deregister_change_handler(
+                self._models[model_key], self._instance_change_handler
+            )
+        self._cached_instances.clear()
+        self._indices.clear()
+        self._new_instances.clear()
+        self._dirty_instances.clear()
+        self._deleted_keys.clear()
+        self._owned_instances.clear()
+        self._loaded_keys.clear()
+        self._loaded_instances.clear()
+        self._replacements.clear()
+        self._columnar_tables.clear()
+        self._sorted_indices.clear()
+        self._change_marks.clear()
+        gc.collect()
+        self.log_memory_usage()
+
+    def close(self):
+        """
+        Clear the cache and stop tracing memory allocations if the cache
+        started it.
+        """
+        self.clear()
+        if self._stop_tracing is not None:
+            self._stop_tracing()
+
+    def pending_counts(self):
+        """
+        Return the number of new and modified instances per model name which
+        will be written by the next `save_changes()`.
+
+        Returns:
+            A dictionary like {'Model': {'new': 2, 'dirty': 1}}.
+        """
+        self._collect_dirty_instances()
+        return {
+            model_key: {
+                'new': len(self._new_instances.get(model_key, ())),
+                'dirty': len(self._dirty_instances.get(model_key, ())),
+            }
+            for model_key in self._cached_instances
+        }
+
+    def pending_models(self):
+        """
+        Return the models with new, modified or deleted instances which
+        will be written by the next `save_changes()`.
+
+        Returns:
+            A dictionary mapping model names to model classes.
+        """
+        self._collect_dirty_instances()
+        return self._pending_models()
+
+    def _pending_models(self):
+        """Return the models with pending changes, see `pending_models()`."""
+        return {
+            model_name: self._models[model_name]
+            for model_name in itertools.chain(
+                (model_name for model_name, _ in self._changed_instances()),
+                self._deleted_keys,
+            )
+            if model_name in self._models
+        }
+
+    def discard_reserved_sequences(self):
+        """
+        Forget the sequence values reserved by `sequence_block_size` but
+        not assigned yet, e.g. in a forked copy of the cache which must not
+        assign the same values as the original.
+        """
+        self._sequence_pools.clear()
+
+    def _changed_instances(self):
+        """
+        Yield tuples of model name and a list of its new and modified
+        instances for every model with pending changes.
+        """
+        self._collect_dirty_instances()
+        for model_key in self._cached_instances:
+            objects = list(self._new_instances.get(model_key, ())) + list(
+                self._dirty_instances.get(model_key, ())
+            )
+            if objects:
+                yield model_key, objects
+
+    def _model_query(self, model):
+        """Return the query used to load instances of `model`."""
+        model_key = self._model_key(model)
+        if model_key in self._read_only_models:
+            query = self._column_query(model, self._record_keys(model))
+        elif model_key in self._preload_models_data:
+            query = self._column_query(
+                model, self._preload_models_data[model_key]
+            )
+        else:
+            query = self._column_query(model, ())
+
+        if (
+            self._prefetch is not None
+            and model_key in self._prefetch
+            and model_key not in self._read_only_models
+        ):
+            if self._prefetch_strategy == 'stitch':
+                query = query.options(
+                    *[
+                        sqlalchemy.orm.selectinload(getattr(model, name))
+                        for name in self._prefetched_relationships(model)
+                        if not self._can_stitch(model, name)
+                    ]
+                )
+            else:
+                query = query.options(
+                    sqlalchemy.orm.joinedload(
+                        *[attr for attr in self._prefetch[model_key]]
+                    )
+                )
+        return query
+
+    def _prefetched_relationships(self, model):
+        """Return the names of the relationships of `model` to prefetch."""
+        return [
+            getattr(attr, 'key', attr)
+            for attr in self._prefetch.get(self._model_key(model), ())
+        ]
+
+    def _can_stitch(self, model, name):
+        """
+        Return whether the relationship `name` of `model` can be set from
+        preloaded instances of the related model.
+        """
+        relationship = inspect(model).relationships[name]
+        target_key = self._model_key(relationship.mapper.class_)
+        return (
+            relationship.secondary is None
+            and not relationship.order_by
+            and self._is_plain_join(relationship)
+            and self._preload_models
+            and not self._load_on_miss
+            and target_key not in self._preload_models_data
+            and target_key not in self._preload_models_filter
+            and target_key not in self._read_only_models
+            and target_key not in self._columnar_models
+        )
+
+    def _is_plain_join(self, relationship):
+        """
+        Return whether the join condition of `relationship` only compares
+        its local and remote columns for equality, so matching foreign key
+        values is equivalent to it.
+        """
+
+        def column_key(column):
+            return (column.table, column.key)
+
+        pairs = {
+            frozenset((column_key(local), column_key(remote)))
+            for local, remote in relationship.local_remote_pairs
+        }
+        condition = relationship.primaryjoin
+        clauses = [condition]
+        if (
+            isinstance(condition, sqlalchemy.sql.expression.BooleanClauseList)
+            and condition.operator is operator.and_
+        ):
+            clauses = list(condition.clauses)
+        return all(
+            isinstance(clause, sqlalchemy.sql.expression.BinaryExpression)
+            and clause.operator is operator.eq
+            and isinstance(clause.left, sqlalchemy.Column)
+            and isinstance(clause.right, sqlalchemy.Column)
+            and frozenset((column_key(clause.left), column_key(clause.right)))
+            in pairs
+            for clause in clauses
+        )
+
+    def _stitch_relationships(self, model, instances):
+        """
+        Set the prefetched relationships of `instances` to the cached
+        instances of the related models with matching foreign key values,
+        so accessing them does not load anything.
+        """
+        mapper = inspect(model)
+        for name in self._prefetched_relationships(model):
+            if not self._can_stitch(model, name):
+                continue
+            relationship = mapper.relationships[name]
+            target = relationship.mapper.class_
+            pairs = sorted(
+                (
+                    relationship.mapper.get_property_by_column(remote).key,
+                    mapper.get_property_by_column(local).key,
+                )
+                for local, remote in relationship.local_remote_pairs
+            )
+            attribute_key = tuple(remote for remote, _ in pairs)
+            # Preloads the related model if it is not cached yet.
+            attribute_index = self._get_attribute_index(target, attribute_key)
+            unique = self._is_unique(target, attribute_key)
+            for instance in instances:
+                key = tuple(getattr(instance, local) for _, local in pairs)
+                entry = None if None in key else attribute_index.get(key)
+                if entry is None:
+                    related = []
+                elif unique:
+                    related = [entry]
+                else:
+                    related = list(entry)
+                if not relationship.uselist:
+                    related = related[0] if related else None
+                attributes.set_committed_value(instance, name, related)
+            self._log(
+                'debug',
+                f'Stitched {self._model_key(model)}.{name} to '
+                f'{self._model_key(target)}.',
+            )
+
+    def preload(self, models, workers=None):
+        """
+        Preload several models at once instead of on their first use.
+
+        The rows of models preloaded as instances or `read_only_models`
+        without `prefetch`, `preload_models_data` or snapshots are fetched
+        concurrently on separate connections of the engine's pool, sharing
+        the snapshot of the session's transaction (via
+        `pg_export_snapshot()`), so all models see the same data. Rows are
+        turned into instances in the session afterwards. Note that changes
+        not committed by the session's transaction itself are not visible
+        to the other connections. Other models are loaded one after the
+        other.
+
+        Args:
+            models: Iterable of model classes.
+            workers: Maximum number of concurrent connections, defaults to
+                     one per model.
+        """
+        if not self._preload_models or self._load_on_miss:
+            return
+        models = [
+            model
+            for model in models
+            if self._model_key(model) not in self._cached_instances
+        ]
+        parallel = []
+        for model in models:
+            model_key = self._model_key(model)
+            if model_key in self._columnar_models:
+                self._get_columnar_table(model)
+            elif (
+                model_key in self._preload_models_data
+                or model_key in (self._prefetch or {})
+                or (
+                    self._snapshot_dir is not None
+                    and model_key not in self._read_only_models
+                )
+            ):
+                self._get_model_cache(model)
+            else:
+                parallel.append(model)
+        if not parallel:
+            return
+
+        start = time.perf_counter()
+        for model in parallel:
+            # Take the mark before the snapshot, see `refresh()`.
+            self._change_marks[self._model_key(model)] = self._change_mark(
+                model
+            )
+        bound_session = self.session.using_bind(self._engine_name)
+        snapshot_id = bound_session.execute(
+            sqlalchemy.text('SELECT pg_export_snapshot()')
+        ).scalar()
+        db_util = zope.component.getUtility(
+            risclog.sqlalchemy.interfaces.IDatabase
+        )
+        engine = db_util.get_engine(self._engine_name)
+
+        def fetch(statement):
+            with engine.connect() as connection:
+                connection = connection.execution_options(
+                    isolation_level='REPEATABLE READ'
+                )
+                with connection.begin():
+                    connection.execute(
+                        sqlalchemy.text(
+                            f"SET TRANSACTION SNAPSHOT '{snapshot_id}'"
+                        )
+                    )
+                    return connection.execute(statement).fetchall()
+
+        queries = {
+            model: self._column_query(model, self._record_keys(model))
+            for model in parallel
+        }
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or len(parallel)
+        ) as executor:
+            futures = {
+                model: executor.submit(fetch, query.statement)
+                for model, query in queries.items()
+            }
+            rows = {
+                model: future.result() for model, future in futures.items()
+            }
+        self._log(
+            'debug',
+            f'Fetched {sum(map(len, rows.values()))} rows of '
+            f'{len(parallel)} models in parallel in '
+            f'{time.perf_counter() - start:.3f}s.',
+        )
+
+        for model in parallel:
+            self._get_model_cache(model, rows.pop(model))
+
+    def refresh(self, model):
+        """
+        Merge rows of a preloaded `model` changed in the database since they
+        were loaded or last refreshed into the cache.
+
+        Changed rows are detected by the version column given in
+        `snapshot_versions` or PostgreSQL's `xmin` (the ID of the
+        transaction writing a row) and fetched with a single query. Their
+        instances (or records) are updated and moved within every existing
+        index, new rows are added. Instances with unsaved changes keep
+        them. Deleted rows are not detected. The first refresh builds an
+        index of the primary key if there is none yet.
+
+        Returns:
+            The number of changed and new rows merged.
+
+        Raises:
+            ValueError: If `model` was not preloaded as instances or
+                        records, e.g. if it is listed in
+                        `preload_models_data` or `columnar_models`.
+        """
+        model_key = self._model_key(model)
+        if (
+            model_key in self._columnar_models
+            or model_key in self._preload_models_data
+        ):
+            raise ValueError(f'{model_key} was not preloaded as instances.')
+        if model_key not in self._cached_instances:
+            self._get_model_cache(model)
+            return 0
+        mark = self._change_marks.get(model_key)
+        if mark is None:
+            raise ValueError(f'{model_key} was not preloaded as instances.')
+
+        start = time.perf_counter()
+        self._change_marks[model_key] = self._change_mark(model)
+        keys = self._record_keys(model)
+        rows = self._column_query(model, keys).filter(
+            self._changed_condition(model, mark)
+        )
+        mapper = inspect(model)
+        primary_key = tuple(
+            sorted(
+                mapper.get_property_by_column(column).key
+                for column in mapper.primary_key
+            )
+        )
+        positions = [keys.index(attr) for attr in primary_key]
+        primary_index = self._get_attribute_index(model, primary_key)
+        unique = self._is_unique(model, primary_key)
+        model_indices = self._get_model_indices(model)
+        make_record = self._record_class(model)._make
+
+        changed, new_rows, moves = 0, [], []
+        for row in rows:
+            entry = primary_index.get(tuple(row[p] for p in positions))
+            if entry is not None and not unique:
+                entry = next(iter(entry))
+            if entry is None:
+                new_rows.append(row)
+                continue
+            is_record = type(entry) in self._record_models
+            if not is_record and attributes.instance_state(entry).modified:
+                continue
+            old_keys = {
+                attribute_key: self._object_instance_key(entry, attribute_key)
+                for attribute_key in model_indices
+            }
+            if is_record:
+                replacement = make_record(row)
+                self._replacements.setdefault(model_key, {})[
+                    entry
+                ] = replacement
+            else:
+                for key, value in zip(keys, row):
+                    attributes.set_committed_value(entry, key, value)
+                replacement = entry
+            for attribute_key in model_indices:
+                new_key = self._object_instance_key(replacement, attribute_key)
+                if replacement is entry and new_key == old_keys[attribute_key]:
+                    continue
+                moves.append(
+                    (
+                        attribute_key,
+                        old_keys[attribute_key],
+                        entry,
+                        new_key,
+                        replacement,
+                    )
+                )
+            changed += 1
+
+        # Remove all old keys before adding the new ones, so rows swapping
+        # the values of a unique index do not collide with each other.
+        for attribute_key, old_key, entry, _, _ in moves:
+            self._remove_from_index(
+                model_indices[attribute_key],
+                old_key,
+                entry,
+                self._is_unique(model, attribute_key),
+            )
+        for attribute_key, _, _, new_key, replacement in moves:
+            self._add_to_index(
+                model_indices[attribute_key],
+                new_key,
+                replacement,
+                self._is_unique(model, attribute_key),
+            )
+        if changed:
+            self._drop_sorted_indices(model)
+        if new_rows:
+            self._apply_replacements(model)
+            if model_key in self._read_only_models:
+                instances = [make_record(row) for row in new_rows]
+            else:
+                instances = self._materialize_rows(model, keys, new_rows)
+            self._cached_instances[model_key].extend(instances)
+            self._own(model, instances)
+            self._index_instances(model, instances)
+        self._log(
+            'debug',
+            f'Refreshed {changed} and added {len(new_rows)} rows of '
+            f'{model_key} in {time.perf_counter() - start:.3f}s.',
+        )
+        return changed + len(new_rows)
+
+    def _change_mark(self, model):
+        """
+        Return the current value of the change marker of `model`: the
+        maximum of its version column or the oldest transaction ID still
+        running.
+        """
+        version = self._snapshot_versions.get(self._model_key(model))
+        if version is not None:
+            return (
+                self._column_query(model, ())
+                .with_entities(sqlalchemy.func.max(getattr(model, version)))
+                .scalar()
+            )
+        return (
+            self.session.using_bind(self._engine_name)
+            .execute(
+                sqlalchemy.text(
+                    'SELECT txid_snapshot_xmin(txid_current_snapshot())'
+                )
+            )
+            .scalar()
+        )
+
+    def _changed_condition(self, model, mark):
+        """
+        Return a condition matching the rows of `model` changed since the
+        change `mark` was taken. It may match a few unchanged rows, too.
+        """
+        version = self._snapshot_versions.get(self._model_key(model))
+        if version is not None:
+            if mark is None:
+                return sqlalchemy.true()
+            return getattr(model, version) >= mark
+        # Transaction IDs of rows wrap around at 2**32, `age()` does not.
+        xid = sqlalchemy.literal_column(f"'{mark % 2 ** 32}'::xid")
+        return sqlalchemy.or_(
+            *[
+                sqlalchemy.func.age(sqlalchemy.literal_column(f'{table}.xmin'))
+                <= sqlalchemy.func.age(xid)
+                for table in inspect(model).tables
+            ]
+        )
+
+    def _column_query(self, model, keys):
+        """
+        Return the query of the instances of `model` to preload, selecting
+        only the column attributes `keys` if given.
+        """
+        query = model.query(*keys)
+        model_key = self._model_key(model)
+        if model_key in self._preload_models_filter:
+            query = query.filter(self._preload_models_filter[model_key])
+        return query
+
+    def _get_model_cache(self, model, rows=None):
+        """
+        Return a list of every existing and newly created instance of `model`.
+
+        Args:
+            rows: Already fetched values of the column attributes of the
+                  instances to preload, see `preload()`.
+        """
+        model_key = self._model_key(model)
 
-            if self._preload_models:
-                self._cached_instances[model_key] = query.all()
+        if model_key not in self._cached_instances:
+            # Initialize model cache if it doesn't exist yet.
+            self._models[model_key] = model
+            query = self._model_query(model)
+
+            model_indices = self._get_model_indices(model)
+            for attribute_key in self._declared_indices.get(
+                model_key, set()
+            ) | self._unique_indices.get(model_key, set()):
+                model_indices.setdefault(attribute_key, {})
+
+            preload = self._preload_models and not self._load_on_miss
+            if preload and model_key not in self._change_marks:
+                self._change_marks[model_key] = self._change_mark(model)
+            start = time.perf_counter()
+            memory = self._traced_memory()
+            model_memory = self._model_memory(model)
+            index_memory = sum(model_memory['indices'].values())
+            if (
+                preload
+                and self._snapshot_dir is not None
+                and model_key not in self._preload_models_data
+                and model_key not in self._read_only_models
+                and model_key not in (self._prefetch or {})
+            ):
+                self._cached_instances[model_key] = self._load_snapshot(
+                    model, query
+                )
+            elif preload:
+                self._cached_instances[model_key] = self._load_instances(
+                    model, query, rows
+                )
             else:
                 # XXX: We run a noop DB request here to avoid some
                 # hard-to-debug session transaction errors that crop up
                 # otherwise.
                 self._cached_instances[model_key] = query.limit(0).all()
+            self._own(model, self._cached_instances[model_key])
+            if preload:
+                preload_stats = self._model_stats(model)['preload']
+                preload_stats['rows'] += len(self._cached_instances[model_key])
+                preload_stats['seconds'] += time.perf_counter() - start
+            if preload and self._profile_memory:
+                size = self._traced_memory() - memory
+                model_memory['preload'] += size
+                self._flush_memory_base += size
+                model_memory['instances'] += size - (
+                    sum(model_memory['indices'].values()) - index_memory
+                )
+            if (
+                preload
+                and self._prefetch_strategy == 'stitch'
+                and model_key in (self._prefetch or {})
+                and model_key not in self._read_only_models
+            ):
+                self._stitch_relationships(
+                    model, self._cached_instances[model_key]
+                )
 
             self._register_change_handler(model, self._instance_change_handler)
 
         return self._cached_instances[model_key]
 
+    def _load_instances(self, model, query, rows=None):
+        """
+        Return a list of all instances matched by the preload `query` or
+        built from already fetched `rows` of column values.
+
+        The instances are added to every existing (i.e. declared) index of
+        `model` while loading. If `preload_batch_size` is set, rows are
+        streamed from a server-side cursor and indexed batch by batch, so
+        only one batch of raw rows is held in memory besides the resulting
+        instances.
+        """
+        timings = {}
+        if rows is not None:
+            if self._model_key(model) in self._read_only_models:
+                instances = self._query_results(model, rows)
+            else:
+                instances = self._materialize_rows(
+                    model, self._record_keys(model), rows
+                )
+            self._index_instances(model, instances, timings)
+        elif self._preload_batch_size is None:
+            instances = self._query_results(model, query.all())
+            self._index_instances(model, instances, timings)
+        else:
+            instances = []
+            rows = query.yield_per(self._preload_batch_size).execution_options(
+                stream_results=True
+            )
+            for batch in _batches(rows, self._preload_batch_size):
+                batch = self._query_results(model, batch)
+                instances.extend(batch)
+                self._index_instances(model, batch, timings)
+
+        model_indices = self._get_model_indices(model)
+        for attribute_key, duration in timings.items():
+            self._record_index_build(model, attribute_key, duration)
+            self._log(
+                'debug',
+                f'Built index {attribute_key} of {self._model_key(model)} '
+                f'with {len(model_indices[attribute_key])} keys in '
+                f'{duration:.3f}s.',
+            )
+        return instances
+
+    def _query_results(self, model, rows):
+        """
+        Return the results of a query built by `_model_query()` as a list,
+        converting rows of `read_only_models` to records.
+        """
+        if self._model_key(model) not in self._read_only_models:
+            return list(rows)
+        make_record = self._record_class(model)._make
+        return [make_record(row) for row in rows]
+
+    def _load_snapshot(self, model, query):
+        """
+        Return all instances matched by the preload `query`, restored with
+        their declared indices from the snapshot file of `model` if it is
+        still fresh.
+
+        Otherwise the instances are loaded from the database and a new
+        snapshot is written, unless they hold values of a type not supported
+        by snapshots.
+        """
+        model_key = self._model_key(model)
+        path = os.path.join(self._snapshot_dir, f'{model_key}.snapshot')
+        fingerprint = self._snapshot_fingerprint(model, query)
+
+        start = time.perf_counter()
+        snapshot = risclog.sqlalchemy.snapshot.read(path, fingerprint)
+        if snapshot is not None:
+            instances = self._restore_snapshot(model, snapshot)
+            self._log(
+                'debug',
+                f'Restored {len(instances)} instances of {model_key} from '
+                f'snapshot in {time.perf_counter() - start:.3f}s.',
+            )
+            return instances
+
+        instances = self._load_instances(model, query)
+        try:
+            risclog.sqlalchemy.snapshot.write(
+                path, fingerprint, self._take_snapshot(model, instances)
+            )
+        except risclog.sqlalchemy.snapshot.UnsupportedTypeError as e:
+            self._log('debug', f'Not snapshotting {model_key}: {e}')
+        else:
+            self._log('debug', f'Wrote snapshot of {model_key} to {path}.')
+        return instances
+
+    def _snapshot_fingerprint(self, model, query):
+        """
+        Return a value which changes whenever the preload `query` of `model`,
+        its declared indices or the content of its tables change.
+
+        Changes are detected by the row count and the maximum `xmin` (the ID
+        of the last transaction writing a row) per table or the maximum of
+        the version column given in `snapshot_versions`.
+        """
+        model_key = self._model_key(model)
+        mapper = inspect(model)
+        version = self._snapshot_versions.get(model_key)
+        if version is not None:
+            markers = [
+                (
+                    getattr(model, version).property.columns[0].table,
+                    getattr(model, version),
+                )
+            ]
+        else:
+            markers = [
+                (table, sqlalchemy.literal_column('xmin::text::bigint'))
+                for table in mapper.tables
+            ]
+        bound_session = self.session.using_bind(self._engine_name)
+        states = tuple(
+            tuple(
+                bound_session.execute(
+                    sqlalchemy.select(
+                        [sqlalchemy.func.count(), sqlalchemy.func.max(marker)]
+                    ).select_from(table)
+                ).first()
+            )
+            for table, marker in markers
+        )
+        statement = query.statement.compile()
+        indices = tuple(
+            sorted(
+                (attribute_key, self._is_unique(model, attribute_key))
+                for attribute_key in self._get_model_indices(model)
+            )
+        )
+        return (
+            str(statement),
+            repr(sorted(statement.params.items())),
+            tuple(self._snapshot_attributes(model)),
+            indices,
+            states,
+        )
+
+    def _snapshot_attributes(self, model):
+        """Return the keys of the column attributes loaded by default."""
+        return [
+            attr.key
+            for attr in inspect(model).column_attrs
+            if not attr.deferred
+        ]
+
+    def _take_snapshot(self, model, instances):
+        """Return a `Snapshot` of `instances` and the indices of `model`."""
+        states = [attributes.instance_state(i) for i in instances]
+        columns = {
+            key: [state.dict.get(key) for state in states]
+            for key in self._snapshot_attributes(model)
+        }
+        positions = {instance: i for i, instance in enumerate(instances)}
+        indices = {}
+        for attribute_key, attribute_index in self._get_model_indices(
+            model
+        ).items():
+            if self._is_unique(model, attribute_key):
+                indices[attribute_key] = {
+                    key: positions[instance]
+                    for key, instance in attribute_index.items()
+                }
+            else:
+                indices[attribute_key] = {
+                    key: [positions[instance] for instance in bucket]
+                    for key, bucket in attribute_index.items()
+                }
+        return risclog.sqlalchemy.snapshot.Snapshot(columns, indices)
+
+    def _restore_snapshot(self, model, snapshot):
+        """
+        Return persistent `model` instances built from the rows of
+        `snapshot` and restore its indices.
+        """
+        instances = self._materialize_rows(
+            model, list(snapshot.columns), zip(*snapshot.columns.values())
+        )
+
+        model_indices = self._get_model_indices(model)
+        for attribute_key, entries in snapshot.indices.items():
+            start = time.perf_counter()
+            memory = self._traced_memory()
+            if self._is_unique(model, attribute_key):
+                model_indices[attribute_key].update(
+                    (key, instances[position])
+                    for key, position in entries.items()
+                )
+            else:
+                model_indices[attribute_key].update(
+                    (key, dict.fromkeys(instances[p] for p in positions))
+                    for key, positions in entries.items()
+                )
+            self._record_index_build(
+                model, attribute_key, time.perf_counter() - start
+            )
+            if self._profile_memory:
+                self._record_index_memory(
+                    model, attribute_key, self._traced_memory() - memory
+                )
+        return instances
+
+    def _load_keys(self, model, attribute_key, keys):
+        """
+        Load instances of `model` matching `keys` of the index
+        `attribute_key` which have not been looked up yet, using one
+        `IN` query per `load_batch_size` keys, and add them to the cache.
+        """
+        model_key = self._model_key(model)
+        loaded_keys = self._loaded_keys.setdefault(model_key, {}).setdefault(
+            attribute_key, set()
+        )
+        keys = list(dict.fromkeys(k for k in keys if k not in loaded_keys))
+        if not keys:
+            return
+
+        model_cache = self._get_model_cache(model)
+        loaded_instances = self._loaded_instances.setdefault(model_key, set())
+        columns = [getattr(model, attr) for attr in attribute_key]
+        for batch in _batches(keys, self._load_batch_size):
+            query = self._model_query(model).filter(
+                self._keys_condition(columns, batch)
+            )
+            instances = []
+            for instance in self._query_results(model, query):
+                identity = self._identity(model, instance)
+                if identity not in loaded_instances:
+                    loaded_instances.add(identity)
+                    instances.append(instance)
+            model_cache.extend(instances)
+            self._own(model, instances)
+            self._index_instances(model, instances)
+            loaded_keys.update(batch)
+        self._log(
+            'debug', f'Loaded {len(keys)} keys {attribute_key} of {model_key}.'
+        )
+
+    def _identity(self, model, instance):
+        """
+        Return the primary key of a `model` instance or record, which stays
+        the same if one is replaced by the other. Other rows are returned
+        unchanged.
+        """
+        if isinstance(instance, ObjectBase):
+            return attributes.instance_state(instance).identity
+        if type(instance) in self._record_models:
+            mapper = inspect(model)
+            return tuple(
+                getattr(instance, mapper.get_property_by_column(column).key)
+                for column in mapper.primary_key
+            )
+        return instance
+
+    def _keys_condition(self, columns, keys):
+        """Return a SQL condition matching any of `keys` on `columns`."""
+        plain_keys = [key for key in keys if None not in key]
+        conditions = [
+            sqlalchemy.and_(
+                *[
+                    column.is_(None) if value is None else column == value
+                    for column, value in zip(columns, key)
+                ]
+            )
+            for key in keys
+            if None in key
+        ]
+        if len(columns) == 1 and plain_keys:
+            conditions.append(columns[0].in_([key[0] for key in plain_keys]))
+        elif plain_keys:
+            conditions.append(sqlalchemy.tuple_(*columns).in_(plain_keys))
+        return sqlalchemy.or_(*conditions)
+
+    def _index_instances(self, model, instances, timings=None):
+        """
+        Add `instances` to every existing index of `model`.
+
+        Args:
+            timings: Optional dictionary in which the time spent per index
+                     is accumulated.
+        """
+        self._insert_into_sorted_indices(model, instances)
+        model_indices = self._get_model_indices(model)
+        for attribute_key, attribute_index in model_indices.items():
+            start = time.perf_counter()
+            memory = self._traced_memory()
+            unique = self._is_unique(model, attribute_key)
+            for instance in instances:
+                self._add_to_index(
+                    attribute_index,
+                    self._object_instance_key(instance, attribute_key),
+                    instance,
+                    unique,
+                )
+            if self._profile_memory:
+                self._record_index_memory(
+                    model, attribute_key, self._traced_memory() - memory
+                )
+            if timings is not None:
+                timings[attribute_key] = (
+                    timings.get(attribute_key, 0) + time.perf_counter() - start
+                )
+
+    def _check_unique(self, model, instances):
+        """
+        Raise a `DuplicateKeyException` if adding `instances` to the unique
+        indices of `model` would violate them, before anything is changed.
+        """
+        for attribute_key, attribute_index in self._get_model_indices(
+            model
+        ).items():
+            if not self._is_unique(model, attribute_key):
+                continue
+            keys = set()
+            for instance in instances:
+                instance_key = self._object_instance_key(
+                    instance, attribute_key
+                )
+                if instance_key in attribute_index or instance_key in keys:
+                    raise DuplicateKeyException(
+                        'Multiple instances found for unique key '
+                        f'{instance_key}.'
+                    )
+                keys.add(instance_key)
+
+    def _add_to_index(self, attribute_index, instance_key, instance, unique):
+        """Add `instance` to the entry `instance_key` of an index."""
+        if unique:
+            existing = attribute_index.setdefault(instance_key, instance)
+            if existing is not instance:
+                raise DuplicateKeyException(
+                    f'Multiple instances found for unique key {instance_key}.'
+                )
+        else:
+            attribute_index.setdefault(instance_key, {})[instance] = None
+
+    def _remove_from_index(
+        self, attribute_index, instance_key, instance, unique
+    ):
+        """
+        Remove `instance` from the entry `instance_key` of an index.
+
+        Returns:
+            True if `instance` was found and removed, False otherwise.
+        """
+        entry = attribute_index.get(instance_key)
+        if unique:
+            if entry is not instance:
+                return False
+            del attribute_index[instance_key]
+        else:
+            if entry is None or instance not in entry:
+                return False
+            del entry[instance]
+            if not entry:
+                del attribute_index[instance_key]
+        return True
+
+    def _is_declared(self, model, attribute_key):
+        """Return whether the index for `attribute_key` was declared."""
+        model_key = self._model_key(model)
+        return attribute_key in self._declared_indices.get(
+            model_key, ()
+        ) or self._is_unique(model, attribute_key)
+
+    def _is_unique(self, model, attribute_key):
+        """Return whether the index for `attribute_key` is unique."""
+        unique_indices = self._unique_indices.get(self._model_key(model))
+        return unique_indices is not None and attribute_key in unique_indices
+
     def _get_model_indices(self, model):
         """
         Return a dictionary containing tuples of indexed attributes as keys.
@@ -344,22 +3111,36 @@ class ModelCache:
 
     def _get_attribute_index(self, model, attributes):
         """
-        Return a dictionary containing model attribute values as keys and a
-        list of matching instances as values.
+        Return a dictionary containing model attribute values as keys and an
+        insertion-ordered set (a dictionary with None values) of matching
+        instances as values. Values of unique indices are single instances.
         """
         model_indices = self._get_model_indices(model)
         attribute_key = tuple(sorted(attributes))
 
         if attribute_key not in model_indices:
             model_cache = self._get_model_cache(model)
+            self._apply_replacements(model)
+            start = time.perf_counter()
+            memory = self._traced_memory()
+            unique = self._is_unique(model, attribute_key)
             indexed_instances = {}
             for instance in model_cache:
-                instance_key = self._object_instance_key(
-                    instance, attribute_key
+                self._add_to_index(
+                    indexed_instances,
+                    self._object_instance_key(instance, attribute_key),
+                    instance,
+                    unique,
                 )
-                cache = indexed_instances.setdefault(instance_key, [])
-                cache.append(instance)
             model_indices[attribute_key] = indexed_instances
+            self._record_index_build(
+                model, attribute_key, time.perf_counter() - start
+            )
+            if self._profile_memory:
+                self._record_index_memory(
+                    model, attribute_key, self._traced_memory() - memory
+                )
+            self._register_change_handler(model, self._instance_change_handler)
 
         return model_indices[attribute_key]
 
@@ -385,30 +3166,96 @@ class ModelCache:
         Assign sequence values to empty model attributes specified in the
         constructor.
 
-        This iterates over every cached model and its corresponding sequences
-        and assigns sequence values where applicable..
-        Empty sequence attributes are counted and matching sequence values are
-        fetched from the database in a single request.
+        This iterates over the new and modified instances of every cached
+        model and its corresponding sequences and assigns sequence values
+        where applicable.
+        Empty sequence attributes are counted and matching sequence values of
+        all sequences are fetched from the database in a single request.
         """
-        for model_name, objects in self._cached_instances.items():
-            if model_name not in self._sequences:
-                continue
+        pending = []
+        counts = collections.Counter()
+        for model_name, objects in self._changed_instances():
+            for attribute, sequence in self._sequences.get(model_name, ()):
+                empty = [o for o in objects if getattr(o, attribute) is None]
+                if empty:
+                    pending.append((attribute, sequence, empty))
+                    counts[sequence] += len(empty)
+        if not pending:
+            return
 
-            model_sequences = self._sequences[model_name]
-            for sequence in model_sequences:
-                new_objects = list(
-                    filter(lambda o: getattr(o, sequence[0]) is None, objects)
-                )
-                if len(new_objects) > 0:
-                    sequence_values = self.session.using_bind(
-                        self._engine_name
-                    ).execute(
-                        "select nextval('%s') from generate_series(1,%s)"
-                        % (sequence[1], len(new_objects))
-                    )
+        values = {
+            sequence: iter(sequence_values)
+            for sequence, sequence_values in self._next_sequence_values(
+                counts
+            ).items()
+        }
+        for attribute, sequence, objects in pending:
+            for object, value in zip(objects, values[sequence]):
+                setattr(object, attribute, value)
+
+    def _assign_reserved_sequences(self, model, instances):
+        """
+        Assign reserved sequence values to empty sequence attributes of new
+        `model` instances.
 
-                    for object, value in zip(new_objects, sequence_values):
-                        setattr(object, sequence[0], value[0])
+        Pools running short are refilled with blocks of at least
+        `sequence_block_size` values in a single request.
+        """
+        pending = []
+        counts = collections.Counter()
+        for attribute, sequence in self._sequences.get(
+            self._model_key(model), ()
+        ):
+            empty = [o for o in instances if getattr(o, attribute) is None]
+            if empty:
+                pending.append((attribute, sequence, empty))
+                counts[sequence] += len(empty)
+
+        missing = {
+            sequence: max(
+                count - len(self._sequence_pools[sequence]),
+                self._sequence_block_size,
+            )
+            for sequence, count in counts.items()
+            if count > len(self._sequence_pools[sequence])
+        }
+        if missing:
+            for sequence, values in self._next_sequence_values(
+                missing
+            ).items():
+                self._sequence_pools[sequence].extend(values)
+
+        for attribute, sequence, objects in pending:
+            pool = self._sequence_pools[sequence]
+            for object in objects:
+                setattr(object, attribute, pool.popleft())
+
+    def _next_sequence_values(self, counts):
+        """
+        Fetch the next values of several sequences in a single request.
+
+        Args:
+            counts: Dictionary mapping sequence names to the number of
+                    values to fetch.
+
+        Returns:
+            A dictionary mapping sequence names to lists of values.
+        """
+        sequences = sorted(counts)
+        row = (
+            self.session.using_bind(self._engine_name)
+            .execute(
+                'SELECT '
+                + ', '.join(
+                    "(SELECT array_agg(nextval('%s')) "
+                    'FROM generate_series(1, %s))'
+                    % (sequence, counts[sequence])
+                    for sequence in sequences
+                )
+            )
+            .first()
+        )
+        return dict(zip(sequences, row))
 
     def _filter_sa_result_objects(self, objects):
         return list(filter(lambda x: isinstance(x, ObjectBase), objects))
@@ -423,78 +3270,143 @@ class ModelCache:
         aren't evaluated anymore.
         To still handle related object as expected, we iterate over
         relationship attributes and set their corresponding ID attributes on
-        the same object.
+        the same object. Only new and modified instances are synchronized.
         """
-        for objects in self._cached_instances.values():
+        for _, objects in self._changed_instances():
             objects = self._filter_sa_result_objects(objects)
             if len(objects) == 0:
                 continue
-            model = type(list(objects)[0])
+            self._sync_instance_relationships(type(objects[0]), objects)
 
-            rel_map = [
-                (rel.key, pair[1].key, pair[0].key)
-                for rel in inspect(model).relationships
-                for pair in rel.local_remote_pairs
-                if rel.direction is not sqlalchemy.orm.interfaces.ONETOMANY
-            ]
-            for object in objects:
-                for from_obj, from_attr, to_attr in rel_map:
-                    if getattr(object, to_attr, None) is None:
-                        setattr(
-                            object,
-                            to_attr,
-                            getattr(
-                                getattr(object, from_obj), from_attr, None
-                            ),
-                        )
+    def _sync_instance_relationships(self, model, objects):
+        """
+        Set ID attributes of `model` instances from their relationship
+        attributes where missing.
+        """
+        rel_map = [
+            (rel.key, pair[1].key, pair[0].key)
+            for rel in inspect(model).relationships
+            for pair in rel.local_remote_pairs
+            if rel.direction is not sqlalchemy.orm.interfaces.ONETOMANY
+        ]
+        for object in objects:
+            for from_obj, from_attr, to_attr in rel_map:
+                if getattr(object, to_attr, None) is None:
+                    setattr(
+                        object,
+                        to_attr,
+                        getattr(getattr(object, from_obj), from_attr, None),
+                    )
 
     def _register_change_handler(self, model, event_handler):
-        """Register an event handler for every column of a model."""
-        for attr in inspect(model).column_attrs:
-            sqlalchemy.event.listen(attr, 'set', event_handler)
+        """
+        Register an event handler for every indexed attribute of a model
+        which does not have one yet.
+        """
+        model_key = self._model_key(model)
+        if model_key in self._columnar_models:
+            return
+        attribute_names = set(
+            itertools.chain.from_iterable(self._get_model_indices(model))
+        )
+        for _, index_attributes, filter_key in self._sorted_indices.get(
+            model_key, ()
+        ):
+            attribute_names.update(index_attributes + filter_key)
+        mapper = inspect(model)
+        listened = self._change_listeners.setdefault(model_key, set())
+        for name in sorted(attribute_names - listened):
+            if name not in mapper.attrs:
+                continue
+            sqlalchemy.event.listen(getattr(model, name), 'set', event_handler)
+            listened.add(name)
 
     def _deregister_change_handler(self, model, event_handler):
-        """Removes an event handler for every column of a model."""
-        for attr in inspect(model).column_attrs:
-            sqlalchemy.event.listen(attr, 'set', event_handler)
+        """Remove an event handler from every attribute of a model."""
+        for name in self._change_listeners.pop(self._model_key(model), ()):
+            sqlalchemy.event.remove(getattr(model, name), 'set', event_handler)
+
+    def _own(self, model, objects):
+        """Remember the instances among `objects` as owned by the cache."""
+        self._owned_instances.setdefault(self._model_key(model), set()).update(
+            obj for obj in objects if type(obj) not in self._record_models
+        )
+
+    def _collect_dirty_instances(self):
+        """
+        Remember the owned instances modified in the session, so
+        `save_changes()` only needs to look at those.
+        """
+        for instance in self.session.dirty:
+            model_key = self._model_key(type(instance))
+            if instance in self._owned_instances.get(model_key, ()):
+                self._dirty_instances.setdefault(model_key, {})[
+                    instance
+                ] = None
 
     def _instance_change_handler(self, instance, value, oldvalue, initiator):
         """
-        Re-index model instances that were changed
+        Re-index cached model instances whose indexed attributes were changed
         (to keep the index up-to-date).
-        Called by SQLAlchemy's model `set` event which fires when a model
-        attribute was changed. For more information,
+        Called by SQLAlchemy's attribute `set` event, which is only listened
+        to for indexed attributes of cached models until the next flush.
+        For more information,
         see: https://docs.sqlalchemy.org/en/13/orm/events.html
         """  # noqa: E501
+        model = type(instance)
+        if instance not in self._owned_instances.get(
+            self._model_key(model), ()
+        ):
+            return
+
+        self._drop_sorted_indices(model, initiator.key)
+
         if oldvalue is sqlalchemy.util.symbol('NEVER_SET'):
             return
 
-        model = type(instance)
-        changed_attr = initiator.key
-        model_indices = self._get_model_indices(model)
+        self._reindex(model, instance, initiator.key, oldvalue, value)
 
-        for attribute_key in model_indices.keys():
-            if changed_attr not in attribute_key:
+    def _reindex(self, model, instance, changed_attr, oldvalue, value):
+        """
+        Move `instance` to the entries of its new key in every index of
+        `model` using the attribute `changed_attr`.
+        """
+        model_indices = {
+            attribute_key: attribute_index
+            for attribute_key, attribute_index in self._get_model_indices(
+                model
+            ).items()
+            if changed_attr in attribute_key
+        }
+        # Check unique indices first, so a violation changes no index.
+        for attribute_key, attribute_index in model_indices.items():
+            if not self._is_unique(model, attribute_key):
                 continue
+            new_instance_key = self._object_instance_key(
+                instance, attribute_key, replace={changed_attr: value}
+            )
+            existing = attribute_index.get(new_instance_key)
+            if existing is not None and existing is not instance:
+                raise DuplicateKeyException(
+                    'Multiple instances found for unique key '
+                    f'{new_instance_key}.'
+                )
 
+        for attribute_key, attribute_index in model_indices.items():
+            unique = self._is_unique(model, attribute_key)
             old_instance_key = self._object_instance_key(
                 instance, attribute_key, replace={changed_attr: oldvalue}
             )
             new_instance_key = self._object_instance_key(
                 instance, attribute_key, replace={changed_attr: value}
             )
-
-            old_cache = model_indices[attribute_key].get(old_instance_key, [])
-            if len(old_cache) > 1:
-                old_cache.remove(instance)
-            else:
-                model_indices[attribute_key].pop(old_instance_key, [])
-
-            cache = model_indices[attribute_key].setdefault(
-                new_instance_key, []
-            )
-            if instance not in cache:
-                cache.append(instance)
+            # Instances not found in the index are not cached by us.
+            if self._remove_from_index(
+                attribute_index, old_instance_key, instance, unique
+            ):
+                self._add_to_index(
+                    attribute_index, new_instance_key, instance, unique
+                )
 
     def _log(self, level, message):
         """Send `message` to logger on `level` if set on setup."""
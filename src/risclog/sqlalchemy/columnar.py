@@ -0,0 +1,144 @@
+"""Column-oriented storage of read-only rows using NumPy arrays.
+
+Requires the `numpy` extra of this package.
+"""
+
+import numpy
+
+
+class ColumnarTable:
+    """Rows stored as one NumPy array per column with sorted key indices.
+
+    Lookups return arrays of row positions, which can be turned into
+    records using `records()`.
+    """
+
+    def __init__(self, columns):
+        """
+        Args:
+            columns: Dictionary mapping attribute names to one-dimensional
+                     arrays of equal length.
+        """
+        self.columns = columns
+        # Sort order and sorted keys per attribute key.
+        self._indices = {}
+
+    @classmethod
+    def from_batches(cls, keys, batches):
+        """
+        Build a table from an iterable of row batches.
+
+        Args:
+            keys: Attribute names in the order of the row values.
+            batches: Iterable of lists of value tuples.
+        """
+        chunks = {key: [] for key in keys}
+        for batch in batches:
+            if not batch:
+                continue
+            for key, values in zip(keys, zip(*batch)):
+                chunks[key].append(numpy.array(values))
+        return cls(
+            {
+                key: numpy.concatenate(arrays) if arrays else numpy.array([])
+                for key, arrays in chunks.items()
+            }
+        )
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the column and index arrays."""
+        return sum(array.nbytes for array in self.columns.values()) + sum(
+            order.nbytes + sorted_keys.nbytes
+            for order, sorted_keys in self._indices.values()
+        )
+
+    def _key_array(self, attribute_key, arrays):
+        if len(attribute_key) == 1:
+            return arrays[0]
+        return numpy.rec.fromarrays(arrays, names=list(attribute_key))
+
+    def index(self, attribute_key):
+        """
+        Return the sort order of rows by the attributes `attribute_key` and
+        the correspondingly sorted keys, building them on first use.
+
+        Key columns must not contain NULL values.
+        """
+        if attribute_key not in self._indices:
+            keys = self._key_array(
+                attribute_key, [self.columns[attr] for attr in attribute_key]
+            )
+            order = numpy.argsort(keys, kind='stable')
+            self._indices[attribute_key] = (order, keys[order])
+        return self._indices[attribute_key]
+
+    def find_positions(self, attribute_key, keys):
+        """
+        Return the positions of rows matching each of `keys` of the
+        attributes `attribute_key` using vectorized binary searches.
+
+        Args:
+            keys: List of value tuples in the order of `attribute_key`.
+
+        Returns:
+            A list with an array of row positions per key.
+        """
+        if not keys:
+            return []
+        order, sorted_keys = self.index(attribute_key)
+        arrays, valid = [], numpy.ones(len(keys), dtype=bool)
+        for attr, values in zip(attribute_key, zip(*keys)):
+            array, converted = self._convert(values, self.columns[attr].dtype)
+            arrays.append(array)
+            valid &= converted
+        lookup = self._key_array(attribute_key, arrays)
+        starts = numpy.searchsorted(sorted_keys, lookup, side='left')
+        ends = numpy.searchsorted(sorted_keys, lookup, side='right')
+        return [
+            order[start:end] if match else order[:0]
+            for start, end, match in zip(
+                starts.tolist(), ends.tolist(), valid.tolist()
+            )
+        ]
+
+    def _convert(self, values, dtype):
+        """
+        Convert key `values` to an array of `dtype`.
+
+        Returns:
+            The array and a boolean array marking the values represented
+            exactly. Other values (e.g. of other types or truncated to the
+            width of a string column) cannot match.
+        """
+        try:
+            array = numpy.array(values).astype(dtype, casting='same_kind')
+            converted = numpy.ones(len(values), dtype=bool)
+        except (TypeError, ValueError):
+            array = numpy.zeros(len(values), dtype=dtype)
+            converted = numpy.zeros(len(values), dtype=bool)
+            for i, value in enumerate(values):
+                try:
+                    array[i] = numpy.array([value]).astype(
+                        dtype, casting='same_kind'
+                    )[0]
+                except (TypeError, ValueError):
+                    continue
+                converted[i] = True
+        converted &= numpy.array(
+            [a == b for a, b in zip(array.tolist(), values)], dtype=bool
+        )
+        return array, converted
+
+    def records(self, record_class, positions):
+        """Return a `record_class` instance per row position."""
+        columns = [self.columns[key] for key in record_class._fields]
+        return [
+            record_class._make(values)
+            for values in zip(
+                *[column[positions].tolist() for column in columns]
+            )
+        ]
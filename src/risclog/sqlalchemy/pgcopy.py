@@ -0,0 +1,233 @@
+"""Encode rows for PostgreSQL's binary COPY format.
+
+See: https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+"""
+
+import datetime
+import decimal
+import io
+import struct
+import uuid
+
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+
+HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+TRAILER = struct.pack('!h', -1)
+NULL = struct.pack('!i', -1)
+
+PG_EPOCH = datetime.datetime(2000, 1, 1)
+PG_EPOCH_UTC = PG_EPOCH.replace(tzinfo=datetime.timezone.utc)
+PG_EPOCH_DATE = PG_EPOCH.date()
+
+NUMERIC_POS = 0x0000
+NUMERIC_NEG = 0x4000
+NUMERIC_NAN = 0xC000
+
+_length = struct.Struct('!i')
+_numeric_header = struct.Struct('!hhHh')
+_bool_true = struct.pack('!ib', 1, 1)
+_bool_false = struct.pack('!ib', 1, 0)
+
+
+def _fixed_size(format, convert):
+    """Return an encoder packing a value with the struct `format`."""
+    packer = struct.Struct('!i' + format)
+    size = packer.size - _length.size
+
+    def encode(value):
+        try:
+            return packer.pack(size, value)
+        except struct.error:
+            return packer.pack(size, convert(value))
+
+    return encode
+
+
+encode_int2 = _fixed_size('h', int)
+encode_int4 = _fixed_size('i', int)
+encode_int8 = _fixed_size('q', int)
+encode_float4 = _fixed_size('f', float)
+encode_float8 = _fixed_size('d', float)
+
+
+def encode_bool(value):
+    return _bool_true if value else _bool_false
+
+
+def encode_bytea(value):
+    value = bytes(value)
+    return _length.pack(len(value)) + value
+
+
+def encode_text(value):
+    return encode_bytea(str(value).encode('utf-8'))
+
+
+def encode_uuid(value):
+    if not isinstance(value, uuid.UUID):
+        value = uuid.UUID(str(value))
+    return _length.pack(16) + value.bytes
+
+
+def _microseconds(delta):
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def encode_timestamp(value):
+    """
+    Encode a timestamp without time zone. Like PostgreSQL, ignore the time
+    zone of aware values.
+    """
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None)
+    return encode_int8(_microseconds(value - PG_EPOCH))
+
+
+def encode_timestamptz(value):
+    """
+    Encode a timestamp with time zone.
+
+    Raises:
+        ValueError: `value` is naive. PostgreSQL interprets naive values in
+            the session's time zone, which is not known here.
+    """
+    if value.tzinfo is None:
+        raise ValueError(f'Cannot encode naive {value} as timestamptz.')
+    return encode_int8(_microseconds(value - PG_EPOCH_UTC))
+
+
+def encode_date(value):
+    return encode_int4((value - PG_EPOCH_DATE).days)
+
+
+def encode_time(value):
+    return encode_int8(
+        ((value.hour * 60 + value.minute) * 60 + value.second) * 1000000
+        + value.microsecond
+    )
+
+
+def encode_numeric(value):
+    """Encode a number as base-10000 digits of a PostgreSQL `numeric`."""
+    if not isinstance(value, decimal.Decimal):
+        value = decimal.Decimal(str(value))
+    if value.is_nan():
+        data = _numeric_header.pack(0, 0, NUMERIC_NAN, 0)
+        return _length.pack(len(data)) + data
+    if value.is_infinite():
+        raise ValueError(f'Cannot encode {value} as numeric.')
+
+    sign, digits, exponent = value.as_tuple()
+    dscale = max(-exponent, 0)
+    digits = ''.join(map(str, digits))
+    if exponent > 0:
+        digits += '0' * exponent
+        exponent = 0
+    int_length = len(digits) + exponent
+    if int_length > 0:
+        int_part, frac_part = digits[:int_length], digits[int_length:]
+    else:
+        int_part, frac_part = '', '0' * -int_length + digits
+    int_part = int_part.rjust(-(-len(int_part) // 4) * 4, '0')
+    frac_part = frac_part.ljust(-(-len(frac_part) // 4) * 4, '0')
+
+    digits = iter(int_part + frac_part)
+    groups = [int(''.join(group)) for group in zip(*[digits] * 4)]
+    weight = len(int_part) // 4 - 1
+    start, end = 0, len(groups)
+    while start < end and groups[start] == 0:
+        start += 1
+        weight -= 1
+    while end > start and groups[end - 1] == 0:
+        end -= 1
+    groups = groups[start:end]
+    if not groups:
+        weight, sign = 0, 0
+
+    data = _numeric_header.pack(
+        len(groups), weight, NUMERIC_NEG if sign else NUMERIC_POS, dscale
+    ) + struct.pack(f'!{len(groups)}h', *groups)
+    return _length.pack(len(data)) + data
+
+
+def get_encoder(type_):
+    """
+    Return the binary encoder for a SQLAlchemy column type or None if the
+    type is not supported.
+    """
+    if isinstance(type_, sqlalchemy.types.TypeDecorator):
+        return None
+    if isinstance(type_, sqlalchemy.Boolean):
+        return encode_bool
+    if isinstance(type_, sqlalchemy.SmallInteger):
+        return encode_int2
+    if isinstance(type_, sqlalchemy.BigInteger):
+        return encode_int8
+    if isinstance(type_, sqlalchemy.Integer):
+        return encode_int4
+    if isinstance(type_, sqlalchemy.dialects.postgresql.REAL):
+        return encode_float4
+    if isinstance(type_, sqlalchemy.Float):
+        if type_.precision is not None and type_.precision <= 24:
+            return encode_float4
+        return encode_float8
+    if isinstance(type_, sqlalchemy.Numeric):
+        return encode_numeric
+    if isinstance(type_, sqlalchemy.DateTime):
+        return encode_timestamptz if type_.timezone else encode_timestamp
+    if isinstance(type_, sqlalchemy.Date):
+        return encode_date
+    if isinstance(type_, sqlalchemy.Time):
+        return None if type_.timezone else encode_time
+    if isinstance(type_, sqlalchemy.dialects.postgresql.UUID):
+        return encode_uuid
+    if isinstance(type_, sqlalchemy.String):
+        return encode_text
+    if isinstance(type_, sqlalchemy.LargeBinary):
+        return encode_bytea
+    return None
+
+
+def encode_rows(encoders, rows, chunk_size=1000):
+    """
+    Yield the binary COPY payload for `rows` in chunks of `chunk_size` rows.
+
+    Args:
+        encoders: One encoder per column, see `get_encoder()`.
+        rows: Iterable of value sequences in the order of `encoders`.
+    """
+    field_count = struct.pack('!h', len(encoders))
+    yield HEADER
+    chunk = []
+    for count, row in enumerate(rows, 1):
+        chunk.append(field_count)
+        for encode, value in zip(encoders, row):
+            chunk.append(NULL if value is None else encode(value))
+        if count % chunk_size == 0:
+            yield b''.join(chunk)
+            chunk = []
+    chunk.append(TRAILER)
+    yield b''.join(chunk)
+
+
+class CopyStream(io.RawIOBase):
+    """Read-only file-like object streaming chunks of a generator."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = memoryview(next(self._chunks))
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
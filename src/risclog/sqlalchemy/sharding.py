@@ -0,0 +1,230 @@
+"""Import records with several forked worker processes using `ModelCache`.
+
+The parent process preloads the shared reference models once and freezes
+them with `gc.freeze()`, so the forked workers share their memory
+copy-on-write. Records are partitioned across the workers by a key
+function. Every worker processes its records with its own copy of the cache
+and saves them on its own connection, level by level of a common save plan,
+so rows of one level written by any worker are committed before a worker
+writes rows referring to them.
+
+The import is therefore not atomic: if a worker fails while saving a
+level, the levels before it stay committed by every worker, while the
+failing level is rolled back.
+"""
+
+import gc
+import multiprocessing
+import os
+import queue
+import traceback
+
+import risclog.sqlalchemy.interfaces
+import transaction
+import zope.component
+
+
+class WorkerError(Exception):
+    """A worker process of a sharded import failed."""
+
+
+class ShardedImport:
+    """Driver running an import on a pool of forked worker processes.
+
+    Only available on platforms supporting the `fork` start method.
+    """
+
+    def __init__(
+        self,
+        cache_factory,
+        process,
+        shard_key,
+        workers=None,
+        reference_models=(),
+        batch_size=1000,
+    ):
+        """
+        Args:
+            cache_factory: Callable returning a new `ModelCache`. It is
+                           called once in the parent process, the workers
+                           use forked copies of the cache.
+            process: Callable called with a worker's cache and a record,
+                     which creates or changes instances using the cache.
+            shard_key: Callable returning the key of a record. Records with
+                       equal keys are processed by the same worker.
+            workers: Number of worker processes, defaults to the number of
+                     CPUs.
+            reference_models: Models preloaded in the parent process and
+                              shared by all workers. They must not be
+                              changed by `process`.
+            batch_size: Number of records sent to a worker at once.
+        """
+        self.cache_factory = cache_factory
+        self.process = process
+        self.shard_key = shard_key
+        self.workers = workers or os.cpu_count()
+        self.reference_models = reference_models
+        self.batch_size = batch_size
+
+    def run(self, records):
+        """
+        Process and save `records`.
+
+        Returns:
+            A list with the statistics of the cache of each worker, see
+            `ModelCache.stats()`.
+
+        Raises:
+            WorkerError: If a worker failed, with its traceback. Nothing is
+                         saved if a worker failed before saving, otherwise
+                         the levels saved before the failure stay
+                         committed.
+        """
+        cache = self.cache_factory()
+        if self.reference_models:
+            cache.preload(self.reference_models)
+        if cache.pending_models():
+            raise ValueError('The cache must not have pending changes.')
+        # Release the session's connection without expiring the preloaded
+        # instances and do not share pooled connections with the workers.
+        cache.session.close()
+        for engine in self._db_util().get_all_engines():
+            engine.dispose()
+
+        context = multiprocessing.get_context('fork')
+        barrier = context.Barrier(self.workers)
+        queues = [context.Queue(maxsize=4) for _ in range(self.workers)]
+        for queue_ in queues:
+            # Do not wait for batches a failed worker will never read.
+            queue_.cancel_join_thread()
+        pipes = [context.Pipe() for _ in range(self.workers)]
+        gc.collect()
+        gc.freeze()
+        try:
+            processes = [
+                context.Process(
+                    target=self._work,
+                    args=(cache, queues[i], pipes[i][1], barrier),
+                    daemon=True,
+                )
+                for i in range(self.workers)
+            ]
+            for worker in processes:
+                worker.start()
+            for _, child in pipes:
+                # Receiving from a dead worker raises EOFError.
+                child.close()
+            try:
+                self._distribute(records, queues, processes)
+                return self._coordinate(
+                    cache, [parent for parent, _ in pipes], barrier
+                )
+            finally:
+                for worker in processes:
+                    worker.join()
+        finally:
+            gc.unfreeze()
+
+    def _distribute(self, records, queues, processes):
+        """Send batches of `records` to the worker of their shard."""
+        batches = [[] for _ in queues]
+        for record in records:
+            shard = hash(self.shard_key(record)) % self.workers
+            batches[shard].append(record)
+            if len(batches[shard]) >= self.batch_size:
+                self._put(queues[shard], processes[shard], batches[shard])
+                batches[shard] = []
+        for shard, batch in enumerate(batches):
+            if batch:
+                self._put(queues[shard], processes[shard], batch)
+            self._put(queues[shard], processes[shard], None)
+
+    def _put(self, queue_, worker, item):
+        """Put `item` into the queue of `worker` unless it died."""
+        while True:
+            try:
+                queue_.put(item, timeout=1)
+                return
+            except queue.Full:
+                if not worker.is_alive():
+                    return
+
+    def _coordinate(self, cache, pipes, barrier):
+        """
+        Send the workers a common save plan for the models they changed and
+        collect their statistics.
+        """
+        models, errors = {}, []
+        for pipe in pipes:
+            status, value = self._recv(pipe)
+            if status == 'error':
+                errors.append(value)
+            else:
+                models.update(value)
+        plan = None if errors else cache.save_plan(models)
+        for pipe in pipes:
+            if not pipe.closed:
+                pipe.send(plan)
+
+        stats = []
+        for pipe in pipes:
+            if pipe.closed:
+                continue
+            status, value = self._recv(pipe)
+            if status == 'error':
+                errors.append(value)
+            elif status == 'ok':
+                stats.append(value)
+        if errors:
+            barrier.abort()
+            raise WorkerError('\n'.join(errors))
+        return stats
+
+    def _recv(self, pipe):
+        """
+        Receive a status message from a worker, closing the pipe on
+        errors.
+        """
+        try:
+            status, value = pipe.recv()
+        except EOFError:
+            status, value = 'error', 'Worker exited unexpectedly.'
+        if status == 'error':
+            pipe.close()
+        return status, value
+
+    def _work(self, cache, queue_, pipe, barrier):
+        """Process the records of one shard and save them."""
+        try:
+            for engine in self._db_util().get_all_engines():
+                engine.dispose(close=False)
+            # Reserved sequence values were copied from the parent.
+            cache.discard_reserved_sequences()
+            for batch in iter(queue_.get, None):
+                for record in batch:
+                    self.process(cache, record)
+            pipe.send(('ok', cache.pending_models()))
+            plan = pipe.recv()
+            if plan is None:
+                transaction.abort()
+                pipe.send(('aborted', None))
+                return
+            cache.save_changes(
+                plan=plan, after_level=lambda level: barrier.wait()
+            )
+            transaction.commit()
+            pipe.send(('ok', cache.stats()))
+        except Exception:
+            barrier.abort()
+            transaction.abort()
+            try:
+                pipe.send(('error', traceback.format_exc()))
+            except Exception:
+                pass
+        finally:
+            pipe.close()
+
+    def _db_util(self):
+        return zope.component.getUtility(
+            risclog.sqlalchemy.interfaces.IDatabase
+        )
@@ -0,0 +1,250 @@
+"""Persist preloaded model data to local snapshot files.
+
+A snapshot file consists of a magic string, a length-prefixed header holding
+the fingerprint the snapshot was taken with and a body holding a list of
+values per column and the row positions of the index keys. Values are
+stored with a type tag in a plain binary layout, so reading a snapshot
+never executes code. Only the types returned for common column types are
+supported, see `UnsupportedTypeError`.
+"""
+
+import datetime
+import decimal
+import os
+import struct
+import tempfile
+import uuid
+
+MAGIC = b'RLSNAP2\n'
+
+_length = struct.Struct('!Q')
+_count = struct.Struct('!I')
+_int8 = struct.Struct('!q')
+_float8 = struct.Struct('!d')
+_timedelta = struct.Struct('!iiI')
+
+
+class UnsupportedTypeError(TypeError):
+    """A value cannot be stored in a snapshot."""
+
+
+class Snapshot:
+    """Column values of preloaded rows and the positions of their keys.
+
+    Attributes:
+        columns: Dictionary mapping attribute names to lists of values, one
+                 per row.
+        indices: Dictionary mapping attribute keys to dictionaries mapping
+                 index keys to a list of row positions, or to a single row
+                 position for unique indices.
+    """
+
+    def __init__(self, columns, indices):
+        self.columns = columns
+        self.indices = indices
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()), ()))
+
+
+def _text(value):
+    data = value.encode('utf-8')
+    return _count.pack(len(data)) + data
+
+
+def _encode_int(value):
+    try:
+        return b'i' + _int8.pack(value)
+    except struct.error:
+        return b'I' + _text(str(value))
+
+
+def _encode_timedelta(value):
+    return b'r' + _timedelta.pack(
+        value.days, value.seconds, value.microseconds
+    )
+
+
+def _encode_tuple(value):
+    return b'(' + _count.pack(len(value)) + b''.join(map(_encode, value))
+
+
+_encoders = {
+    type(None): lambda value: b'N',
+    bool: lambda value: b'T' if value else b'F',
+    int: _encode_int,
+    float: lambda value: b'f' + _float8.pack(value),
+    str: lambda value: b's' + _text(value),
+    bytes: lambda value: b'b' + _count.pack(len(value)) + value,
+    decimal.Decimal: lambda value: b'n' + _text(str(value)),
+    datetime.datetime: lambda value: b'D' + _text(value.isoformat()),
+    datetime.date: lambda value: b'd' + _text(value.isoformat()),
+    datetime.time: lambda value: b't' + _text(value.isoformat()),
+    datetime.timedelta: _encode_timedelta,
+    uuid.UUID: lambda value: b'u' + value.bytes,
+    tuple: _encode_tuple,
+}
+
+
+def _encode(value):
+    """
+    Return `value` as its type tag followed by its data.
+
+    Raises:
+        UnsupportedTypeError: The type of `value` cannot be stored.
+    """
+    encode = _encoders.get(type(value))
+    if encode is None:
+        raise UnsupportedTypeError(
+            f'Cannot store {type(value).__name__} values in a snapshot.'
+        )
+    return encode(value)
+
+
+class _Reader:
+    """Decode values from the bytes of a snapshot."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+
+    def take(self, size):
+        start, end = self.offset, self.offset + size
+        if end > len(self.data):
+            raise ValueError('Snapshot is truncated.')
+        chunk = self.data[start:end]
+        self.offset = end
+        return chunk
+
+    def unpack(self, packer):
+        return packer.unpack(self.take(packer.size))
+
+    def count(self):
+        return self.unpack(_count)[0]
+
+    def text(self):
+        return self.take(self.count()).decode('utf-8')
+
+    def value(self):
+        return _decoders[self.take(1)](self)
+
+
+_decoders = {
+    b'N': lambda reader: None,
+    b'T': lambda reader: True,
+    b'F': lambda reader: False,
+    b'i': lambda reader: reader.unpack(_int8)[0],
+    b'I': lambda reader: int(reader.text()),
+    b'f': lambda reader: reader.unpack(_float8)[0],
+    b's': lambda reader: reader.text(),
+    b'b': lambda reader: reader.take(reader.count()),
+    b'n': lambda reader: decimal.Decimal(reader.text()),
+    b'D': lambda reader: datetime.datetime.fromisoformat(reader.text()),
+    b'd': lambda reader: datetime.date.fromisoformat(reader.text()),
+    b't': lambda reader: datetime.time.fromisoformat(reader.text()),
+    b'r': lambda reader: datetime.timedelta(*reader.unpack(_timedelta)),
+    b'u': lambda reader: uuid.UUID(bytes=reader.take(16)),
+    b'(': lambda reader: tuple(reader.value() for _ in range(reader.count())),
+}
+
+
+def _encode_body(snapshot):
+    """Yield the encoded columns and indices of `snapshot` in chunks."""
+    yield _count.pack(len(snapshot.columns)) + _length.pack(len(snapshot))
+    for name, values in snapshot.columns.items():
+        yield _text(name) + b''.join(map(_encode, values))
+    yield _count.pack(len(snapshot.indices))
+    for attribute_key, entries in snapshot.indices.items():
+        # Unique indices map keys to a single position.
+        unique = all(type(p) is int for p in entries.values())
+        yield _encode(attribute_key) + _encode(unique)
+        yield _length.pack(len(entries))
+        for key, positions in entries.items():
+            if unique:
+                yield _encode(key) + _length.pack(positions)
+            else:
+                yield _encode(key) + _count.pack(len(positions)) + (
+                    struct.pack(f'!{len(positions)}Q', *positions)
+                )
+
+
+def _decode_body(reader):
+    """Return the `Snapshot` encoded by `_encode_body()`."""
+    column_count = reader.count()
+    (row_count,) = reader.unpack(_length)
+    columns = {}
+    for _ in range(column_count):
+        name = reader.text()
+        columns[name] = [reader.value() for _ in range(row_count)]
+    indices = {}
+    for _ in range(reader.count()):
+        attribute_key = reader.value()
+        unique = reader.value()
+        (entry_count,) = reader.unpack(_length)
+        entries = indices[attribute_key] = {}
+        for _ in range(entry_count):
+            key = reader.value()
+            if unique:
+                (entries[key],) = reader.unpack(_length)
+            else:
+                count = reader.count()
+                entries[key] = list(reader.unpack(struct.Struct(f'!{count}Q')))
+    if reader.offset != len(reader.data):
+        raise ValueError('Snapshot has trailing data.')
+    return Snapshot(columns, indices)
+
+
+def write(path, fingerprint, snapshot):
+    """
+    Write `snapshot` taken with `fingerprint` to `path`.
+
+    The file is replaced atomically, so concurrent readers either see the
+    old or the new snapshot.
+
+    Raises:
+        UnsupportedTypeError: A value of `snapshot` or `fingerprint` cannot
+            be stored. No file is written.
+    """
+    header = _encode(fingerprint)
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(MAGIC)
+            file.write(_length.pack(len(header)))
+            file.write(header)
+            for chunk in _encode_body(snapshot):
+                file.write(chunk)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read(path, fingerprint):
+    """
+    Read the snapshot at `path` if it was taken with `fingerprint`.
+
+    The fingerprint is compared in its encoded form without decoding the
+    header.
+
+    Returns:
+        A `Snapshot` or None if the file does not exist, is not a snapshot,
+        is truncated or is outdated.
+    """
+    try:
+        header = _encode(fingerprint)
+        file = open(path, 'rb')
+    except (FileNotFoundError, UnsupportedTypeError):
+        return None
+    with file:
+        if file.read(len(MAGIC)) != MAGIC:
+            return None
+        try:
+            (length,) = _length.unpack(file.read(_length.size))
+            if file.read(length) != header:
+                return None
+            return _decode_body(_Reader(file.read()))
+        except (KeyError, OverflowError, ValueError, struct.error):
+            return None
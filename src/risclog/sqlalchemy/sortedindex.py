@@ -0,0 +1,133 @@
+"""Static sorted indices for range, prefix and interval lookups."""
+
+import bisect
+import operator
+
+
+class SortedIndex:
+    """Values sorted by a key, supporting range and prefix lookups.
+
+    Keys must be mutually comparable, None keys are not allowed.
+    """
+
+    def __init__(self, items):
+        """
+        Args:
+            items: Iterable of (key, value) tuples. Values with equal keys
+                   keep their order.
+        """
+        items = sorted(items, key=operator.itemgetter(0))
+        self.keys = [key for key, _ in items]
+        self.values = [value for _, value in items]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def insert(self, key, value):
+        """Add `value` with `key` after the values with equal keys."""
+        position = bisect.bisect_right(self.keys, key)
+        self.keys.insert(position, key)
+        self.values.insert(position, value)
+
+    def range(
+        self, lower=None, upper=None, include_lower=True, include_upper=True
+    ):
+        """
+        Return the values whose keys are between `lower` and `upper`,
+        ordered by key. A bound of None is open.
+        """
+        if lower is None:
+            start = 0
+        elif include_lower:
+            start = bisect.bisect_left(self.keys, lower)
+        else:
+            start = bisect.bisect_right(self.keys, lower)
+        if upper is None:
+            end = len(self.keys)
+        elif include_upper:
+            end = bisect.bisect_right(self.keys, upper)
+        else:
+            end = bisect.bisect_left(self.keys, upper)
+        return self.values[start:end]
+
+    def prefix(self, prefix):
+        """Return the values whose (string) keys start with `prefix`."""
+        start = end = bisect.bisect_left(self.keys, prefix)
+        while end < len(self.keys) and self.keys[end].startswith(prefix):
+            end += 1
+        return self.values[start:end]
+
+
+class IntervalIndex:
+    """Values of intervals with an optional open upper bound, supporting
+    lookups of the intervals containing a point.
+
+    Intervals are sorted by their lower bound and grouped into blocks
+    remembering the maximum upper bound, so blocks ending before a point
+    are skipped as a whole.
+    """
+
+    block_size = 64
+
+    def __init__(self, items):
+        """
+        Args:
+            items: Iterable of (left, right, value) tuples. A `right` of
+                   None means the interval is not bounded above, a `left`
+                   of None is not allowed.
+        """
+        items = sorted(items, key=operator.itemgetter(0))
+        self.lefts = [left for left, _, _ in items]
+        self.rights = [right for _, right, _ in items]
+        self.values = [value for _, _, value in items]
+        # Maximum upper bound per block or None if a block is unbounded.
+        self.block_maxima = []
+        self._update_block_maxima(0)
+
+    def __len__(self):
+        return len(self.values)
+
+    def insert(self, left, right, value):
+        """
+        Add the interval from `left` to `right` with `value` after the
+        intervals with equal lower bounds.
+        """
+        position = bisect.bisect_right(self.lefts, left)
+        self.lefts.insert(position, left)
+        self.rights.insert(position, right)
+        self.values.insert(position, value)
+        self._update_block_maxima(position)
+
+    def _update_block_maxima(self, position):
+        """
+        Compute the maxima of the block containing `position` and the
+        following ones.
+        """
+        first = position // self.block_size
+        del self.block_maxima[first:]
+        for start in range(
+            first * self.block_size, len(self.rights), self.block_size
+        ):
+            end = start + self.block_size
+            block = self.rights[start:end]
+            self.block_maxima.append(None if None in block else max(block))
+
+    def containing(self, point):
+        """
+        Return the values of the intervals containing `point`, ordered by
+        their lower bound. Both bounds are inclusive, like `in_interval()`
+        of `risclog.sqlalchemy.functions`.
+        """
+        end = bisect.bisect_right(self.lefts, point)
+        result = []
+        for block, maximum in enumerate(self.block_maxima):
+            start = block * self.block_size
+            if start >= end:
+                break
+            if maximum is not None and maximum < point:
+                continue
+            for i in range(start, min(start + self.block_size, end)):
+                right = self.rights[i]
+                if right is None or point <= right:
+                    result.append(self.values[i])
+        return result
@@ -1,9 +1,21 @@
+import datetime
+import decimal
+import gc
+import tracemalloc
+import uuid
+from unittest import mock
+
 import pytest
 import sqlalchemy
+import sqlalchemy.dialects.postgresql
+import transaction
 from sqlalchemy import Column, ForeignKey, Integer, String
 
+from .. import cache as cache_module
 from .. import model
+from .. import snapshot as snapshot_module
 from ..cache import ModelCache, MultipleObjectsFoundException
+from ..sharding import ShardedImport, WorkerError
 
 
 class TestObject(model.ObjectBase):
@@ -33,6 +45,52 @@ class SequenceModel(Object):
     titel = Column(String)
 
 
+class TypedModel(Object):
+    id = Column(sqlalchemy.BigInteger, primary_key=True)
+    count = Column(sqlalchemy.SmallInteger, default=7)
+    amount = Column(sqlalchemy.Numeric(12, 4))
+    ratio = Column(sqlalchemy.Float)
+    active = Column(sqlalchemy.Boolean)
+    created = Column(sqlalchemy.DateTime)
+    changed = Column(sqlalchemy.DateTime(timezone=True))
+    day = Column(sqlalchemy.Date)
+    key = Column(sqlalchemy.dialects.postgresql.UUID(as_uuid=True))
+    titel = Column(sqlalchemy.Text)
+
+
+class ValidityModel(Object):
+    id = Column(Integer, primary_key=True)
+    key = Column(String(10))
+    valid_from = Column(sqlalchemy.Date)
+    valid_to = Column(sqlalchemy.Date)
+
+
+class ParentModel(Object):
+    id = Column(Integer, primary_key=True)
+    active_children = sqlalchemy.orm.relation(
+        'ChildModel',
+        primaryjoin='and_(ParentModel.id == ChildModel.parent_id, '
+        'ChildModel.active)',
+        viewonly=True,
+    )
+    ordered_children = sqlalchemy.orm.relation(
+        'ChildModel', order_by='ChildModel.id.desc()', viewonly=True
+    )
+
+
+class ChildModel(Object):
+    id = Column(Integer, primary_key=True)
+    parent_id = Column(Integer, ForeignKey('parentmodel.id'))
+    parent = sqlalchemy.orm.relation('ParentModel', backref='children')
+    active = Column(sqlalchemy.Boolean, default=True)
+
+
+class UpsertModel(Object):
+    id = Column(Integer, primary_key=True)
+    key = Column(String(10), unique=True)
+    titel = Column(String)
+
+
 @pytest.fixture(scope='session')
 def db(database_3):
     database_3.create_all('db3')
@@ -44,6 +102,7 @@ def __create_cache(db, extra_settings=None):
         'PlainModel',
         'LinkedModel',
         'SequenceModel',
+        'TypedModel',
     ]
     MODEL_SEQUENCES = {
         'Model1': (('id', 'sequencemodel_id_seq'),),
@@ -70,6 +129,14 @@ def copy_cache(db):
     yield __create_cache(db, {'use_copy': True})
 
 
+@pytest.fixture(scope='function')
+def cache_factory(db):
+    def factory(**extra_settings):
+        return __create_cache(db, extra_settings)
+
+    yield factory
+
+
 class TestFindGet:
     def test_find_uncached_object(self, cache):
         svg = PlainModel.create(
@@ -160,6 +227,51 @@ class TestFindGet:
         )
 
 
+class TestBatchLookup:
+    def test_find_many(self, cache):
+        svg1 = PlainModel.create(id='1', titel='a')
+        svg2 = PlainModel.create(id='2', titel='a')
+
+        assert [[svg1, svg2], [], [svg2]] == [
+            *cache.find_many(PlainModel, ('titel',), [('a',), ('b',)]),
+            *cache.find_many(PlainModel, ('titel', 'id'), [('a', '2')]),
+        ]
+
+    def test_get_or_create_many(self, db, cache):
+        svg1 = PlainModel.create(id='1', titel='a')
+
+        result = cache.get_or_create_many(
+            PlainModel, ('id', 'titel'), [('2', 'b'), ('1', 'a'), ('2', 'b')]
+        )
+
+        assert svg1 is result[1]
+        assert result[0] is result[2]
+        assert ('2', 'b') == (result[0].id, result[0].titel)
+        assert {'PlainModel': {'new': 1, 'dirty': 0}} == cache.pending_counts()
+
+    def test_get_or_create_many_multiple_objects(self, cache):
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='a')
+
+        with pytest.raises(MultipleObjectsFoundException):
+            cache.get_or_create_many(PlainModel, ('titel',), [('a',)])
+
+    def test_find_many_loads_missing_keys_at_once(self, cache_factory):
+        cache = cache_factory(
+            load_on_miss=True, unique_indices={'PlainModel': (('id',),)}
+        )
+        svg1 = PlainModel.create(id='1')
+        svg2 = PlainModel.create(id='2')
+
+        with mock.patch.object(
+            cache, '_load_keys', wraps=cache._load_keys
+        ) as load_keys:
+            result = cache.find_many(PlainModel, ('id',), [('1',), ('2',)])
+
+        assert [[svg1], [svg2]] == result
+        load_keys.assert_called_once()
+
+
 class TestCreate:
     def test_create_object(self, db, cache):
         cache.create(
@@ -180,6 +292,206 @@ class TestCreate:
         assert 1 == PlainModel.query().count()
 
 
+class TestBinaryCopy:
+    def test_create_objects_with_binary_copy(self, db, cache_factory):
+        cache = cache_factory(use_copy=True, copy_format='binary')
+        key = uuid.uuid4()
+        changed = datetime.datetime(
+            2024, 5, 1, 12, 30, tzinfo=datetime.timezone.utc
+        )
+        cache.create(
+            TypedModel,
+            id=1,
+            amount=decimal.Decimal('-1234.5678'),
+            ratio=0.5,
+            active=True,
+            created=datetime.datetime(1999, 12, 31, 23, 59, 59, 123),
+            changed=changed,
+            day=datetime.date(2024, 2, 29),
+            key=key,
+            titel='Ä "quoted", \\N\n',
+        )
+        cache.create(TypedModel, id=2)
+        cache.save_changes(db.session)
+
+        first, second = TypedModel.query().order_by(TypedModel.id).all()
+        assert 7 == first.count
+        assert decimal.Decimal('-1234.5678') == first.amount
+        assert 0.5 == first.ratio
+        assert first.active is True
+        assert (
+            datetime.datetime(1999, 12, 31, 23, 59, 59, 123) == first.created
+        )
+        assert changed == first.changed
+        assert datetime.date(2024, 2, 29) == first.day
+        assert key == first.key
+        assert 'Ä "quoted", \\N\n' == first.titel
+        assert None is second.amount
+        assert None is second.titel
+
+    @pytest.fixture
+    def berlin(self, db):
+        db.session.execute("SET TimeZone='Europe/Berlin'")
+        yield
+        db.session.execute('RESET TimeZone')
+
+    @pytest.mark.parametrize('copy_format', ['csv', 'binary'])
+    def test_naive_values_use_session_time_zone(
+        self, db, cache_factory, berlin, copy_format
+    ):
+        cache = cache_factory(use_copy=True, copy_format=copy_format)
+        cache.create(
+            TypedModel, id=1, changed=datetime.datetime(2020, 5, 1, 12)
+        )
+        cache.save_changes(db.session)
+
+        assert (
+            datetime.datetime(2020, 5, 1, 10, tzinfo=datetime.timezone.utc)
+            == db.session.query(TypedModel.changed).scalar()
+        )
+
+    @pytest.mark.parametrize('copy_format', ['csv', 'binary'])
+    def test_aware_values_drop_time_zone_for_naive_columns(
+        self, db, cache_factory, berlin, copy_format
+    ):
+        cache = cache_factory(use_copy=True, copy_format=copy_format)
+        cache.create(
+            TypedModel,
+            id=1,
+            created=datetime.datetime(
+                2020,
+                5,
+                1,
+                12,
+                tzinfo=datetime.timezone(datetime.timedelta(hours=5)),
+            ),
+        )
+        cache.save_changes(db.session)
+
+        assert (
+            datetime.datetime(2020, 5, 1, 12)
+            == db.session.query(TypedModel.created).scalar()
+        )
+
+    def test_unsupported_types_fall_back_to_csv(self, db, cache_factory):
+        cache = cache_factory(use_copy=True, copy_format='binary')
+        cache.create(PlainModel, id='1')
+
+        with pytest.MonkeyPatch.context() as mp:
+            mp.setattr(
+                'risclog.sqlalchemy.pgcopy.get_encoder', lambda type_: None
+            )
+            cache.save_changes(db.session)
+
+        assert 1 == PlainModel.query().count()
+
+
+class TestCopyUpdate:
+    @pytest.mark.parametrize('copy_format', ['csv', 'binary'])
+    def test_update_with_copy(self, db, cache_factory, copy_format):
+        cache = cache_factory(copy_updates=True, copy_format=copy_format)
+        PlainModel.create(id='1', titel='old')
+        PlainModel.create(id='2', titel='old')
+        PlainModel.create(id='3', titel='old')
+        cache.get(PlainModel, id='1').titel = 'new'
+        cache.get(PlainModel, id='2').titel = None
+        cache.save_changes(db.session)
+
+        assert [('1', 'new'), ('2', None), ('3', 'old')] == (
+            db.session.query(PlainModel.id, PlainModel.titel)
+            .order_by(PlainModel.id)
+            .all()
+        )
+
+    def test_update_primary_key_with_copy_updates(self, db, cache_factory):
+        cache = cache_factory(copy_updates=True)
+        PlainModel.create(id='1', titel='old')
+        svg = cache.get(PlainModel, id='1')
+        svg.id = '2'
+        cache.save_changes(db.session)
+
+        assert [('2', 'old')] == db.session.query(
+            PlainModel.id, PlainModel.titel
+        ).all()
+
+    def test_updated_objects_are_not_flushed_again(self, db, cache_factory):
+        cache = cache_factory(copy_updates=True)
+        PlainModel.create(id='1', titel='old')
+        svg = cache.get(PlainModel, id='1')
+        svg.titel = 'new'
+        cache.save_changes(db.session)
+
+        assert svg not in db.session.dirty
+
+
+class TestUpsert:
+    @pytest.fixture
+    def upsert_cache(self, cache_factory):
+        def factory(**extra_settings):
+            settings = {
+                'save_order': None,
+                'sequences': {'UpsertModel': (('id', 'upsertmodel_id_seq'),)},
+                'preload_models': False,
+                'upsert_models': {'UpsertModel': ('key',)},
+            }
+            settings.update(extra_settings)
+            return cache_factory(**settings)
+
+        yield factory
+
+    def query(self, db):
+        return (
+            db.session.query(UpsertModel.key, UpsertModel.titel)
+            .order_by(UpsertModel.key)
+            .all()
+        )
+
+    @pytest.mark.parametrize('copy_format', ['csv', 'binary'])
+    def test_existing_keys_are_updated(self, db, upsert_cache, copy_format):
+        cache = upsert_cache(copy_format=copy_format)
+        UpsertModel.create(id=100, key='a', titel='old')
+        cache.create(UpsertModel, key='a', titel='new')
+        cache.create(UpsertModel, key='b', titel='new')
+        cache.save_changes(db.session)
+
+        assert [('a', 'new'), ('b', 'new')] == self.query(db)
+        assert (
+            100 == db.session.query(UpsertModel.id).filter_by(key='a').scalar()
+        )
+
+    def test_existing_rows_are_kept(self, db, upsert_cache):
+        cache = upsert_cache(upsert_update=False)
+        UpsertModel.create(id=100, key='a', titel='old')
+        cache.create(UpsertModel, key='a', titel='new')
+        cache.save_changes(db.session)
+
+        assert [('a', 'old')] == self.query(db)
+
+    def test_last_duplicate_wins(self, db, upsert_cache):
+        cache = upsert_cache()
+        cache.create(UpsertModel, key='a', titel='first')
+        cache.create(UpsertModel, key='a', titel='last')
+        cache.save_changes(db.session)
+
+        assert [('a', 'last')] == self.query(db)
+
+    def test_primary_keys_are_resolved(self, db, upsert_cache):
+        cache = upsert_cache(
+            upsert_returning=True,
+            sequence_block_size=10,
+            unique_indices={'UpsertModel': (('id',),)},
+        )
+        UpsertModel.create(id=100, key='a', titel='old')
+        existing = cache.create(UpsertModel, key='a')
+        new = cache.create(UpsertModel, key='b')
+        cache._flush_changes()
+
+        assert 100 == existing.id
+        assert new.id != 100
+        assert existing is cache.get(UpsertModel, id=100)
+        assert new is cache.get(UpsertModel, id=new.id)
+
+
 class TestFlush:
     def test_creation(self, db, cache):
         svg = cache.create(
@@ -246,6 +558,190 @@ class TestFlush:
         assert sequence_model.id == partner.sequence_model_id
 
 
+class TestFlushPlan:
+    def test_explicit_save_order_is_serial(self, cache):
+        assert [
+            ['PlainModel'],
+            ['LinkedModel'],
+            ['SequenceModel'],
+            ['TypedModel'],
+        ] == cache.save_plan()
+
+    def test_levels_follow_foreign_keys(self, cache_factory):
+        cache = cache_factory(save_order=None)
+        sequence_model = cache.create(SequenceModel, id=1)
+        cache.create(LinkedModel, id='1', sequence_model=sequence_model)
+        cache.create(PlainModel, id='1')
+        cache.create(TypedModel, id=1)
+
+        assert [
+            ['PlainModel', 'SequenceModel', 'TypedModel'],
+            ['LinkedModel'],
+        ] == cache.save_plan()
+
+    def test_only_pending_models_are_planned(self, cache_factory):
+        cache = cache_factory(save_order=None)
+        cache.get(PlainModel, id='1')
+        cache.create(TypedModel, id=1)
+
+        assert [['TypedModel']] == cache.save_plan()
+
+    def test_parallel_copy(self, db, cache_factory):
+        cache = cache_factory(save_order=None, use_copy=True, flush_workers=2)
+        sequence_model = cache.create(SequenceModel, id=1, titel='seq')
+        cache.create(LinkedModel, id='1', sequence_model=sequence_model)
+        cache.create(PlainModel, id='1')
+        cache.create(TypedModel, id=1)
+        with mock.patch.object(
+            cache, '_save_by_parallel_copy', wraps=cache._save_by_parallel_copy
+        ) as parallel:
+            cache.save_changes(db.session)
+
+        parallel.assert_called_once_with(
+            ['PlainModel', 'SequenceModel', 'TypedModel']
+        )
+        assert 1 == PlainModel.query().count()
+        assert 1 == TypedModel.query().count()
+        assert 'seq' == SequenceModel.query().one().titel
+        assert 1 == LinkedModel.query().one().sequence_model_id
+
+    def test_parallel_copy_rolls_back_level(self, db, cache_factory):
+        cache = cache_factory(save_order=None, use_copy=True, flush_workers=2)
+        cache.create(PlainModel, id='1')
+        cache.create(TypedModel, id=1, count='no number')
+
+        with pytest.raises(ValueError):
+            cache.save_changes(db.session)
+
+        assert 0 == PlainModel.query().count()
+        assert 0 == TypedModel.query().count()
+
+
+class TestSequences:
+    SEQUENCES = {
+        'SequenceModel': (('id', 'sequencemodel_id_seq'),),
+        'TypedModel': (('id', 'sequencemodel_id_seq'),),
+    }
+
+    def test_all_sequences_fetched_at_once(self, db, cache_factory):
+        cache = cache_factory(sequences=self.SEQUENCES)
+        cache.create(SequenceModel)
+        cache.create(SequenceModel, id=-1)
+        cache.create(TypedModel)
+        with mock.patch.object(
+            cache, '_next_sequence_values', wraps=cache._next_sequence_values
+        ) as next_values:
+            cache.save_changes(db.session)
+
+        next_values.assert_called_once_with({'sequencemodel_id_seq': 2})
+        ids = {x.id for x in SequenceModel.query()}
+        assert -1 in ids
+        assert 3 == len(ids | {TypedModel.query().one().id})
+
+    def test_blocks_assigned_on_create(self, db, cache_factory):
+        cache = cache_factory(sequences=self.SEQUENCES, sequence_block_size=10)
+        with mock.patch.object(
+            cache, '_next_sequence_values', wraps=cache._next_sequence_values
+        ) as next_values:
+            instances = [cache.create(SequenceModel) for _ in range(12)]
+            instances += cache.get_or_create_many(
+                TypedModel, ('titel',), [('a',), ('b',)]
+            )
+
+        assert 2 == next_values.call_count
+        ids = [x.id for x in instances]
+        assert None not in ids
+        assert len(ids) == len(set(ids))
+        assert instances[0] is cache.get(SequenceModel, id=ids[0])
+
+        cache.save_changes(db.session)
+        assert 12 == SequenceModel.query().count()
+        assert 2 == TypedModel.query().count()
+
+    def test_foreign_keys_known_on_create(self, db, cache_factory):
+        cache = cache_factory(sequences=self.SEQUENCES, sequence_block_size=10)
+        sequence_model = cache.create(SequenceModel)
+        linked = cache.create(
+            LinkedModel, id='1', sequence_model=sequence_model
+        )
+
+        assert sequence_model.id == linked.sequence_model_id
+        assert [linked] == cache.find(
+            LinkedModel, sequence_model_id=sequence_model.id
+        )
+
+
+class TestChangeTracking:
+    def test_pending_counts(self, cache):
+        PlainModel.create(id='1')
+        PlainModel.create(id='2')
+        cache.create(PlainModel, id='3')
+        cache.get(PlainModel, id='1').titel = 'changed'
+
+        assert {'PlainModel': {'new': 1, 'dirty': 1}} == cache.pending_counts()
+
+    def test_save_changes_only_saves_changed_instances(
+        self, db, cache, monkeypatch
+    ):
+        saved = []
+        monkeypatch.setattr(
+            db.session,
+            'bulk_save_objects',
+            lambda objects: saved.extend(objects),
+        )
+        PlainModel.create(id='1')
+        PlainModel.create(id='2')
+        svg = cache.get(PlainModel, id='1')
+        svg.titel = 'changed'
+        new = cache.create(PlainModel, id='3')
+        cache.save_changes(db.session)
+
+        assert [new, svg] == saved
+        assert {} == cache.pending_counts()
+
+    def test_only_indexed_attributes_are_listened_to(self, db, cache):
+        PlainModel.create(id='1')
+        cache.get(PlainModel, id='1')
+
+        handler = cache._instance_change_handler
+        assert sqlalchemy.event.contains(PlainModel.id, 'set', handler)
+        assert not sqlalchemy.event.contains(PlainModel.titel, 'set', handler)
+
+        cache.find(PlainModel, titel=None)
+        assert sqlalchemy.event.contains(PlainModel.titel, 'set', handler)
+
+        cache.save_changes(db.session)
+        assert not sqlalchemy.event.contains(PlainModel.id, 'set', handler)
+        assert not sqlalchemy.event.contains(PlainModel.titel, 'set', handler)
+
+    def test_listeners_do_not_pile_up(self, db, cache):
+        PlainModel.create(id='1')
+        listeners = len(PlainModel.id.dispatch.set)
+        for _ in range(3):
+            cache.get(PlainModel, id='1')
+            assert listeners + 1 == len(PlainModel.id.dispatch.set)
+            cache.save_changes(db.session)
+            assert listeners == len(PlainModel.id.dispatch.set)
+
+        cache.get(PlainModel, id='1')
+        cache.clear()
+        assert listeners == len(PlainModel.id.dispatch.set)
+
+    def test_changes_of_foreign_instances_are_ignored(self, db, cache):
+        PlainModel.create(id='1')
+        svg = cache.get(PlainModel, id='1')
+        cache.find(PlainModel, titel=None)
+        foreign = PlainModel.create(id='2')
+
+        with mock.patch.object(cache, '_drop_sorted_indices') as drop:
+            foreign.titel = 'changed'
+        drop.assert_not_called()
+        svg.titel = 'changed'
+
+        assert {'PlainModel': {'new': 0, 'dirty': 1}} == cache.pending_counts()
+        assert {'PlainModel': {svg: None}} == cache._dirty_instances
+
+
 class TestIndex:
     def test_find_populates_indices(self, cache):
         svg = PlainModel.create(
@@ -258,10 +754,10 @@ class TestIndex:
         cache.find(PlainModel, id=svg.id, titel='')
 
         assert [svg] == cache._cached_instances['PlainModel']
-        assert [svg] == cache._indices['PlainModel'][('id',)][(svg.id,)]
-        assert [svg] == cache._indices['PlainModel'][('id', 'titel')][
-            (svg.id, svg.titel)
-        ]
+        assert [svg] == list(cache._indices['PlainModel'][('id',)][(svg.id,)])
+        assert [svg] == list(
+            cache._indices['PlainModel'][('id', 'titel')][(svg.id, svg.titel)]
+        )
 
     def test_get_populates_indices(self, cache):
         svg = PlainModel.create(
@@ -274,10 +770,10 @@ class TestIndex:
         cache.get(PlainModel, id=svg.id, titel='')
 
         assert [svg] == cache._cached_instances['PlainModel']
-        assert [svg] == cache._indices['PlainModel'][('id',)][(svg.id,)]
-        assert [svg] == cache._indices['PlainModel'][('id', 'titel')][
-            (svg.id, svg.titel)
-        ]
+        assert [svg] == list(cache._indices['PlainModel'][('id',)][(svg.id,)])
+        assert [svg] == list(
+            cache._indices['PlainModel'][('id', 'titel')][(svg.id, svg.titel)]
+        )
 
     def test_attribute_changes_update_indices(self, cache):
         old_id, new_id = '1', '2'
@@ -292,7 +788,7 @@ class TestIndex:
         svg.id = new_id
 
         assert [svg] == cache._cached_instances['PlainModel']
-        assert [svg] == cache._indices['PlainModel'][('id',)][(new_id,)]
+        assert [svg] == list(cache._indices['PlainModel'][('id',)][(new_id,)])
         assert (old_id,) not in cache._indices['PlainModel'][('id',)]
 
     def test_attribute_changes_update_indices2(self, cache):
@@ -307,5 +803,1110 @@ class TestIndex:
         svg1.titel = new_titel
 
         assert [svg1, svg2] == cache._cached_instances['PlainModel']
-        assert [svg1] == cache._indices['PlainModel'][('titel',)][(new_titel,)]
-        assert [svg2] == cache._indices['PlainModel'][('titel',)][(old_titel,)]
+        assert [svg1] == list(
+            cache._indices['PlainModel'][('titel',)][(new_titel,)]
+        )
+        assert [svg2] == list(
+            cache._indices['PlainModel'][('titel',)][(old_titel,)]
+        )
+
+
+class TestUniqueIndex:
+    @pytest.fixture(scope='function')
+    def unique_cache(self, cache_factory):
+        return cache_factory(unique_indices={'PlainModel': (('id',),)})
+
+    def test_unique_index_stores_instance(self, unique_cache):
+        svg = PlainModel.create(id='1')
+
+        assert svg == unique_cache.get(PlainModel, id='1')
+        assert [svg] == unique_cache.find(PlainModel, id='1')
+        assert svg is unique_cache._indices['PlainModel'][('id',)][('1',)]
+
+    def test_unique_index_is_updated_on_change(self, unique_cache):
+        svg = unique_cache.create(PlainModel, id='1')
+        unique_cache.get(PlainModel, id='1')
+
+        svg.id = '2'
+
+        assert None is unique_cache.get(PlainModel, id='1')
+        assert svg is unique_cache.get(PlainModel, id='2')
+
+    def test_duplicate_key_raises(self, unique_cache):
+        PlainModel.create(id='1')
+        unique_cache.get(PlainModel, id='1')
+
+        with pytest.raises(cache_module.DuplicateKeyException):
+            unique_cache.create(PlainModel, id='1')
+
+    def test_duplicate_key_leaves_cache_unchanged(self, db, unique_cache):
+        svg = unique_cache.create(PlainModel, id='1')
+        pending_counts = unique_cache.pending_counts()
+
+        with pytest.raises(cache_module.DuplicateKeyException):
+            unique_cache.create(PlainModel, id='1', titel='duplicate')
+
+        assert pending_counts == unique_cache.pending_counts()
+        assert [svg] == unique_cache._get_model_cache(PlainModel)
+        unique_cache.save_changes(db.session)
+        assert [('1', None)] == db.session.query(
+            PlainModel.id, PlainModel.titel
+        ).all()
+
+    def test_duplicate_key_on_change_leaves_index_unchanged(
+        self, unique_cache
+    ):
+        unique_cache.create(PlainModel, id='1')
+        svg = unique_cache.create(PlainModel, id='2')
+
+        with pytest.raises(cache_module.DuplicateKeyException):
+            svg.id = '1'
+
+        assert '2' == svg.id
+        assert svg is unique_cache.get(PlainModel, id='2')
+
+
+class TestLoadOnMiss:
+    @pytest.fixture(scope='function')
+    def lazy_cache(self, cache_factory):
+        return cache_factory(
+            load_on_miss=True,
+            load_batch_size=2,
+            indices={'PlainModel': (('titel',), ('id', 'titel'))},
+            unique_indices={'PlainModel': (('id',),)},
+        )
+
+    def test_loads_only_looked_up_keys(self, lazy_cache):
+        PlainModel.create(id='1', titel='a')
+        svg2 = PlainModel.create(id='2', titel='b')
+
+        assert svg2 is lazy_cache.get(PlainModel, id='2')
+        assert None is lazy_cache.get(PlainModel, id='3')
+        assert [svg2] == lazy_cache._cached_instances['PlainModel']
+
+    def test_does_not_query_resolved_keys_again(self, lazy_cache):
+        svg = PlainModel.create(id='1', titel='a')
+        assert [svg] == lazy_cache.find(PlainModel, titel='a')
+        PlainModel.create(id='2', titel='a')
+
+        assert [svg] == lazy_cache.find(PlainModel, titel='a')
+
+    def test_finds_created_and_loaded_instances(self, lazy_cache):
+        svg1 = PlainModel.create(id='1', titel=None)
+        svg2 = lazy_cache.create(PlainModel, id='2', titel=None)
+
+        assert [svg2, svg1] == lazy_cache.find(PlainModel, titel=None)
+
+    def test_prefetch_keys_loads_keys_in_batches(self, lazy_cache):
+        svgs = [PlainModel.create(id=str(i), titel='a') for i in range(5)]
+        lazy_cache.prefetch_keys(
+            PlainModel, ('titel', 'id'), [('a', '1'), ('a', '3'), ('a', '4')]
+        )
+
+        assert [svgs[1], svgs[3], svgs[4]] == lazy_cache._cached_instances[
+            'PlainModel'
+        ]
+        assert svgs[3] is lazy_cache.get(PlainModel, id='3')
+        assert [svgs[1], svgs[3], svgs[4]] == lazy_cache._cached_instances[
+            'PlainModel'
+        ]
+
+    def test_undeclared_keys_are_not_loaded(self, cache_factory):
+        lazy_cache = cache_factory(
+            load_on_miss=True, unique_indices={'PlainModel': (('id',),)}
+        )
+        PlainModel.create(id='1', titel='a')
+
+        assert [] == lazy_cache.find(PlainModel, titel='a')
+
+
+class TestPreload:
+    def test_streaming_preload(self, cache_factory):
+        cache = cache_factory(preload_batch_size=2)
+        svgs = [PlainModel.create(id=str(i), titel='') for i in range(5)]
+
+        assert svgs == cache.find(PlainModel, titel='')
+        assert svgs[3] == cache.get(PlainModel, id='3')
+
+    def test_streaming_preload_updates_existing_indices(self, cache_factory):
+        cache = cache_factory(preload_batch_size=2)
+        svg = PlainModel.create(id='1', titel='')
+        cache._get_model_indices(PlainModel)[('titel',)] = {}
+
+        cache._get_model_cache(PlainModel)
+
+        assert [svg] == list(cache._indices['PlainModel'][('titel',)][('',)])
+
+    @pytest.mark.parametrize('preload_batch_size', [None, 2])
+    def test_declared_indices_are_built_on_preload(
+        self, cache_factory, preload_batch_size
+    ):
+        logger = mock.Mock()
+        cache = cache_factory(
+            indices={'PlainModel': (('titel',), ('titel', 'id'))},
+            unique_indices={'PlainModel': (('id',),)},
+            preload_batch_size=preload_batch_size,
+            logger=logger,
+        )
+        svg1 = PlainModel.create(id='1', titel='a')
+        svg2 = PlainModel.create(id='2', titel='a')
+        svg3 = PlainModel.create(id='3', titel='b')
+
+        cache._get_model_cache(PlainModel)
+
+        indices = cache._indices['PlainModel']
+        assert {('id',), ('titel',), ('id', 'titel')} == set(indices)
+        assert [svg1, svg2] == list(indices[('titel',)][('a',)])
+        assert svg3 is indices[('id',)][('3',)]
+        assert [svg3] == list(indices[('id', 'titel')][('3', 'b')])
+        messages = [c.args[0] for c in logger.debug.call_args_list]
+        assert any(
+            "Built index ('titel',) of PlainModel with 2 keys in" in m
+            for m in messages
+        )
+
+
+class TestStats:
+    def test_lookups_and_changes_are_counted(self, db, cache_factory):
+        cache = cache_factory(indices={'PlainModel': (('titel',),)})
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='a')
+        db.session.flush()
+
+        cache.find(PlainModel, titel='a')
+        cache.get(PlainModel, id='1').titel = 'b'
+        cache.find(PlainModel, titel='c')
+        cache.find_many(PlainModel, ('titel',), [('a',), ('b',), ('x',)])
+        cache.create(PlainModel, id='3')
+        cache.save_changes(db.session)
+
+        stats = cache.stats()['models']['PlainModel']
+        assert 2 == stats['preload']['rows']
+        assert 4 == stats['hits']
+        assert 2 == stats['misses']
+        assert 1 == stats['created']
+        assert 1 == stats['updated']
+        assert {'id', 'titel'} == set(stats['indices'])
+        assert 2 == stats['indices']['id']['keys']
+        assert 0 < stats['indices']['titel']['seconds']
+        assert 0 < cache.stats()['phases']['bulk_save']
+
+    def test_stats_are_logged(self, db, cache_factory):
+        logger = mock.Mock()
+        cache = cache_factory(logger=logger)
+        cache.create(PlainModel, id='1')
+        cache.reset_stats()
+        cache.find(PlainModel, id='1')
+
+        cache.log_stats()
+
+        messages = [c.args[0] for c in logger.info.call_args_list]
+        assert messages[0].startswith(
+            'PlainModel: preloaded 0 rows in 0.000s, 1 hits, 0 misses, '
+            '0 created, 0 updated, 0 deleted.'
+        )
+        assert messages[1].startswith('PlainModel: index id with 1 keys')
+        assert messages[2].startswith('Time spent flushing: sequences')
+
+
+class TestMemoryProfile:
+    @pytest.fixture(autouse=True)
+    def stop_tracing(self):
+        yield
+        tracemalloc.stop()
+
+    def test_memory_is_attributed(self, db, cache_factory):
+        for i in range(50):
+            PlainModel.create(id=str(i), titel=f'titel {i}')
+        db.session.flush()
+        cache = cache_factory(
+            indices={'PlainModel': (('titel',),)},
+            use_copy=True,
+            profile_memory=True,
+        )
+
+        cache.find(PlainModel, id='1')
+        for i in range(50):
+            cache.create(TypedModel, id=i, titel='x' * 1000)
+        cache.save_changes(db.session)
+
+        profile = cache.memory_profile()
+        plain = profile['models']['PlainModel']
+        assert plain['preload'] > plain['indices']['titel'] > 0
+        assert plain['instances'] > 0
+        assert plain['indices']['id'] > 0
+        assert profile['models']['TypedModel']['instances'] > 50000
+        assert profile['copy'] > 0
+        [cycle] = profile['cycles']
+        assert cycle['peak'] >= cycle['current']
+
+    def test_tracing_is_stopped_on_close(self, db, cache_factory):
+        cache = cache_factory(profile_memory=True)
+        cache.find(PlainModel, id='1')
+        assert tracemalloc.is_tracing()
+
+        cache.close()
+
+        assert not tracemalloc.is_tracing()
+
+    def test_tracing_is_stopped_on_garbage_collection(self, cache_factory):
+        cache = cache_factory(profile_memory=True)
+        assert tracemalloc.is_tracing()
+
+        del cache
+        gc.collect()
+
+        assert not tracemalloc.is_tracing()
+
+    def test_tracing_started_elsewhere_is_kept(self, cache_factory):
+        tracemalloc.start()
+        cache_factory(profile_memory=True).close()
+
+        assert tracemalloc.is_tracing()
+
+    def test_nothing_is_traced_by_default(self, cache):
+        cache.find(PlainModel, id='1')
+
+        assert not tracemalloc.is_tracing()
+        assert {} == cache.memory_profile()['models']['PlainModel']['indices']
+
+
+class TestAutoFlush:
+    def test_flushes_after_count(self, db, cache_factory):
+        PlainModel.create(id='0', titel='a')
+        db.session.flush()
+        cache = cache_factory(
+            auto_flush_count=3, indices={'PlainModel': (('titel',),)}
+        )
+        preloaded = cache.get(PlainModel, id='0')
+
+        cache.create(PlainModel, id='1', titel='a')
+        cache.create(PlainModel, id='2', titel='b')
+        assert 1 == PlainModel.query().count()
+        cache.create(PlainModel, id='3', titel='a')
+        assert 4 == PlainModel.query().count()
+        assert {'PlainModel': {'new': 0, 'dirty': 0}} == cache.pending_counts()
+
+        record = cache.get(PlainModel, id='1')
+        assert 'PlainModelRecord' == type(record).__name__
+        assert ('1', 'a') == (record.id, record.titel)
+        assert [preloaded, record, cache.get(PlainModel, id='3')] == (
+            cache.find(PlainModel, titel='a')
+        )
+
+        preloaded.titel = 'c'
+        cache.create(PlainModel, id='4', titel='c')
+        cache.save_changes(db.session)
+        assert 'c' == PlainModel.query().get('0').titel
+        assert 5 == PlainModel.query().count()
+
+    def test_instance_list_is_not_rebuilt_on_every_flush(
+        self, db, cache_factory
+    ):
+        cache = cache_factory(auto_flush_count=1)
+        with mock.patch.object(
+            cache, '_apply_replacements', wraps=cache._apply_replacements
+        ) as apply_replacements:
+            for i in range(16):
+                cache.create(PlainModel, id=str(i))
+
+        assert 5 == apply_replacements.call_count
+        assert 16 == PlainModel.query().count()
+        assert 16 == len(cache.find(PlainModel, titel=None))
+
+    def test_records_are_compared_by_identity(self, cache_factory):
+        cache = cache_factory(auto_flush_count=1)
+        cache.create(PlainModel, id='1')
+        cache.create(PlainModel, id='2')
+        records = cache.find(PlainModel, titel=None)
+
+        assert 2 == len(set(records))
+        assert records[0] != cache._record_class(PlainModel)('1', None)
+
+    def test_flushes_after_memory_threshold(self, db, cache_factory):
+        cache = cache_factory(auto_flush_memory=1)
+        try:
+            cache.create(PlainModel, id='1')
+            assert 1 == PlainModel.query().count()
+            assert 1 == len(cache.memory_profile()['cycles'])
+        finally:
+            tracemalloc.stop()
+
+    def test_memory_threshold_ignores_preloaded_data(self, db, cache_factory):
+        for i in range(500):
+            PlainModel.create(id=str(i), titel='preloaded')
+        db.session.flush()
+        db.session.expunge_all()
+        cache = cache_factory(auto_flush_memory=100000)
+        try:
+            cache.find(PlainModel, titel='preloaded')
+            for i in range(5):
+                cache.create(PlainModel, id=f'new {i}')
+            assert 0 == len(cache.memory_profile()['cycles'])
+            assert (
+                100000
+                < cache.memory_profile()['models']['PlainModel']['preload']
+            )
+        finally:
+            tracemalloc.stop()
+
+
+class TestReadOnlyModels:
+    def test_preloads_records(self, db, cache_factory):
+        PlainModel.create(id='1', titel='a')
+        db.session.flush()
+        db.session.expunge_all()
+        cache = cache_factory(read_only_models={'PlainModel'})
+
+        record = cache.get(PlainModel, id='1')
+
+        assert 'PlainModelRecord' == type(record).__name__
+        assert [record] == cache.find(PlainModel, titel='a')
+        assert 0 == len(db.session.identity_map)
+        with pytest.raises(AttributeError):
+            record.titel = 'b'
+
+    def test_materialize(self, db, cache_factory):
+        PlainModel.create(id='1', titel='a')
+        db.session.flush()
+        cache = cache_factory(read_only_models={'PlainModel'})
+        record = cache.get(PlainModel, id='1')
+
+        svg = cache.materialize(record)
+
+        assert isinstance(svg, PlainModel)
+        assert svg is cache.materialize(svg)
+        assert svg is cache.get(PlainModel, id='1')
+        assert [svg] == cache.find(PlainModel, titel='a')
+        svg.titel = 'b'
+        assert [svg] == cache.find(PlainModel, titel='b')
+        cache.save_changes(db.session)
+        assert 'b' == PlainModel.query().one().titel
+
+    def test_records_are_materialized_when_related(self, db, cache_factory):
+        SequenceModel.create(id=1)
+        db.session.flush()
+        cache = cache_factory(read_only_models={'SequenceModel'})
+        record = cache.get(SequenceModel, id=1)
+
+        linked = cache.create(LinkedModel, id='1', sequence_model=record)
+        cache.save_changes(db.session)
+
+        assert 1 == LinkedModel.query().one().sequence_model_id
+        assert isinstance(linked.sequence_model, SequenceModel)
+
+    def test_load_on_miss(self, db, cache_factory):
+        PlainModel.create(id='1', titel='a')
+        db.session.flush()
+        cache = cache_factory(
+            read_only_models={'PlainModel'},
+            load_on_miss=True,
+            indices={'PlainModel': (('titel',),)},
+            unique_indices={'PlainModel': (('id',),)},
+        )
+
+        [record] = cache.find(PlainModel, titel='a')
+
+        assert record is cache.get(PlainModel, id='1')
+        assert 1 == len(cache._get_model_cache(PlainModel))
+
+
+class TestColumnarModels:
+    @pytest.fixture
+    def columnar_cache(self, db, cache_factory):
+        pytest.importorskip('numpy')
+        for i in range(6):
+            TypedModel.create(id=i, count=i % 3, titel=f'titel {i}')
+        db.session.flush()
+        yield cache_factory(
+            columnar_models={'TypedModel': ('id', 'count', 'titel')},
+            preload_batch_size=4,
+        )
+
+    def test_find_and_get(self, columnar_cache):
+        records = columnar_cache.find(TypedModel, count=1)
+
+        assert [1, 4] == [x.id for x in records]
+        assert 'titel 4' == records[1].titel
+        assert 'titel 2' == columnar_cache.get(TypedModel, id=2).titel
+        assert None is columnar_cache.get(TypedModel, id=42)
+        assert [] == columnar_cache.find(TypedModel, titel='titel 10')
+        with pytest.raises(MultipleObjectsFoundException):
+            columnar_cache.get(TypedModel, count=0)
+
+    def test_find_many(self, columnar_cache):
+        result = columnar_cache.find_many(
+            TypedModel, ('titel', 'count'), [('titel 5', 2), ('titel 5', 1)]
+        )
+
+        assert [[5], []] == [[x.id for x in r] for r in result]
+        stats = columnar_cache.stats()['models']['TypedModel']
+        assert (6, 1, 1) == (
+            stats['preload']['rows'],
+            stats['hits'],
+            stats['misses'],
+        )
+
+    def test_positions_to_records_and_instances(self, columnar_cache):
+        [positions] = columnar_cache.find_positions(
+            TypedModel, ('count',), [(2,)]
+        )
+
+        records = columnar_cache.columnar_records(TypedModel, positions)
+        instances = columnar_cache.columnar_instances(TypedModel, positions)
+
+        assert [2, 5] == [x.id for x in records]
+        assert [TypedModel.query().get(2), TypedModel.query().get(5)] == (
+            instances
+        )
+
+    def test_is_read_only(self, columnar_cache):
+        with pytest.raises(ValueError):
+            columnar_cache.create(TypedModel, id=42)
+        with pytest.raises(ValueError):
+            columnar_cache.find(TypedModel, amount=1)
+
+
+class TestSortedLookups:
+    @pytest.fixture
+    def validities(self, db, cache):
+        day = datetime.date(2024, 1, 1)
+        validities = [
+            ValidityModel.create(id=1, key='a', valid_from=day),
+            ValidityModel.create(
+                id=2,
+                key='ab',
+                valid_from=day,
+                valid_to=day + datetime.timedelta(9),
+            ),
+            ValidityModel.create(
+                id=3, key='a', valid_from=day + datetime.timedelta(5)
+            ),
+            ValidityModel.create(id=4, key='b'),
+        ]
+        db.session.flush()
+        yield validities
+
+    def test_find_range(self, cache, validities):
+        day = datetime.date(2024, 1, 1)
+
+        assert validities[:3] == cache.find_range(
+            ValidityModel, 'valid_from', day
+        )
+        assert validities[:2] == cache.find_range(
+            ValidityModel,
+            'valid_from',
+            upper=day + datetime.timedelta(5),
+            include_upper=False,
+        )
+        assert [validities[2]] == cache.find_range(
+            ValidityModel, 'valid_from', day, key='a', include_lower=False
+        )
+        assert [] == cache.find_range(ValidityModel, 'id', key='c')
+
+    def test_find_prefix(self, cache, validities):
+        assert [validities[0], validities[2], validities[1]] == (
+            cache.find_prefix(ValidityModel, 'key', 'a')
+        )
+        assert [validities[1]] == cache.find_prefix(ValidityModel, 'key', 'ab')
+
+    def test_find_containing(self, cache, validities):
+        day = datetime.date(2024, 1, 1)
+
+        def find(days, **kwargs):
+            return cache.find_containing(
+                ValidityModel,
+                'valid_from',
+                'valid_to',
+                day + datetime.timedelta(days),
+                **kwargs,
+            )
+
+        assert [] == find(-1)
+        assert validities[:2] == find(0)
+        assert validities[:3] == find(9)
+        assert [validities[0], validities[2]] == find(10)
+        assert [validities[2]] == find(10, id=3)
+
+    def test_changes_are_reflected(self, cache, validities):
+        day = datetime.date(2024, 1, 1)
+        assert [validities[3]] == cache.find_prefix(ValidityModel, 'key', 'b')
+
+        validities[0].key = 'bb'
+        created = cache.create(ValidityModel, id=5, key='ba', valid_from=day)
+
+        assert [validities[3], created, validities[0]] == cache.find_prefix(
+            ValidityModel, 'key', 'b'
+        )
+        assert [validities[1], created] == cache.find_containing(
+            ValidityModel, 'valid_from', 'valid_to', day, key='ab'
+        ) + cache.find_containing(
+            ValidityModel, 'valid_from', 'valid_to', day, key='ba'
+        )
+
+    def test_created_instances_are_inserted(self, cache, validities):
+        day = datetime.date(2024, 1, 1)
+        index = cache._get_sorted_index(ValidityModel, 'range', ('id',), {})
+
+        for id in (6, 5):
+            created = cache.create(ValidityModel, id=id, valid_from=day)
+            assert [created] == cache.find_range(ValidityModel, 'id', id, id)
+            assert validities[1] in cache.find_containing(
+                ValidityModel, 'valid_from', 'valid_to', day
+            )
+
+        assert index is cache._get_sorted_index(
+            ValidityModel, 'range', ('id',), {}
+        )
+        assert [1, 2, 3, 4, 5, 6] == [
+            x.id for x in cache.find_range(ValidityModel, 'id')
+        ]
+
+
+class TestParallelPreload:
+    def test_preloads_models_concurrently(self, db, cache_factory):
+        PlainModel.create(id='1', titel='a')
+        SequenceModel.create(id=1, titel='b')
+        TypedModel.create(id=1, titel='c')
+        transaction.commit()
+        cache = cache_factory(
+            read_only_models={'TypedModel'},
+            indices={'PlainModel': (('titel',),)},
+        )
+
+        with mock.patch.object(
+            cache, '_load_instances', wraps=cache._load_instances
+        ) as load_instances:
+            cache.preload([PlainModel, SequenceModel, TypedModel], workers=2)
+
+        assert 3 == load_instances.call_count
+        assert all(c.args[2] is not None for c in load_instances.mock_calls)
+        svg = cache.get(PlainModel, titel='a')
+        assert svg is PlainModel.query().get('1')
+        assert 'b' == cache.get(SequenceModel, id=1).titel
+        assert 'TypedModelRecord' == type(cache.get(TypedModel, id=1)).__name__
+
+        svg.titel = 'x'
+        cache.save_changes(db.session)
+        assert 'x' == PlainModel.query().get('1').titel
+
+    def test_rows_are_fetched_from_the_sessions_snapshot(
+        self, db, cache_factory
+    ):
+        PlainModel.create(id='1')
+        transaction.commit()
+        cache = cache_factory()
+        fetch = cache.session.using_bind('db3').execute
+
+        def export_snapshot_and_insert(statement):
+            result = fetch(statement)
+            if 'pg_export_snapshot' not in str(statement):
+                return result
+            # Committed by another connection after the snapshot was taken.
+            with db.get_engine('db3').begin() as connection:
+                connection.execute(
+                    sqlalchemy.text("INSERT INTO plainmodel (id) VALUES ('2')")
+                )
+            return result
+
+        with mock.patch.object(
+            cache.session,
+            'using_bind',
+            return_value=mock.Mock(execute=export_snapshot_and_insert),
+        ):
+            cache.preload([PlainModel])
+
+        assert ['1'] == [x.id for x in cache.find(PlainModel, titel=None)]
+        assert 2 == PlainModel.query().count()
+
+
+class TestStitchedPrefetch:
+    @pytest.fixture
+    def family(self, db):
+        ParentModel.create(id=1)
+        ParentModel.create(id=2)
+        ChildModel.create(id=1, parent_id=1)
+        ChildModel.create(id=2, parent_id=1, active=False)
+        ChildModel.create(id=3)
+        db.session.flush()
+        db.session.expunge_all()
+
+    def test_relationships_are_stitched(self, db, cache_factory, family):
+        cache = cache_factory(
+            prefetch={'ChildModel': ('parent',), 'ParentModel': ('children',)},
+            prefetch_strategy='stitch',
+        )
+        child1, child2, child3 = [
+            cache.get(ChildModel, id=id) for id in (1, 2, 3)
+        ]
+        parent1, parent2 = [cache.get(ParentModel, id=id) for id in (1, 2)]
+
+        for instance in (child1, child3):
+            assert 'parent' not in sqlalchemy.inspect(instance).unloaded
+        for instance in (parent1, parent2):
+            assert 'children' not in sqlalchemy.inspect(instance).unloaded
+        assert parent1 is child1.parent
+        assert child3.parent is None
+        assert [child1, child2] == parent1.children
+        assert [] == parent2.children
+        assert 0 == cache.stats()['models']['ParentModel']['misses']
+
+    def test_falls_back_to_selectinload(self, db, cache_factory, family):
+        cache = cache_factory(
+            prefetch={'ChildModel': ('parent',)},
+            prefetch_strategy='stitch',
+            preload_models_filter={'ParentModel': ParentModel.id == 1},
+        )
+        child = cache.get(ChildModel, id=1)
+
+        assert not sqlalchemy.inspect(child).unloaded
+        assert 1 == child.parent.id
+        assert 'ParentModel' not in cache._cached_instances
+
+    def test_other_join_conditions_are_not_stitched(
+        self, db, cache_factory, family
+    ):
+        cache = cache_factory(
+            prefetch={'ParentModel': ('active_children', 'ordered_children')},
+            prefetch_strategy='stitch',
+        )
+        parent = cache.get(ParentModel, id=1)
+
+        assert not {'active_children', 'ordered_children'} & (
+            sqlalchemy.inspect(parent).unloaded
+        )
+        assert [1] == [x.id for x in parent.active_children]
+        assert [2, 1] == [x.id for x in parent.ordered_children]
+        assert 'ChildModel' not in cache._cached_instances
+
+
+class TestShardedImport:
+    @pytest.fixture
+    def parents(self, db):
+        ParentModel.create(id=1)
+        ParentModel.create(id=2)
+        transaction.commit()
+
+    def run(self, cache_factory, process, records):
+        driver = ShardedImport(
+            lambda: cache_factory(save_order=None, use_copy=True),
+            process,
+            shard_key=lambda record: record[1],
+            workers=2,
+            reference_models=[ParentModel],
+            batch_size=3,
+        )
+        return driver.run(records)
+
+    def test_records_are_imported_by_workers(self, db, cache_factory, parents):
+        def process(cache, record):
+            _, id, parent_id = record
+            parent = cache.get(ParentModel, id=parent_id)
+            cache.create(ChildModel, id=id, parent_id=parent.id)
+
+        stats = self.run(
+            cache_factory,
+            process,
+            (('child', id, id % 2 + 1) for id in range(10)),
+        )
+
+        assert 2 == len(stats)
+        assert [5, 5] == [s['models']['ChildModel']['created'] for s in stats]
+        assert [0, 0] == [s['models']['ParentModel']['misses'] for s in stats]
+        assert 10 == db.session.query(ChildModel).count()
+
+    def test_levels_are_saved_by_all_workers_in_turn(
+        self, db, cache_factory, parents
+    ):
+        def process(cache, record):
+            if record[0] == 'parent':
+                cache.create(ParentModel, id=record[1])
+            else:
+                cache.create(ChildModel, id=record[1], parent_id=record[2])
+
+        # Children are processed by another worker than their parent.
+        self.run(
+            cache_factory,
+            process,
+            [('child', 2, 3), ('parent', 3), ('child', 5, 4), ('parent', 4)],
+        )
+
+        assert [(2, 3), (5, 4)] == (
+            db.session.query(ChildModel.id, ChildModel.parent_id)
+            .order_by(ChildModel.id)
+            .all()
+        )
+
+    def test_worker_errors_are_raised(self, db, cache_factory, parents):
+        def process(cache, record):
+            if record[1] == 3:
+                raise ValueError('Invalid record.')
+            cache.create(ChildModel, id=record[1], parent_id=1)
+
+        with pytest.raises(WorkerError, match='Invalid record.'):
+            self.run(
+                cache_factory, process, [('child', id) for id in range(6)]
+            )
+        assert 0 == db.session.query(ChildModel).count()
+
+    def test_previous_levels_stay_committed_on_errors(
+        self, db, cache_factory, parents
+    ):
+        def process(cache, record):
+            if record[0] == 'parent':
+                cache.create(ParentModel, id=record[1])
+            else:
+                cache.create(ChildModel, id=record[1], parent_id=record[2])
+
+        # The child refers to a missing parent, failing the second level.
+        with pytest.raises(WorkerError, match='foreign key'):
+            self.run(
+                cache_factory,
+                process,
+                [('parent', 3), ('child', 4, 42), ('parent', 5)],
+            )
+        db.session.rollback()
+
+        assert [1, 2, 3, 5] == [
+            x.id for x in ParentModel.query().order_by(ParentModel.id)
+        ]
+        assert 0 == db.session.query(ChildModel).count()
+
+
+class TestRefresh:
+    def execute(self, db, statement):
+        # Committed by another connection.
+        with db.get_engine('db3').begin() as connection:
+            connection.execute(sqlalchemy.text(statement))
+
+    def test_changed_rows_are_merged(self, db, cache):
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='a')
+        transaction.commit()
+        svg1, svg2 = cache.find(PlainModel, titel='a')
+
+        self.execute(db, "UPDATE plainmodel SET titel = 'b' WHERE id = '1'")
+        self.execute(db, "INSERT INTO plainmodel VALUES ('3', 'b')")
+
+        assert 2 == cache.refresh(PlainModel)
+        assert 'b' == svg1.titel
+        assert [svg2] == cache.find(PlainModel, titel='a')
+        assert [svg1, cache.get(PlainModel, id='3')] == cache.find(
+            PlainModel, titel='b'
+        )
+        assert 0 == cache.refresh(PlainModel)
+
+    def test_rows_swapping_unique_keys_are_merged(self, db, cache_factory):
+        cache = cache_factory(unique_indices={'PlainModel': (('titel',),)})
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='b')
+        transaction.commit()
+        svg1 = cache.get(PlainModel, titel='a')
+        svg2 = cache.get(PlainModel, titel='b')
+
+        self.execute(
+            db,
+            "UPDATE plainmodel SET titel = CASE id WHEN '1' THEN 'b' "
+            "ELSE 'a' END",
+        )
+
+        assert 2 == cache.refresh(PlainModel)
+        assert svg2 is cache.get(PlainModel, titel='a')
+        assert svg1 is cache.get(PlainModel, titel='b')
+
+    def test_unsaved_changes_are_kept(self, db, cache):
+        PlainModel.create(id='1', titel='a')
+        transaction.commit()
+        svg = cache.get(PlainModel, id='1')
+        svg.titel = 'local'
+
+        self.execute(db, "UPDATE plainmodel SET titel = 'b' WHERE id = '1'")
+        cache.refresh(PlainModel)
+
+        assert 'local' == svg.titel
+        assert [svg] == cache.find(PlainModel, titel='local')
+
+    def test_version_column(self, db, cache_factory):
+        cache = cache_factory(snapshot_versions={'TypedModel': 'created'})
+        TypedModel.create(id=1, created=datetime.datetime(2024, 1, 1))
+        TypedModel.create(id=2, created=datetime.datetime(2024, 1, 2))
+        transaction.commit()
+        cache.get(TypedModel, id=1)
+
+        self.execute(
+            db,
+            "UPDATE typedmodel SET titel = 'old' WHERE id = 1;"
+            "UPDATE typedmodel SET titel = 'new', created = '2024-01-03' "
+            'WHERE id = 2',
+        )
+
+        assert 1 == cache.refresh(TypedModel)
+        assert None is cache.get(TypedModel, id=1).titel
+        assert 'new' == cache.get(TypedModel, id=2).titel
+
+    def test_read_only_records_are_replaced(self, db, cache_factory):
+        cache = cache_factory(read_only_models=('PlainModel',))
+        PlainModel.create(id='1', titel='a')
+        transaction.commit()
+        record = cache.get(PlainModel, id='1')
+
+        self.execute(db, "UPDATE plainmodel SET titel = 'b' WHERE id = '1'")
+        cache.refresh(PlainModel)
+
+        assert [] == cache.find(PlainModel, titel='a')
+        assert [('1', 'b')] == cache.find(PlainModel, titel='b')
+        assert record not in cache._get_model_cache(PlainModel)
+
+    def test_preloaded_rows_cannot_be_refreshed(self, db, cache_factory):
+        cache = cache_factory(preload_models_data={'PlainModel': ('id',)})
+        PlainModel.create(id='1', titel='a')
+        transaction.commit()
+        cache.get(PlainModel, id='1')
+
+        with pytest.raises(ValueError):
+            cache.refresh(PlainModel)
+
+
+class TestDelete:
+    def test_delete(self, db, cache):
+        svg1 = PlainModel.create(id='1', titel='a')
+        svg2 = PlainModel.create(id='2', titel='a')
+        cache.find(PlainModel, titel='a')
+
+        cache.delete(svg1)
+
+        assert None is cache.get(PlainModel, id='1')
+        assert [svg2] == cache.find(PlainModel, titel='a')
+        assert [svg2] == cache._get_model_cache(PlainModel)
+        cache.save_changes(db.session)
+        assert ['2'] == [x.id for x in PlainModel.query()]
+        assert 1 == cache.stats()['models']['PlainModel']['deleted']
+
+    def test_delete_where(self, db, cache):
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='a')
+        PlainModel.create(id='3', titel='b')
+
+        assert 2 == cache.delete_where(PlainModel, titel='a')
+        cache.save_changes(db.session)
+        assert ['3'] == [x.id for x in PlainModel.query()]
+
+    def test_new_instances_are_discarded(self, db, cache):
+        cache.delete(cache.create(PlainModel, id='1'))
+
+        assert {'PlainModel': {'new': 0, 'dirty': 0}} == cache.pending_counts()
+        cache.save_changes(db.session)
+        assert 0 == PlainModel.query().count()
+
+    def test_deleted_before_saving_in_reverse_order(self, db, cache_factory):
+        cache = cache_factory(save_order=['ParentModel', 'ChildModel'])
+        ParentModel.create(id=1)
+        ChildModel.create(id=1, parent_id=1)
+        db.session.flush()
+
+        cache.delete_where(ParentModel, id=1)
+        cache.delete_where(ChildModel, parent_id=1)
+        cache.create(ParentModel, id=1)
+        cache.save_changes(db.session)
+
+        assert 1 == ParentModel.query().count()
+        assert 0 == ChildModel.query().count()
+
+    def test_children_are_moved_before_deleting_parent(
+        self, db, cache_factory
+    ):
+        cache = cache_factory(save_order=['ParentModel', 'ChildModel'])
+        ParentModel.create(id=1)
+        ParentModel.create(id=2)
+        ChildModel.create(id=1, parent_id=1)
+        db.session.flush()
+
+        parent, child = cache.get(ParentModel, id=1), cache.get(
+            ChildModel, id=1
+        )
+
+        child.parent_id = 2
+        cache.delete(parent)
+        cache.save_changes(db.session)
+
+        assert [2] == [x.id for x in ParentModel.query()]
+        assert [2] == [x.parent_id for x in ChildModel.query()]
+
+    def test_models_missing_in_save_order(self, db, cache):
+        ValidityModel.create(id=1)
+        db.session.flush()
+
+        cache.delete(cache.get(ValidityModel, id=1))
+        cache.save_changes(db.session)
+
+        assert 0 == ValidityModel.query().count()
+
+    def test_delete_read_only_record(self, db, cache_factory):
+        cache = cache_factory(read_only_models=('PlainModel',))
+        PlainModel.create(id='1')
+        db.session.flush()
+
+        cache.delete(cache.get(PlainModel, id='1'))
+        cache.save_changes(db.session)
+
+        assert 0 == PlainModel.query().count()
+
+
+class TestCheckpoints:
+    def save_failing(self, db, cache, failing_call):
+        """Save `cache`, crashing before saving its chunk `failing_call`."""
+        save_new = cache._save_new
+        calls = []
+
+        def save(*args, **kwargs):
+            calls.append(args)
+            if len(calls) == failing_call:
+                raise RuntimeError('Crash')
+            return save_new(*args, **kwargs)
+
+        with mock.patch.object(cache, '_save_new', side_effect=save):
+            with pytest.raises(RuntimeError, match='Crash'):
+                cache.save_changes(db.session)
+        transaction.abort()
+
+    def test_failed_flush_is_resumed(self, db, cache_factory):
+        settings = dict(
+            use_copy=True, checkpoint_size=2, checkpoint_name='import'
+        )
+        cache = cache_factory(**settings)
+        for id in '12345':
+            cache.create(PlainModel, id=id)
+        self.save_failing(db, cache, 3)
+        assert ['1', '2', '3', '4'] == sorted(x.id for x in PlainModel.query())
+        assert [('import', 'PlainModel', 4)] == db.session.execute(
+            'SELECT * FROM modelcache_checkpoint'
+        ).fetchall()
+
+        cache = cache_factory(**settings)
+        for id in '12345':
+            cache.create(PlainModel, id=id, titel=id)
+        cache.save_changes(db.session)
+        transaction.commit()
+
+        assert [('1', None), ('2', None), ('3', None), ('4', None)] + [
+            ('5', '5')
+        ] == db.session.query(PlainModel.id, PlainModel.titel).order_by(
+            PlainModel.id
+        ).all()
+        assert (
+            0
+            == db.session.execute(
+                'SELECT count(*) FROM modelcache_checkpoint'
+            ).scalar()
+        )
+
+    def test_checkpoints_are_named(self, db, cache_factory):
+        cache = cache_factory(checkpoint_size=1, checkpoint_name='a')
+        cache.create(PlainModel, id='1')
+        cache.create(PlainModel, id='2')
+        self.save_failing(db, cache, 2)
+
+        cache = cache_factory(checkpoint_size=1, checkpoint_name='b')
+        cache.create(PlainModel, id='3')
+        cache.save_changes(db.session)
+        transaction.commit()
+
+        assert ['1', '3'] == sorted(x.id for x in PlainModel.query())
+        assert [('a', 'PlainModel', 1)] == db.session.execute(
+            'SELECT * FROM modelcache_checkpoint'
+        ).fetchall()
+
+    def test_strict_transaction_does_not_commit(self, db, cache_factory):
+        cache = cache_factory(
+            save_order=['ParentModel', 'ChildModel'],
+            use_copy=True,
+            strict_transaction=True,
+        )
+        cache.create(ParentModel, id=1)
+        cache.create(ChildModel, id=1, parent_id=2)
+
+        with pytest.raises(Exception, match='foreign key'):
+            cache.save_changes(db.session)
+        db.session.rollback()
+
+        assert 0 == ParentModel.query().count()
+
+    def test_strict_transaction_is_not_checkpointed(self, db, cache_factory):
+        with pytest.raises(ValueError):
+            cache_factory(checkpoint_size=1, strict_transaction=True)
+
+
+class TestSnapshot:
+    @pytest.fixture
+    def snapshot_cache(self, db, cache_factory, tmp_path):
+        def factory(**extra_settings):
+            db.session.expunge_all()
+            return cache_factory(
+                snapshot_dir=str(tmp_path),
+                indices={'PlainModel': (('titel',),)},
+                unique_indices={'PlainModel': (('id',),)},
+                **extra_settings,
+            )
+
+        yield factory
+
+    def test_restores_instances_and_indices(self, db, snapshot_cache):
+        PlainModel.create(id='1', titel='a')
+        PlainModel.create(id='2', titel='a')
+        transaction.commit()
+        snapshot_cache()._get_model_cache(PlainModel)
+
+        cache = snapshot_cache()
+        with mock.patch.object(cache, '_load_instances') as load_instances:
+            svgs = cache.find(PlainModel, titel='a')
+
+        load_instances.assert_not_called()
+        assert ['1', '2'] == [x.id for x in svgs]
+        assert svgs[1] is cache.get(PlainModel, id='2')
+        assert svgs[0] is PlainModel.query().get('1')
+
+        svgs[0].titel = 'b'
+        cache.save_changes(db.session)
+        assert 'b' == PlainModel.query().get('1').titel
+
+    def test_unsupported_values_are_not_snapshotted(
+        self, db, snapshot_cache, tmp_path
+    ):
+        PlainModel.create(id='1', titel='a')
+        transaction.commit()
+        cache = snapshot_cache()
+        snapshot = snapshot_module.Snapshot({'id': [object()]}, {})
+        with mock.patch.object(cache, '_take_snapshot', return_value=snapshot):
+            assert ['1'] == [x.id for x in cache.find(PlainModel, titel='a')]
+
+        assert [] == list(tmp_path.iterdir())
+
+    def test_changed_table_invalidates_snapshot(self, db, snapshot_cache):
+        PlainModel.create(id='1', titel='a')
+        transaction.commit()
+        snapshot_cache()._get_model_cache(PlainModel)
+        PlainModel.query().get('1').titel = 'b'
+        transaction.commit()
+
+        cache = snapshot_cache()
+
+        assert [] == cache.find(PlainModel, titel='a')
+        assert ['1'] == [x.id for x in cache.find(PlainModel, titel='b')]
+
+    def test_version_column(self, db, snapshot_cache):
+        created = datetime.datetime(2024, 1, 1)
+        TypedModel.create(id=1, titel='a', created=created)
+        transaction.commit()
+        settings = {'snapshot_versions': {'TypedModel': 'created'}}
+        snapshot_cache(**settings)._get_model_cache(TypedModel)
+        # Changes not touching the version column are not detected.
+        TypedModel.query().get(1).titel = 'b'
+        transaction.commit()
+
+        cache = snapshot_cache(**settings)
+        assert 'a' == cache.get(TypedModel, id=1).titel
+
+        TypedModel.create(id=2, created=created + datetime.timedelta(1))
+        transaction.commit()
+        cache = snapshot_cache(**settings)
+        assert 'b' == cache.get(TypedModel, id=1).titel
@@ -0,0 +1,57 @@
+import collections
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+columnar = pytest.importorskip('risclog.sqlalchemy.columnar')
+
+
+@pytest.fixture
+def table():
+    return columnar.ColumnarTable.from_batches(
+        ('zone', 'code', 'price'),
+        [[(2, 10, 1.5), (1, 20, 2.5)], [], [(2, 10, 3.5), (1, 30, 4.5)]],
+    )
+
+
+def test_builds_columns_from_batches(table):
+    assert 4 == len(table)
+    assert [2, 1, 2, 1] == table.columns['zone'].tolist()
+    assert 0 < table.nbytes
+
+
+def test_finds_positions_of_single_attribute_keys(table):
+    positions = table.find_positions(('zone',), [(2,), (3,), (1,)])
+
+    assert [[0, 2], [], [1, 3]] == [p.tolist() for p in positions]
+
+
+def test_finds_positions_of_multiple_attribute_keys(table):
+    positions = table.find_positions(
+        ('code', 'zone'), [(10, 2), (20, 1), (20, 2)]
+    )
+
+    assert [[0, 2], [1], []] == [p.tolist() for p in positions]
+
+
+def test_keys_of_other_types_do_not_match(table):
+    positions = table.find_positions(('zone',), [(None,), ('x',), (1,)])
+
+    assert [[], [], [1, 3]] == [p.tolist() for p in positions]
+
+
+def test_keys_are_not_truncated_to_the_column_width():
+    table = columnar.ColumnarTable({'id': numpy.array(['ab', 'c'])})
+
+    positions = table.find_positions(('id',), [('abc',), ('ab',)])
+
+    assert [[], [0]] == [p.tolist() for p in positions]
+
+
+def test_returns_records_of_positions(table):
+    Record = collections.namedtuple('Record', ('price', 'zone'))
+
+    records = table.records(Record, numpy.array([3, 0]))
+
+    assert [Record(4.5, 1), Record(1.5, 2)] == records
+    assert int is type(records[0].zone)
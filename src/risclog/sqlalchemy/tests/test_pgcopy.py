@@ -0,0 +1,125 @@
+import datetime
+import decimal
+import io
+import struct
+import uuid
+
+import pytest
+import risclog.sqlalchemy.pgcopy
+import sqlalchemy
+import sqlalchemy.dialects.postgresql
+
+
+def test_encodes_null_as_negative_length():
+    chunks = risclog.sqlalchemy.pgcopy.encode_rows(
+        [risclog.sqlalchemy.pgcopy.encode_int4], [(None,)]
+    )
+    assert (
+        risclog.sqlalchemy.pgcopy.HEADER
+        + struct.pack('!hi', 1, -1)
+        + risclog.sqlalchemy.pgcopy.TRAILER
+    ) == b''.join(chunks)
+
+
+@pytest.mark.parametrize(
+    'value, expected',
+    [
+        ('0', (0, 0, 0, 0, [])),
+        ('1', (1, 0, 0x0000, 0, [1])),
+        ('-12345.678', (3, 1, 0x4000, 3, [1, 2345, 6780])),
+        ('0.0001', (1, -1, 0x0000, 4, [1])),
+        ('100000000', (1, 2, 0x0000, 0, [1])),
+        ('NaN', (0, 0, 0xC000, 0, [])),
+    ],
+)
+def test_encodes_numeric_as_base_10000_digits(value, expected):
+    data = risclog.sqlalchemy.pgcopy.encode_numeric(decimal.Decimal(value))
+    ndigits, weight, sign, dscale, digits = expected
+    assert (
+        struct.pack(f'!ihhHh{ndigits}h', len(data) - 4, *expected[:4], *digits)
+        == data
+    )
+
+
+def test_encodes_timestamps_relative_to_postgres_epoch():
+    encode = risclog.sqlalchemy.pgcopy.encode_timestamptz
+    naive = datetime.datetime(2000, 1, 1, 0, 0, 1)
+    aware = datetime.datetime(
+        2000,
+        1,
+        1,
+        2,
+        0,
+        1,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=2)),
+    )
+    assert struct.pack('!iq', 8, 1000000) == encode(aware)
+    assert struct.pack(
+        '!iq', 8, 1000000
+    ) == risclog.sqlalchemy.pgcopy.encode_timestamp(naive)
+    assert struct.pack('!ii', 4, -1) == risclog.sqlalchemy.pgcopy.encode_date(
+        datetime.date(1999, 12, 31)
+    )
+
+
+def test_encoding_timestamp_ignores_time_zone_like_postgres():
+    aware = datetime.datetime(
+        2000,
+        1,
+        1,
+        0,
+        0,
+        1,
+        tzinfo=datetime.timezone(datetime.timedelta(hours=-5)),
+    )
+    assert struct.pack(
+        '!iq', 8, 1000000
+    ) == risclog.sqlalchemy.pgcopy.encode_timestamp(aware)
+
+
+def test_encoding_timestamptz_rejects_naive_values():
+    with pytest.raises(ValueError):
+        risclog.sqlalchemy.pgcopy.encode_timestamptz(
+            datetime.datetime(2000, 1, 1)
+        )
+
+
+def test_encodes_uuid_from_string():
+    value = uuid.uuid4()
+    assert struct.pack(
+        '!i', 16
+    ) + value.bytes == risclog.sqlalchemy.pgcopy.encode_uuid(str(value))
+
+
+@pytest.mark.parametrize(
+    'type_, encoder',
+    [
+        (sqlalchemy.Integer(), 'encode_int4'),
+        (sqlalchemy.BigInteger(), 'encode_int8'),
+        (sqlalchemy.SmallInteger(), 'encode_int2'),
+        (sqlalchemy.Float(), 'encode_float8'),
+        (sqlalchemy.Numeric(10, 2), 'encode_numeric'),
+        (sqlalchemy.String(10), 'encode_text'),
+        (sqlalchemy.Boolean(), 'encode_bool'),
+        (sqlalchemy.DateTime(timezone=True), 'encode_timestamptz'),
+        (sqlalchemy.dialects.postgresql.UUID(), 'encode_uuid'),
+    ],
+)
+def test_get_encoder_returns_encoder_matching_column_type(type_, encoder):
+    assert getattr(
+        risclog.sqlalchemy.pgcopy, encoder
+    ) is risclog.sqlalchemy.pgcopy.get_encoder(type_)
+
+
+def test_get_encoder_returns_none_for_unsupported_types():
+    assert None is risclog.sqlalchemy.pgcopy.get_encoder(
+        sqlalchemy.dialects.postgresql.JSONB()
+    )
+
+
+def test_copy_stream_reads_chunks_in_requested_sizes():
+    stream = io.BufferedReader(
+        risclog.sqlalchemy.pgcopy.CopyStream([b'abc', b'', b'defg'])
+    )
+    assert b'ab' == stream.read(2)
+    assert b'cdefg' == stream.read()
@@ -0,0 +1,82 @@
+import datetime
+import decimal
+import pickle
+import uuid
+
+import pytest
+import risclog.sqlalchemy.snapshot
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'model.snapshot')
+    snapshot = risclog.sqlalchemy.snapshot.Snapshot(
+        {
+            'id': [1, 2**70],
+            'created': [datetime.date(2024, 1, 1), None],
+            'changed': [
+                datetime.datetime(2024, 1, 1, 12, 30, 0, 5),
+                datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+            ],
+            'time': [datetime.time(23, 59), datetime.timedelta(-1, 5, 7)],
+            'amount': [decimal.Decimal('-1.50'), 0.25],
+            'titel': ['Ä', b'\0'],
+            'flag': [True, False],
+            'key': [uuid.uuid4(), None],
+        },
+        {('id',): {(1,): 0, (2**70,): 1}, ('flag',): {(True,): [0, 1]}},
+    )
+    risclog.sqlalchemy.snapshot.write(path, ('fingerprint', 1), snapshot)
+
+    restored = risclog.sqlalchemy.snapshot.read(path, ('fingerprint', 1))
+
+    assert 2 == len(restored)
+    assert snapshot.columns == restored.columns
+    assert snapshot.indices == restored.indices
+
+
+def test_outdated_snapshot_is_not_read(tmp_path):
+    path = str(tmp_path / 'model.snapshot')
+    snapshot = risclog.sqlalchemy.snapshot.Snapshot({'id': []}, {})
+    risclog.sqlalchemy.snapshot.write(path, 1, snapshot)
+
+    assert None is risclog.sqlalchemy.snapshot.read(path, 2)
+
+
+def test_missing_or_invalid_snapshot_is_not_read(tmp_path):
+    path = tmp_path / 'model.snapshot'
+    assert None is risclog.sqlalchemy.snapshot.read(str(path), 1)
+
+    path.write_bytes(b'')
+    assert None is risclog.sqlalchemy.snapshot.read(str(path), 1)
+
+    path.write_bytes(risclog.sqlalchemy.snapshot.MAGIC + b'\0' * 8)
+    assert None is risclog.sqlalchemy.snapshot.read(str(path), 1)
+
+
+def test_truncated_snapshot_is_not_read(tmp_path):
+    path = tmp_path / 'model.snapshot'
+    snapshot = risclog.sqlalchemy.snapshot.Snapshot({'id': [1, 2, 3]}, {})
+    risclog.sqlalchemy.snapshot.write(str(path), 1, snapshot)
+
+    path.write_bytes(path.read_bytes()[:-5])
+
+    assert None is risclog.sqlalchemy.snapshot.read(str(path), 1)
+
+
+def test_unsupported_values_are_not_written(tmp_path):
+    path = tmp_path / 'model.snapshot'
+    snapshot = risclog.sqlalchemy.snapshot.Snapshot({'id': [object()]}, {})
+
+    with pytest.raises(risclog.sqlalchemy.snapshot.UnsupportedTypeError):
+        risclog.sqlalchemy.snapshot.write(str(path), 1, snapshot)
+
+    assert [] == list(tmp_path.iterdir())
+
+
+def test_pickles_are_not_read(tmp_path):
+    path = tmp_path / 'model.snapshot'
+    path.write_bytes(
+        risclog.sqlalchemy.snapshot.MAGIC + pickle.dumps(({'id': [1]}, {}))
+    )
+
+    assert None is risclog.sqlalchemy.snapshot.read(str(path), 1)
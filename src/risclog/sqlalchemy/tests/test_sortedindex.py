@@ -0,0 +1,77 @@
+import pytest
+import risclog.sqlalchemy.sortedindex
+
+
+@pytest.fixture
+def sorted_index():
+    return risclog.sqlalchemy.sortedindex.SortedIndex(
+        [(3, 'c'), (1, 'a'), (2, 'b1'), (2, 'b2'), (5, 'e')]
+    )
+
+
+@pytest.mark.parametrize(
+    'args, expected',
+    [
+        ((), ['a', 'b1', 'b2', 'c', 'e']),
+        ((2, 3), ['b1', 'b2', 'c']),
+        ((2, 3, False, False), []),
+        ((2, None, False), ['c', 'e']),
+        ((None, 4), ['a', 'b1', 'b2', 'c']),
+        ((6,), []),
+    ],
+)
+def test_range(sorted_index, args, expected):
+    assert expected == sorted_index.range(*args)
+
+
+def test_insert_keeps_order(sorted_index):
+    sorted_index.insert(2, 'b3')
+    sorted_index.insert(0, 'z')
+    sorted_index.insert(6, 'f')
+
+    assert ['z', 'a', 'b1', 'b2', 'b3', 'c', 'e', 'f'] == sorted_index.range()
+
+
+def test_prefix():
+    index = risclog.sqlalchemy.sortedindex.SortedIndex(
+        [(key, key) for key in ['ab', 'b', 'abc', 'a', 'ba']]
+    )
+
+    assert ['ab', 'abc'] == index.prefix('ab')
+    assert ['b', 'ba'] == index.prefix('b')
+    assert [] == index.prefix('c')
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 64])
+def test_containing_matches_in_interval_semantics(monkeypatch, block_size):
+    monkeypatch.setattr(
+        risclog.sqlalchemy.sortedindex.IntervalIndex, 'block_size', block_size
+    )
+    index = risclog.sqlalchemy.sortedindex.IntervalIndex(
+        [(5, 8, 'c'), (1, 2, 'a'), (2, None, 'b'), (6, 6, 'd'), (9, 10, 'e')]
+    )
+
+    assert [] == index.containing(0)
+    assert ['a'] == index.containing(1)
+    assert ['a', 'b'] == index.containing(2)
+    assert ['b', 'c', 'd'] == index.containing(6)
+    assert ['b', 'c'] == index.containing(7)
+    assert ['b', 'e'] == index.containing(10)
+    assert ['b'] == index.containing(11)
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 64])
+def test_insert_updates_block_maxima(monkeypatch, block_size):
+    monkeypatch.setattr(
+        risclog.sqlalchemy.sortedindex.IntervalIndex, 'block_size', block_size
+    )
+    index = risclog.sqlalchemy.sortedindex.IntervalIndex(
+        [(1, 2, 'a'), (5, 8, 'c'), (9, 10, 'e')]
+    )
+
+    index.insert(2, 20, 'b')
+    index.insert(0, None, 'z')
+
+    assert ['z', 'a', 'b'] == index.containing(2)
+    assert ['z', 'b', 'e'] == index.containing(10)
+    assert ['z', 'b'] == index.containing(20)